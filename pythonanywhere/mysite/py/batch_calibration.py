@@ -0,0 +1,170 @@
+'''
+    heston calibration of many quoted surfaces in a process pool:
+
+        python batch_calibration.py surfaces.jsonl results.jsonl [--workers 4] [--method trf] [--store db.sqlite]
+
+    the input is a jsonl file, or a directory of .json (one surface) and .jsonl files, of surfaces
+    {"id": ..., "spot": ..., "input_quotes": [...], "ini_params": {...}} as sent to /heston/calibrate, optionally
+    with "method", "objective", "premium_type" and "starts" overriding the command line. every result or failure
+    is appended to the output as soon as it is done, so the output is the checkpoint: a rerun skips the surfaces
+    already in it (the failed ones too, unless --retry-failed)
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from datetime import datetime
+
+from fin.calibration_store import CalibrationStore
+from fin.heston_surrogate import ChebyshevSurrogate
+from fin.surface_calibration import calibrateSurface
+
+
+def readSurfaces(path):
+    '''
+        (id, surface) pairs of the input file or directory, the id defaults to file:line or the file name
+    '''
+    files = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(('.json', '.jsonl'))] \
+        if os.path.isdir(path) else [path]
+    for f in files:
+        with open(f) as lines:
+            if f.endswith('.json'):
+                surface = json.load(lines)
+                yield str(surface.get('id', os.path.basename(f))), surface
+                continue
+            for i, line in enumerate(lines, 1):
+                if line.strip():
+                    surface = json.loads(line)
+                    yield str(surface.get('id', '{}:{}'.format(os.path.basename(f), i))), surface
+
+
+def readCheckpoint(path, retryFailed=False):
+    '''
+        ids of the surfaces already in the output; an unfinished last line of an interrupted run is ignored
+    '''
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as lines:
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record['status'] == 'ok' or not retryFailed:
+                done.add(record['id'])
+    return done
+
+
+def jsonify(obj):
+    if hasattr(obj, 'jsonify'):
+        return obj.jsonify()
+    raise TypeError('{} is not JSON serializable'.format(type(obj).__name__))
+
+
+# state of a worker: the calibration store and surrogate, loaded once per process
+_workerStore = None
+_workerSurrogate = None
+
+
+def _initWorker(storePath, surrogatePath):
+    global _workerStore, _workerSurrogate
+    _workerStore = CalibrationStore(storePath) if storePath else None
+    _workerSurrogate = ChebyshevSurrogate.load(surrogatePath) if surrogatePath else None
+
+
+def _calibrate(task):
+    '''
+        the output record of a surface; failures are recorded, not raised
+    '''
+    surfaceId, surface, defaults = task
+    setup = dict(defaults)
+    setup.update((k, surface[k]) for k in defaults if k in surface)
+    tStart = datetime.now()
+    try:
+        # the surfaces are already spread over the cores, the starts run in the worker
+        result = calibrateSurface(float(surface['spot']), surface['input_quotes'], surface['ini_params'],
+                                  setup['method'], setup['premium_type'], setup['objective'].upper(),
+                                  int(setup['starts']), store=_workerStore, surrogate=_workerSurrogate,
+                                  max_workers=1)
+        record = {'id': surfaceId, 'status': 'ok', 'result': result}
+    except Exception as e:
+        record = {'id': surfaceId, 'status': 'failed', 'error': '{}: {}'.format(type(e).__name__, e)}
+    record['elapsed'] = (datetime.now() - tStart).total_seconds()
+    return json.dumps(record, default=jsonify)
+
+
+def run(inputPath, outputPath, defaults, workers=None, storePath=None, surrogatePath=None, retryFailed=False,
+        progress=None):
+    '''
+        calibrates the surfaces of inputPath missing in outputPath, returns the throughput summary. progress, if
+        given, is called with the count done, the count to do and the output record of every finished surface
+    '''
+    done = readCheckpoint(outputPath, retryFailed)
+    surfaces = list(readSurfaces(inputPath))
+    tasks = [(surfaceId, surface, defaults) for surfaceId, surface in surfaces if surfaceId not in done]
+    summary = {'surfaces': len(surfaces), 'skipped': len(surfaces) - len(tasks), 'ok': 0, 'failed': 0}
+
+    # complete an unfinished last line before appending
+    if os.path.exists(outputPath) and os.path.getsize(outputPath) > 0:
+        with open(outputPath, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            broken = f.read(1) != '\n'
+    else:
+        broken = False
+
+    tStart = datetime.now()
+    pool = None
+    if workers == 1:
+        _initWorker(storePath, surrogatePath)
+        records = (_calibrate(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(workers, _initWorker, (storePath, surrogatePath))
+        records = pool.imap_unordered(_calibrate, tasks, chunksize=1)
+    try:
+        with open(outputPath, 'a') as out:
+            if broken:
+                out.write('\n')
+            for n, line in enumerate(records, 1):
+                out.write(line + '\n')
+                out.flush()
+                record = json.loads(line)
+                summary[record['status']] += 1
+                if progress is not None:
+                    progress(n, len(tasks), record)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = (datetime.now() - tStart).total_seconds()
+    summary['elapsed'] = elapsed
+    summary['surfacesPerMinute'] = (summary['ok'] + summary['failed']) / elapsed * 60. if elapsed > 0. else 0.
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='batch heston calibration')
+    parser.add_argument('input', help='jsonl file or directory of .json/.jsonl files')
+    parser.add_argument('output', help='jsonl file of the results, appended to')
+    parser.add_argument('--workers', type=int, default=None, help='processes, the number of cpus by default')
+    parser.add_argument('--method', default='trf')
+    parser.add_argument('--objective', default='VOL')
+    parser.add_argument('--premium-type', default='Excluded', choices=['Included', 'Excluded'])
+    parser.add_argument('--starts', type=int, default=1)
+    parser.add_argument('--store', default=None, help='sqlite calibration store for warm starts')
+    parser.add_argument('--surrogate', default=None, help='.npz chebyshev surrogate for method surrogate')
+    parser.add_argument('--retry-failed', action='store_true', help='calibrate the failed surfaces again')
+    args = parser.parse_args()
+
+    def progress(n, total, record):
+        print '{}/{} {} {} {:.2f}s'.format(n, total, record['id'], record['status'], record['elapsed'])
+
+    summary = run(args.input, args.output,
+                  {'method': args.method, 'objective': args.objective, 'premium_type': args.premium_type,
+                   'starts': args.starts},
+                  args.workers, args.store, args.surrogate, args.retry_failed, progress)
+    print '{ok} ok, {failed} failed, {skipped} skipped in {elapsed:.1f}s: {surfacesPerMinute:.1f} surfaces/min'.format(
+        **summary)
+    sys.exit(1 if summary['failed'] else 0)
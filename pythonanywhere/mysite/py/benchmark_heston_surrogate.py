@@ -0,0 +1,95 @@
+'''
+    trains (or loads) the chebyshev surrogate of the heston implied vols and reports its error against
+    the exact COS prices, the cost per quote and the surrogate + exact polish calibration:
+
+        python benchmark_heston_surrogate.py [heston_surrogate.npz] [--train]
+'''
+import argparse
+import os
+from datetime import datetime
+
+import numpy as np
+
+from fin import heston
+from fin.heston_surrogate import ChebyshevSurrogate, averageVariance
+from fin.heston_calibration import HestonCalibrator, HestonMarket, HestonParams, FxMarket, InterpolatedZeroCurve, \
+    LinearInterpolator, ForwardCurveFromLinearPoints, ForwardHelper, ForwardCurve
+
+
+def load(path, train=False):
+    if os.path.exists(path) and not train:
+        return ChebyshevSurrogate.load(path)
+    tStart = datetime.now()
+    surrogate = ChebyshevSurrogate.train()
+    surrogate.save(path)
+    print 'trained in', datetime.now() - tStart, 'nodes', surrogate.coefficients.shape, \
+        'file', os.path.getsize(path) / 1024, 'kB'
+    return surrogate
+
+
+def accuracy(surrogate, n=500, seed=0):
+    rng = np.random.RandomState(seed)
+    errors = []
+    tExact = tSurrogate = datetime.now() - datetime.now()
+    nQuotes = 0
+    for _ in xrange(n):
+        sqrtT, sqrtV0, kappa, sqrtTheta, xi, rho = rng.uniform(surrogate.lower[1:], surrogate.upper[1:])
+        ttm, v0, theta = sqrtT ** 2., sqrtV0 ** 2., sqrtTheta ** 2.
+        # quotes between the 10 delta put and call
+        k = np.linspace(-1.5, 1.5, 7) * np.sqrt(averageVariance(v0, kappa, theta, ttm) * ttm)
+
+        tStart = datetime.now()
+        exact = heston.HestonCOS(heston.HestonParams(1., v0, 0., 0., kappa, theta, xi, rho)).smile(np.exp(k), ttm)
+        tExact += datetime.now() - tStart
+        tStart = datetime.now()
+        vols = surrogate.impliedVols(ttm, k, v0, kappa, theta, xi, rho)
+        tSurrogate += datetime.now() - tStart
+
+        errors.append(np.abs(vols - exact))
+        nQuotes += len(k)
+
+    errors = np.concatenate(errors)
+    print 'vol error over {} quotes: mean {:.2e} p99 {:.2e} max {:.2e}'.format(
+        nQuotes, np.mean(errors), np.percentile(errors, 99), np.max(errors))
+    print 'time per quote in smiles of {} quotes: exact {:.1f}us surrogate {:.1f}us'.format(
+        len(k), tExact.total_seconds() / nQuotes * 1.e6, tSurrogate.total_seconds() / nQuotes * 1.e6)
+
+
+def calibration(surrogate):
+    spot = 1.6235
+    t = [0.25, 0.5, 1., 2.]
+    domCurve = InterpolatedZeroCurve(LinearInterpolator(t, [0.02, 0.022, 0.025, 0.03]))
+    fwdPointsCurve = ForwardCurveFromLinearPoints(spot, t, [-60., -125., -254.36, -480.])
+    forCurve = ForwardHelper.implyForeignCurve(fwdPointsCurve, domCurve)
+    fxMarket = FxMarket(domCurve, forCurve, ForwardCurve(spot, domCurve, forCurve))
+
+    market = HestonMarket(domCurve, forCurve, fxMarket.fwdCurve, HestonParams(0.012, 1.2, 0.015, 0.3, -0.35))
+    strikes = []
+    vols = []
+    for ti in t:
+        ki = fxMarket.fwdCurve.fwd(ti) * np.exp(0.11 * np.sqrt(ti) * np.array([-1.5, -0.7, 0., 0.7, 1.5]))
+        strikes.append(ki)
+        vols.append(market.impl_vol(ti, ki))
+
+    iniParams = {'var0': {'value': 0.03, 'fixed': False},
+                 'kappa': {'value': 1.2, 'fixed': True},
+                 'theta': {'value': 0.03, 'fixed': False},
+                 'xi': {'value': 0.6, 'fixed': False},
+                 'rho': {'value': 0., 'fixed': False}}
+
+    for method in ['Nelder-Mead', 'trf', 'surrogate']:
+        calibrator = HestonCalibrator(fxMarket, surrogate=surrogate)
+        tStart = datetime.now()
+        params, err = calibrator.calibrate_to_surface(t, strikes, vols, iniParams, method, 'VOL')
+        print '{:12s} {} error {:.2e} {}'.format(method, datetime.now() - tStart, err, params.jsonify())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='heston surrogate benchmark')
+    parser.add_argument('path', nargs='?', default='heston_surrogate.npz')
+    parser.add_argument('--train', action='store_true', help='retrain even if the file exists')
+    args = parser.parse_args()
+
+    surrogate = load(args.path, args.train)
+    accuracy(surrogate)
+    calibration(surrogate)
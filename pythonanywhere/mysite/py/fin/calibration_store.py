@@ -0,0 +1,114 @@
+'''
+    persistent warm starts for the heston calibration
+'''
+
+import hashlib
+import json
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+
+from heston_calibration import HestonParams, PARAM_NAMES
+
+
+class CalibrationStore:
+    '''
+        calibration results in an sqlite file, keyed by the spot and a fingerprint of the quotes. a result
+        is reused as it is when spot, quotes and setup (method, objective, premium type, starts, fixed
+        parameters) match exactly; otherwise the result with the same setup and tenors whose spot and vols are
+        closest, within spotTolerance (relative) and volTolerance (absolute), serves as the starting point.
+        every call opens its own connection, so that a store can be shared by the threads of the web app
+    '''
+
+    def __init__(self, path, spotTolerance=0.02, volTolerance=0.01, maxCandidates=100):
+        self.path = path
+        self.spotTolerance = spotTolerance
+        self.volTolerance = volTolerance
+        self.maxCandidates = maxCandidates
+        with closing(self.connect()) as conn, conn:
+            conn.execute('create table if not exists calibrations ('
+                         'id integer primary key, fingerprint text, family text, spot real, vols text, '
+                         'params text, objective real, created timestamp default current_timestamp)')
+            conn.execute('create index if not exists calibrations_fingerprint on calibrations (fingerprint)')
+            conn.execute('create index if not exists calibrations_family on calibrations (family)')
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10.)
+
+    @staticmethod
+    def digest(*parts):
+        return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+    @staticmethod
+    def setup(iniParams, method, objective, premiumType, starts=1):
+        '''
+            everything besides the market that a stored result depends on
+        '''
+        fixed = dict((name, iniParams[name]['value']) for name in PARAM_NAMES if iniParams[name]['fixed'])
+        return {'method': method, 'objective': objective, 'premiumType': premiumType, 'starts': starts,
+                'fixed': fixed}
+
+    def keys(self, spot, t, vols, quotes, setup):
+        '''
+            (fingerprint, family): the fingerprint covers spot, tenors, vols and the remaining market quotes
+            (forwards, rates, ...), rounded to 12 significant digits; the family only tenors and setup
+        '''
+        def rounded(x):
+            return [float('%.12g' % xi) for xi in np.ravel(x)]
+
+        family = self.digest(rounded(t), setup)
+        fingerprint = self.digest(family, rounded(spot), [rounded(vi) for vi in vols], rounded(quotes))
+        return fingerprint, family
+
+    def lookup(self, spot, t, vols, quotes, setup):
+        '''
+            (params, objective value) of an exact match, else (params, None) of the nearest match,
+            else (None, None)
+        '''
+        fingerprint, family = self.keys(spot, t, vols, quotes, setup)
+        with closing(self.connect()) as conn:
+            row = conn.execute('select params, objective from calibrations where fingerprint = ? '
+                               'order by id desc limit 1', (fingerprint,)).fetchone()
+            if row is not None:
+                return self.params(row[0]), row[1]
+            candidates = conn.execute('select spot, vols, params from calibrations where family = ? '
+                                      'order by id desc limit ?', (family, self.maxCandidates)).fetchall()
+
+        vols = np.concatenate([np.ravel(vi) for vi in vols])
+        nearest = None
+        nearestDistance = 1.
+        for spot0, vols0, params in candidates:
+            vols0 = np.array(json.loads(vols0))
+            if vols0.shape != vols.shape:
+                continue
+            distance = max(abs(spot / spot0 - 1.) / self.spotTolerance,
+                           np.max(np.abs(vols - vols0)) / self.volTolerance)
+            if distance <= nearestDistance:
+                nearest, nearestDistance = params, distance
+        return (None if nearest is None else self.params(nearest)), None
+
+    def save(self, spot, t, vols, quotes, setup, hestonParams, objectiveValue):
+        fingerprint, family = self.keys(spot, t, vols, quotes, setup)
+        vols = [float(v) for vi in vols for v in np.ravel(vi)]
+        params = json.dumps(dict((name, float(getattr(hestonParams, name))) for name in PARAM_NAMES))
+        with closing(self.connect()) as conn, conn:
+            conn.execute('insert into calibrations (fingerprint, family, spot, vols, params, objective) '
+                         'values (?, ?, ?, ?, ?, ?)',
+                         (fingerprint, family, float(spot), json.dumps(vols), params, float(objectiveValue)))
+
+    @staticmethod
+    def params(text):
+        values = json.loads(text)
+        return HestonParams(*[values[name] for name in PARAM_NAMES])
+
+    @staticmethod
+    def warmStart(iniParams, hestonParams):
+        '''
+            iniParams with the free values replaced by those of hestonParams
+        '''
+        start = dict((name, dict(iniParams[name])) for name in PARAM_NAMES)
+        for name in PARAM_NAMES:
+            if not start[name]['fixed']:
+                start[name]['value'] = getattr(hestonParams, name)
+        return start
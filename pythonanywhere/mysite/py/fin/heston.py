@@ -1,10 +1,19 @@
 
+import copy
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import scipy.stats as st
+import scipy.special as sps
 import scipy.integrate as spi
+import scipy.interpolate as spint
 from scipy.optimize.zeros import newton, brentq
 import datetime
 
+import lets_be_rational
+import profiling
+
 
 class BSParams:
 
@@ -28,6 +37,9 @@ class HestonParams:
         self.rho = svCorrelation
         self.lmbda = priceOfVol
 
+    def key(self):
+        return (self.s0, self.v0, self.r, self.q, self.kappa, self.theta, self.xi, self.rho, self.lmbda)
+
     def isFeller(self):
         return 2. * self.kappa * self.theta > self.xi ** 2
 
@@ -55,7 +67,15 @@ class BS:
             + strike * np.exp(-self.m.r * ttm)
 
     def vanilla(self, strike, ttm, phi):
-        return self.call(strike, ttm) if phi == 1 else self.put(strike, ttm)
+        if np.ndim(strike) == 0 and np.ndim(phi) == 0:
+            return self.call(strike, ttm) if phi == 1 else self.put(strike, ttm)
+        return np.where(np.asarray(phi) == 1, self.call(strike, ttm), self.put(strike, ttm))
+
+    def vega(self, strike, ttm):
+        std = self.m.vol * np.sqrt(ttm)
+        fwd = self.m.s0 * np.exp((self.m.r - self.m.q) * ttm)
+        d1 = np.log(fwd / np.asarray(strike, dtype=float)) / std + std / 2.
+        return self.m.s0 * np.exp(-self.m.q * ttm) * np.sqrt(ttm) * np.exp(-d1 ** 2 / 2.) / np.sqrt(2. * np.pi)
 
     def P12(self, k, ttm):
         std = self.m.vol * np.sqrt(ttm)
@@ -72,7 +92,15 @@ class BS:
         finally:
             np.seterr(divide=errs['divide'], over=errs['over'])
 
-    def impliedVol(self, strike, ttm, pv, callput, guess=None):
+    def impliedVol(self, strike, ttm, pv, callput, guess=None, method='brent'):
+        profile = profiling.current()
+        if profile is not None:
+            profile.count('impliedVolSolves')
+        if method == 'rational':
+            return lets_be_rational.implied_volatility(pv * np.exp(self.m.r * ttm),
+                                                       self.m.s0 * np.exp((self.m.r - self.m.q) * ttm),
+                                                       strike, ttm, callput)
+
         atm = self.m.vol if guess is None else guess
 
         def obj(sigma): return pv - BS(BSParams(self.m.s0,
@@ -103,25 +131,257 @@ class BS:
         x = brentq(obj, l, r)
         return x
 
+    def impliedVols(self, strike, ttm, pv, callput, guess=None, tol=1.e-14, maxIter=100, method='halley'):
+        '''
+            inverts arrays of (strike, ttm, pv, callput) at once by safeguarded halley iterations
+            on the total std. dev. s = vol * sqrt(ttm); prices outside the no-arbitrage bounds give nan.
+            method='rational' inverts element by element with lets_be_rational instead
+        '''
+        args = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (strike, ttm, pv, callput)])
+        shape = args[0].shape
+        strike, ttm, pv, callput = [a.ravel() for a in args]
+        if method == 'rational':
+            vols = np.array([self.impliedVol(k, t, p, cp, method='rational')
+                             for k, t, p, cp in zip(strike, ttm, pv, callput)]).reshape(shape)
+            return vols if vols.ndim > 0 else vols[()]
+        profile = profiling.current()
+
+        fwd = self.m.s0 * np.exp((self.m.r - self.m.q) * ttm)
+        target = pv * np.exp(self.m.r * ttm)  # undiscounted
+        intrinsic = np.maximum(callput * (fwd - strike), 0.)
+        upper = np.where(callput == 1, fwd, strike)
+        valid = (target > intrinsic) & (target < upper)
+
+        lnFK = np.log(fwd / strike)
+        s = np.sqrt(ttm) * np.broadcast_to(self.m.vol if guess is None else guess, shape).ravel()
+        lo = np.zeros_like(target)
+        hi = np.full_like(target, np.inf)
+        active = valid.copy()
+
+        errs = np.geterr()
+        np.seterr(divide='ignore', invalid='ignore', over='ignore', under='ignore')
+        for _ in xrange(maxIter):
+            if not active.any():
+                break
+            if profile is not None:
+                profile.count('impliedVolIterations')
+            sa = s[active]
+            cp = callput[active]
+            d1 = lnFK[active] / sa + sa / 2.
+            d2 = d1 - sa
+            price = cp * (fwd[active] * sps.ndtr(cp * d1) - strike[active] * sps.ndtr(cp * d2))
+            vega = fwd[active] * np.exp(-d1 ** 2 / 2.) / np.sqrt(2. * np.pi)
+            f = price - target[active]
+
+            # keep the bracket, the price is increasing in s
+            lo[active] = np.where(f < 0., sa, lo[active])
+            hi[active] = np.where(f > 0., sa, hi[active])
+
+            newton = -f / vega
+            volga = vega * d1 * d2 / sa
+            step = newton / np.maximum(1. + 0.5 * newton * volga / vega, 0.5)
+            sNew = sa + step
+            # converged before the bracket test, at the root sa is one end of the bracket already.
+            # in the money f is rounding noise of the price long before the step is below tol
+            done = (np.abs(step) <= tol * sa) | (np.abs(f) <= 4. * np.finfo(float).eps * target[active])
+
+            # fall back to bisection (or doubling without upper bound) whenever halley leaves the bracket.
+            # without upper bound halley may not grow faster than doubling, nor crawl: from a low guess on
+            # the convex side of the price its steps are about 2 s / (d1 d2), then doubling is faster
+            l, h = lo[active], hi[active]
+            outside = ~done & (~np.isfinite(sNew) | (sNew <= l) | (sNew >= np.where(np.isinf(h), 2. * sa, h))
+                               | (np.isinf(h) & (sNew < 1.5 * sa)))
+            sNew = np.where(outside, np.where(np.isinf(h), 2. * sa, 0.5 * (l + h)), sNew)
+
+            s[active] = sNew
+            idx = np.flatnonzero(active)
+            active[idx[done]] = False
+        np.seterr(**errs)
+        if profile is not None:
+            profile.count('impliedVolSolves', len(target))
+
+        vols = np.where(valid, s / np.sqrt(ttm), np.nan).reshape(shape)
+        return vols if vols.ndim > 0 else vols[()]
+
     def smile(self, strike, ttm):  # @UnusedVariable
         return self.m.vol
 
 
+# order of the model parameters in the analytic gradients
+GRADIENT_PARAMS = ('v0', 'kappa', 'theta', 'xi', 'rho')
+
+
+class CFCache:
+    '''
+        bounded lru cache for cf evaluations on fixed frequency grids, keyed by the model parameters,
+        the cf, the maturity and the grid itself; shared by all pricers it is handed to. bounded by the
+        number of entries and by the number of values they hold, a carr-madan grid alone has up to 2^18
+    '''
+
+    def __init__(self, maxsize=256, maxValues=2 ** 21):
+        self.maxsize = maxsize
+        self.maxValues = maxValues
+        self.values = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def argKey(x):
+        if isinstance(x, np.ndarray):
+            return (x.dtype.str, x.shape, x.tobytes())
+        return x
+
+    @staticmethod
+    def valueSize(value):
+        if isinstance(value, tuple):
+            return sum(np.size(x) for x in value)
+        return np.size(value)
+
+    def get(self, params, name, args, compute):
+        key = (params.key(), name) + tuple(map(self.argKey, args))
+        with self.lock:
+            if key in self.entries:
+                # re-insert to mark as most recently used
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = compute(*args)
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+
+        with self.lock:
+            if key in self.entries:
+                self.values -= self.valueSize(self.entries.pop(key))
+            self.entries[key] = value
+            self.values += self.valueSize(value)
+            while self.entries and (len(self.entries) > self.maxsize or self.values > self.maxValues):
+                self.values -= self.valueSize(self.entries.popitem(last=False)[1])
+        return value
+
+    def invalidate(self, params=None):
+        '''
+            drops the entries computed for params, or everything if params is None
+        '''
+        with self.lock:
+            if params is None:
+                self.entries.clear()
+                self.values = 0
+            else:
+                paramsKey = params.key()
+                for key in [k for k in self.entries if k[0] == paramsKey]:
+                    self.values -= self.valueSize(self.entries.pop(key))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'values': self.values}
+
+
+class QuadraturePlan:
+    '''
+        fixed nodes and weights for integrals over [0, integrationLimit]:
+        gauss-legendre on each panel and, for an infinite limit (scheme 'gauss'),
+        gauss-laguerre beyond the last panel edge
+    '''
+    plans = {}
+
+    def __init__(self, scheme, n, panels):
+        self.scheme = scheme
+        self.n = n
+        self.panels = panels
+
+        x, w = np.polynomial.legendre.leggauss(n)
+        nodes = []
+        weights = []
+        for l, r in zip(panels[:-1], panels[1:]):
+            nodes.append(0.5 * (r - l) * x + 0.5 * (r + l))
+            weights.append(0.5 * (r - l) * w)
+
+        if scheme == 'gauss':
+            x, w = np.polynomial.laguerre.laggauss(n)
+            h = panels[-1] / 4.
+            nodes.append(panels[-1] + h * x)
+            weights.append(h * w * np.exp(x))
+
+        self.nodes = np.concatenate(nodes)
+        self.weights = np.concatenate(weights)
+
+    @classmethod
+    def get(cls, scheme, n, panels):
+        key = (scheme, n, tuple(panels))
+        if key not in cls.plans:
+            cls.plans[key] = QuadraturePlan(scheme, n, panels)
+        return cls.plans[key]
+
+    @classmethod
+    def heston(cls, m, ttm, stdev, n=24, integrationLimit=np.inf):
+        '''
+            panels doubling in width from half the frequency scale 1/stdev up to where the cf has decayed,
+            i.e. gaussian decay in w * stdev for small xi and exponential decay in w / xi for large xi;
+            the scale is rounded to a power of two, so that nearby maturities share the same plan
+        '''
+        base = 2. ** np.round(np.log2(1. / stdev))
+        decay = np.sqrt(1. - min(m.rho ** 2, 1. - 1.e-8)) * (m.v0 + m.kappa * m.theta * ttm) / max(m.xi, 1.e-8)
+        top = min(max(32. / stdev, 30. / decay), integrationLimit)
+
+        panels = [0., 0.5 * base]
+        while panels[-1] < top:
+            panels.append(2. * panels[-1])
+
+        if integrationLimit < np.inf:
+            panels = [p for p in panels if p < integrationLimit] + [integrationLimit]
+            return cls.get('legendre', n, panels)
+        return cls.get('gauss', n, panels)
+
+    def integrate(self, integrand):
+        return integrand(self.nodes).dot(self.weights)
+
+
 class Heston93:
 
-    def __init__(self, params, integrationLimit=400.):
+    def __init__(self, params, integrationLimit=400., integrationScheme='quad', cfCache=None):
+        profile = profiling.current()
+        if profile is not None:
+            profile.count('pricers')
         self.m = params
         self.integrationLim = integrationLimit
+        self.integrationScheme = integrationScheme
+        self.cfCache = cfCache
+
+    def setParams(self, params):
+        # cf values cached for the previous parameters are stale from now on
+        if self.cfCache is not None:
+            self.cfCache.invalidate(self.m)
+        self.m = params
+
+    def cached(self, name, compute, *args):
+        '''
+            compute(*args) through the cf cache, if any; meant for frequency grids and constants only,
+            not for the scalar frequencies visited by adaptive quadratures
+        '''
+        if self.cfCache is None:
+            return compute(*args)
+        return self.cfCache.get(self.m, type(self).__name__ + '.' + name, args, compute)
 
-    def smile(self, strike, ttm, guess=None):
+    def smile(self, strike, ttm, guess=None, method=None):
+        '''
+            implied vols; method=None picks brent for a single strike and the batched halley solver for arrays,
+            method='rational' uses lets_be_rational for both
+        '''
         fwd = self.m.s0 * np.exp((self.m.r - self.m.q) * ttm)
-        callput = 1. if strike > fwd else -1.
+        callput = np.where(np.asarray(strike) > fwd, 1., -1.)
         hestonPv = self.vanilla(strike, ttm, callput)
         bs = BS(BSParams(self.m.s0,
                          self.m.r,
                          self.m.q,
                          np.sqrt(np.abs(self.m.v0))))
-        return bs.impliedVol(strike, ttm, hestonPv, callput, guess)
+        if np.ndim(strike) == 0:
+            return bs.impliedVol(strike, ttm, hestonPv, callput, guess, method=method or 'brent')
+
+        return bs.impliedVols(strike, ttm, hestonPv, callput, guess, method=method or 'halley')
 
     def call(self, strike, ttm):
         P1, P2 = self.P12(np.log(strike), ttm)
@@ -133,7 +393,16 @@ class Heston93:
             + strike * np.exp(-self.m.r * ttm)
 
     def vanilla(self, strike, ttm, phi):
-        return self.call(strike, ttm) if phi == 1 else self.put(strike, ttm)
+        if np.ndim(strike) == 0 and np.ndim(phi) == 0:
+            return self.call(strike, ttm) if phi == 1 else self.put(strike, ttm)
+
+        # array of strikes: price all calls at once and use put-call parity for the puts
+        strike = np.asarray(strike, dtype=float)
+        call = self.call(strike, ttm)
+        put = call \
+            - self.m.s0 * np.exp(-self.m.q * ttm) \
+            + strike * np.exp(-self.m.r * ttm)
+        return np.where(np.asarray(phi) == 1, call, put)
 
     def P12(self, k, ttm):
         return map(lambda I: 0.5 + I / np.pi, self.I12(k, ttm))
@@ -144,21 +413,43 @@ class Heston93:
 
             def integrand_j(w): return self.integrand(w, j, k, ttm)
 
-            # res, _ = spi.quad(integrand_j, 0.0, np.inf)
-            res, _ = spi.quad(integrand_j, 0.0, self.integrationLim)
+            if self.integrationScheme == 'gauss':
+                res = self.plan(ttm).integrate(integrand_j)
+            else:
+                # res, _ = spi.quad(integrand_j, 0.0, np.inf)
+                res, _ = spi.quad(integrand_j, 0.0, self.integrationLim)
             I.append(res)
             # assert err < 1.e-6
 
         return I
 
+    def plan(self, ttm):
+        return QuadraturePlan.heston(self.m, ttm, self.stdev(ttm), integrationLimit=self.integrationLim)
+
+    def stdev(self, ttm):
+        # std. dev. of ln(S_T) implied by the expected integrated variance
+        m = self.m
+        if m.kappa * ttm < 1.e-8:
+            return np.sqrt(m.v0 * ttm)
+        var = m.theta * ttm - (m.v0 - m.theta) * np.expm1(-m.kappa * ttm) / m.kappa
+        return np.sqrt(var)
+
     def integrand(self, w, j, k, ttm):
+        profile = profiling.current()
+        if profile is not None:
+            profile.count('quadratureNodes', np.size(w))
         err = np.geterr()
         np.seterr(under='ignore')
-        v = np.real(np.exp(-1j * w * k) * self.cf(j, ttm, w) / (1j * w))
+        cf = self.cached('cf', self.cf, j, ttm, w) if np.ndim(w) > 0 else self.cf(j, ttm, w)
+        v = np.real(np.exp(-1j * w * k) * cf / (1j * w))
         np.seterr(under=err['under'])
         return v
 
     def cf(self, j, ttm, w):
+        profile = profiling.current()
+        if profile is not None:
+            profile.count('cfCalls')
+            profile.count('cfEvaluations', np.size(w))
         m = self.m
         x = np.log(m.s0)
         a = m.kappa * m.theta
@@ -185,15 +476,19 @@ class Heston93:
 '''
 class HestonCommonCF(Heston93):
 
-    def __init__(self, params, integrationLimit=np.inf):
-        Heston93.__init__(self, params, integrationLimit=integrationLimit)
+    def __init__(self, params, integrationLimit=np.inf, integrationScheme='quad', cfCache=None):
+        Heston93.__init__(self, params, integrationLimit=integrationLimit, integrationScheme=integrationScheme,
+                          cfCache=cfCache)
 
     def integrand(self, w, j, k, ttm):
+        cf_lnS = self.cf_lnS if np.ndim(w) == 0 else \
+            lambda w, ttm: self.cached('cf_lnS', self.cf_lnS, w, ttm)
         if j == 1:
-            return np.real(np.exp(-1j * w * k) * self.cf_lnS(w - 1j, ttm)
-                           / (1j * w * self.cf_lnS(-1j, ttm)))
+            # cf_lnS(-1j) = E[S_T] does not depend on w
+            return np.real(np.exp(-1j * w * k) * cf_lnS(w - 1j, ttm)
+                           / (1j * w * self.cached('cf_lnS', self.cf_lnS, -1j, ttm)))
         else:
-            return np.real(np.exp(-1j * w * k) * self.cf_lnS(w, ttm) / (1j * w))
+            return np.real(np.exp(-1j * w * k) * cf_lnS(w, ttm) / (1j * w))
 
     def cf_lnS(self, w, ttm):
         m = self.m
@@ -222,10 +517,15 @@ class HestonCommonCF(Heston93):
 '''
 class HestonLord(Heston93):
 
-    def __init__(self, params, integrationLimit=np.inf):
-        Heston93.__init__(self, params, integrationLimit=integrationLimit)
+    def __init__(self, params, integrationLimit=np.inf, integrationScheme='quad', cfCache=None):
+        Heston93.__init__(self, params, integrationLimit=integrationLimit, integrationScheme=integrationScheme,
+                          cfCache=cfCache)
 
     def cf(self, j, ttm, w):
+        profile = profiling.current()
+        if profile is not None:
+            profile.count('cfCalls')
+            profile.count('cfEvaluations', np.size(w))
         m = self.m
         x = np.log(m.s0)
         a = m.kappa * m.theta
@@ -250,65 +550,171 @@ class HestonLord(Heston93):
 
         return res
 
+    def cf_gradient(self, j, ttm, w):
+        '''
+            cf and its derivatives w.r.t. GRADIENT_PARAMS (leading axis of the second result),
+            by the chain rule through d, g, C and D of the cf above
+        '''
+        profile = profiling.current()
+        if profile is not None:
+            profile.count('cfGradientCalls')
+            profile.count('cfGradientEvaluations', np.size(w))
+        m = self.m
+        x = np.log(m.s0)
+        a = m.kappa * m.theta
+        b = m.kappa + m.lmbda - (m.rho * m.xi if j == 1 else 0.)
+        u = 1.5 - j
+        q = m.rho * m.xi * w * 1j
+        z = 2. * u * w * 1j - w ** 2
+        d = np.sqrt((q - b) ** 2 - m.xi ** 2 * z)
+        gp = b - q + d
+        gm = b - q - d
+        g = gp / gm
+
+        under = np.geterr()['under']
+        np.seterr(under='ignore')
+        E = np.exp(-d * ttm)
+        L = np.log((E - g) / (1. - g))
+        R = (E - 1.) / (E - g)
+        C = (m.r - m.q) * w * 1j * ttm + a / m.xi ** 2 * (ttm * gm - 2 * L)
+        D = gp / m.xi ** 2 * R
+        res = np.exp(C + D * m.v0 + 1j * w * x)
+
+        # (da, db, dq, dxi) for v0, kappa, theta, xi, rho
+        zero = np.zeros_like(q)
+        partials = [(0., 0., zero, 0.),
+                    (m.theta, 1., zero, 0.),
+                    (m.kappa, 0., zero, 0.),
+                    (0., -m.rho if j == 1 else 0., m.rho * w * 1j, 1.),
+                    (0., -m.xi if j == 1 else 0., m.xi * w * 1j, 0.)]
+        dlncf = []
+        for da, db, dq, dxi in partials:
+            dd = ((q - b) * (dq - db) - m.xi * dxi * z) / d
+            dgp = db - dq + dd
+            dgm = db - dq - dd
+            dg = (dgp * gm - gp * dgm) / gm ** 2
+            dE = -ttm * E * dd
+            dL = (dE - dg) / (E - g) + dg / (1. - g)
+            dR = dE / (E - g) - R * (dE - dg) / (E - g)
+            dC = (da - 2. * a * dxi / m.xi) / m.xi ** 2 * (ttm * gm - 2 * L) \
+                + a / m.xi ** 2 * (ttm * dgm - 2 * dL)
+            dD = (dgp - 2. * gp * dxi / m.xi) / m.xi ** 2 * R + gp / m.xi ** 2 * dR
+            dlncf.append(dC + dD * m.v0)
+        dlncf[0] = dlncf[0] + D
+        np.seterr(under=under)
+
+        return res, res * np.array(dlncf)
+
+
+def rowwise(quadrature, integrand, n):
+    '''
+        applies a scalar (adaptive) quadrature to every row, i.e. strike, of the integrand separately
+    '''
+    return np.array([quadrature(lambda w: integrand(w, i)[0, 0]) for i in xrange(n)])
+
 
 class HestonSingleIntegration(HestonLord):
 
-    def __init__(self, params, integrationLimit=np.inf, integrationScheme='quad'):
-        HestonLord.__init__(self, params, integrationLimit=integrationLimit)
-        self.integrationScheme = integrationScheme
+    def __init__(self, params, integrationLimit=np.inf, integrationScheme='quad', cfCache=None):
+        HestonLord.__init__(self, params, integrationLimit=integrationLimit, integrationScheme=integrationScheme,
+                            cfCache=cfCache)
 
     def call(self, strike, ttm):
-        k = np.log(strike)
+        '''
+            strike can be a scalar or an array; for the grid based schemes (fixed_quad, romb, ...)
+            the cf is evaluated only once on the frequency grid, which is then shared by all strikes
+        '''
+        strikes = np.atleast_1d(np.asarray(strike, dtype=float))
+        n = len(strikes)
+        k = np.log(strikes).reshape((-1, 1))
         a1 = self.m.s0 * np.exp(-self.m.q * ttm)
-        a2 = strike * np.exp(-self.m.r * ttm)
+        a2 = (strikes * np.exp(-self.m.r * ttm)).reshape((-1, 1))
 
         err = np.geterr()
         np.seterr(under='ignore')
-
-        def integrand(w):
-            i1 = self.integrand(w, 1, k, ttm)
-            i2 = self.integrand(w, 2, k, ttm)
-            return (a1 * i1 - a2 * i2) / np.pi
-
+        profile = profiling.current()
+
+        def integrand(w, i=None):
+            # rows correspond to strikes, columns to frequencies w
+            if profile is not None:
+                profile.count('quadratureNodes', np.size(w))
+            if i is None:
+                # frequency grid shared by all strikes
+                rows = slice(None)
+                cf = a1 * self.cached('cf', self.cf, 1, ttm, w) - a2 * self.cached('cf', self.cf, 2, ttm, w)
+            else:
+                rows = slice(i, i + 1)
+                cf = a1 * self.cf(1, ttm, w) - a2[rows] * self.cf(2, ttm, w)
+            return np.real(np.exp(-1j * w * k[rows]) * cf / (1j * w)) / np.pi
 
         if self.integrationScheme == 'quad':
-            I = self.integrate_quad(integrand)
+            I = self.integrate_quad(integrand, n)
         elif self.integrationScheme == 'fixed_quad':
-            I = self.integrate_fixed_quad(integrand)
+            I = self.integrate_fixed_quad(integrand, n)
         elif self.integrationScheme == 'romb':
-            I = self.integrate_romb1(integrand)
+            I = self.integrate_romb1(integrand, n)
         elif self.integrationScheme == 'romberg':
-            I = self.integrate_romberg(integrand)
+            I = self.integrate_romberg(integrand, n)
         elif self.integrationScheme == 'quadromb':
-            I = self.integrate_romb2(integrand)
+            I = self.integrate_romb2(integrand, n)
+        elif self.integrationScheme == 'gauss':
+            I = self.plan(ttm).integrate(integrand)
         else:
             raise ValueError('Unsupported integration scheme {}'.format(self.integrationScheme))
 
         np.seterr(under=err['under'])
 
-        return (a1 - a2) / 2. + I
+        pv = (a1 - a2[:, 0]) / 2. + I
+        return pv if np.ndim(strike) > 0 else pv[0]
+
+    def gradient(self, strike, ttm, phi=1.):
+        '''
+            price and its derivatives w.r.t. GRADIENT_PARAMS, integrated with the gauss plan of the price
+        '''
+        if self.integrationScheme != 'gauss':
+            raise ValueError('Analytic gradients need integrationScheme=\'gauss\', got {}'.format(
+                self.integrationScheme))
+        strikes = np.atleast_1d(np.asarray(strike, dtype=float))
+        k = np.log(strikes).reshape((1, -1, 1))
+        a1 = self.m.s0 * np.exp(-self.m.q * ttm)
+        a2 = (strikes * np.exp(-self.m.r * ttm)).reshape((1, -1, 1))
+
+        err = np.geterr()
+        np.seterr(under='ignore')
+
+        def dcf(j, ttm, w): return self.cf_gradient(j, ttm, w)[1][:, np.newaxis, :]
+
+        def integrand(w):
+            # (params, strikes, frequencies)
+            cf = a1 * self.cached('cf_gradient', dcf, 1, ttm, w) - a2 * self.cached('cf_gradient', dcf, 2, ttm, w)
+            return np.real(np.exp(-1j * w * k) * cf / (1j * w)) / np.pi
+
+        dpv = self.plan(ttm).integrate(integrand)
+        np.seterr(under=err['under'])
+
+        return self.vanilla(strike, ttm, phi), (dpv if np.ndim(strike) > 0 else dpv[:, 0])
 
-    def integrate_quad(self, integrand):
+    def integrate_quad(self, integrand, n):
         # subdivide for better performance
         b = 100.
-        pv1, _ = spi.quad(integrand, 0., b)
-        pv2, _ = spi.quad(integrand, b, self.integrationLim)
+        pv1 = rowwise(lambda f: spi.quad(f, 0., b)[0], integrand, n)
+        pv2 = rowwise(lambda f: spi.quad(f, b, self.integrationLim)[0], integrand, n)
         return pv1 + pv2
 
-    def integrate_fixed_quad(self, integrand):
+    def integrate_fixed_quad(self, integrand, n):
         # subdivide for better performance
         b = 100.
         pv1, _ = spi.fixed_quad(integrand, 1.e-9, 500., n=200)
         return pv1
 
-    def integrate_romberg(self, integrand):
+    def integrate_romberg(self, integrand, n):
         # subdivide for better performance
         b = 100.
-        pv1 = spi.romberg(integrand, 1.e-9, b)
-        pv2 = spi.romberg(integrand, b, min(self.integrationLim, 700.))
+        pv1 = rowwise(lambda f: spi.romberg(f, 1.e-9, b), integrand, n)
+        pv2 = rowwise(lambda f: spi.romberg(f, b, min(self.integrationLim, 700.)), integrand, n)
         return pv1 + pv2
 
-    def integrate_romb(self, integrand):
+    def integrate_romb(self, integrand, n):
         # subdivide for better performance
         a = 1.e-9
         b = 20.
@@ -323,12 +729,11 @@ class HestonSingleIntegration(HestonLord):
                        (c - b) / (n2 - 1))
 
         if self.integrationLim == np.inf:
-            pvinf, _ = spi.quad(integrand, c, np.inf)
-            pv += pvinf
+            pv += rowwise(lambda f: spi.quad(f, c, np.inf)[0], integrand, n)
 
         return pv
 
-    def integrate_romb1(self, integrand):
+    def integrate_romb1(self, integrand, n):
         # subdivide for better performance
         a = [1.e-9, 1., 5., 20.] + ([self.integrationLim] if self.integrationLim < np.inf else [400., np.inf])
         k = [4, 5, 6, 9]
@@ -339,16 +744,15 @@ class HestonSingleIntegration(HestonLord):
             l = a[i]
             r = a[i + 1]
             if r == np.inf:
-                pvi, _ = spi.quad(integrand, l, r)
-                pv += pvi
+                pv += rowwise(lambda f: spi.quad(f, l, r)[0], integrand, n)
             else:
-                x = np.linspace(l, r, 2 ** k[i] + 1).reshape((1, -1))
+                x = np.linspace(l, r, 2 ** k[i] + 1)
                 pv += spi.romb(integrand(x),
                                (r - l) / 2 ** k[i])
 
-        return pv.reshape((-1, 1))
+        return pv
 
-    def integrate_romb2(self, integrand):
+    def integrate_romb2(self, integrand, n):
         # subdivide for better performance
         a = [0., 1., 5., 20.] + ([self.integrationLim] if self.integrationLim < np.inf else [400., np.inf])
         k = [4, 5, 6, 9]
@@ -359,8 +763,7 @@ class HestonSingleIntegration(HestonLord):
             l = a[i]
             r = a[i + 1]
             if l == 0. or r == np.inf:
-                pvi, _ = spi.quad(integrand, l, r)
-                pv += pvi
+                pv += rowwise(lambda f: spi.quad(f, l, r)[0], integrand, n)
             else:
                 pv += spi.romb(integrand(np.linspace(l, r, 2 ** k[i] + 1)),
                                (r - l) / 2 ** k[i])
@@ -368,6 +771,260 @@ class HestonSingleIntegration(HestonLord):
         return pv
 
 
+'''
+    see Carr, Madan: Option valuation using the fast Fourier transform, 1999
+'''
+class HestonCarrMadan(HestonLord):
+
+    def __init__(self, params, alpha=0.75, eta=0.125, resolution=16., maxPoints=2 ** 18, cfCache=None):
+        HestonLord.__init__(self, params, cfCache=cfCache)
+        self.alpha = alpha  # damping of the call price in log-strike
+        self.eta = eta  # spacing of the frequency grid
+        self.resolution = resolution  # log-strike grid points per std. dev. of ln(S_T)
+        self.maxPoints = maxPoints
+
+    def call_grid(self, ttm):
+        '''
+            undiscounted call prices in units of the forward on the log-moneyness grid k = ln(K/F),
+            computed by a single fft of the damped call transform
+        '''
+        m = self.m
+        fwd = m.s0 * np.exp((m.r - m.q) * ttm)
+
+        # eta * lmbda = 2 pi / n, i.e. the number of points is driven by the strike resolution
+        n = 2 ** int(np.ceil(np.log2(2. * np.pi * self.resolution / (self.eta * self.stdev(ttm)))))
+        n = min(max(n, 2 ** 12), self.maxPoints)
+        profile = profiling.current()
+        if profile is not None:
+            profile.count('quadratureNodes', n)
+        lmbda = 2. * np.pi / (n * self.eta)
+        b = n * lmbda / 2.
+
+        j = np.arange(n)
+        v = self.eta * j
+        u = v - (self.alpha + 1.) * 1j
+
+        err = np.geterr()
+        np.seterr(under='ignore')
+        cf = self.cached('cf', self.cf, 2, ttm, u) * np.exp(-1j * u * np.log(fwd))
+        psi = cf / (self.alpha ** 2 + self.alpha - v ** 2 + 1j * (2. * self.alpha + 1.) * v)
+        np.seterr(under=err['under'])
+
+        # the integrand is hermitian in v, hence the trapezoidal rule is spectrally accurate,
+        # whereas the simpson weights of the original paper are not
+        weights = np.ones(n)
+        weights[0] = 0.5
+
+        k = -b + lmbda * j
+        c = np.exp(-self.alpha * k) / np.pi \
+            * np.real(np.fft.fft(np.exp(1j * b * v) * psi * self.eta * weights))
+
+        return k, c
+
+    def call(self, strike, ttm):
+        fwd = self.m.s0 * np.exp((self.m.r - self.m.q) * ttm)
+        k, c = self.call_grid(ttm)
+        pv = np.exp(-self.m.r * ttm) * fwd * spint.CubicSpline(k, c)(np.log(np.asarray(strike, dtype=float) / fwd))
+        return pv if np.ndim(strike) > 0 else pv[()]
+
+
+'''
+    see Fang, Oosterlee: A novel pricing method for european options
+    based on Fourier-cosine series expansions, 2008
+'''
+class HestonCOS(HestonLord):
+
+    def __init__(self, params, L=12., tol=1.e-12, minTerms=64, maxTerms=2 ** 13, cfCache=None):
+        HestonLord.__init__(self, params, cfCache=cfCache)
+        self.L = L  # truncation range in units of the std. dev. of ln(S_T/F)
+        self.tol = tol  # the expansion is cut where |cf| drops below tol
+        self.minTerms = minTerms
+        self.maxTerms = maxTerms
+
+    def cf_x(self, ttm, u):
+        # cf of x = ln(S_T/F)
+        m = self.m
+        lnFwd = np.log(m.s0) + (m.r - m.q) * ttm
+        err = np.geterr()
+        np.seterr(under='ignore', invalid='ignore', divide='ignore')
+        cf = self.cf(2, ttm, u) * np.exp(-1j * u * lnFwd)
+        np.seterr(**err)
+        return np.where(u == 0., 1., cf)
+
+    def cumulants(self, ttm):
+        '''
+            c1, c2, c4 of ln(S_T/F) by finite differences of ln(cf) around zero
+        '''
+        m = self.m
+        # one step per parameter set, so that a population gets the same steps as its members alone
+        u = 0.1 / np.sqrt(np.maximum(np.maximum(m.v0, m.theta), 1.e-8) * ttm) * np.array([-2., -1., 1., 2.])
+        h = u[..., 2]
+        f = np.log(self.cf_x(ttm, u))
+        c1 = np.imag(8. * (f[..., 2] - f[..., 1]) - (f[..., 3] - f[..., 0])) / (12. * h)
+        c2 = -np.real(16. * (f[..., 2] + f[..., 1]) - (f[..., 3] + f[..., 0])) / (12. * h ** 2)
+        c4 = np.real(f[..., 3] + f[..., 0] - 4. * (f[..., 2] + f[..., 1])) / h ** 4
+        return c1, c2, c4
+
+    def cf_grid(self, ttm, a, b):
+        '''
+            cf on the frequencies k * pi / (b - a); the number of terms is doubled until the cf has decayed
+        '''
+        n = self.minTerms
+        u = np.arange(n) * np.pi / (b - a)
+        cf = self.cf_x(ttm, u)
+        while np.abs(cf[-1]) >= self.tol and n < self.maxTerms:
+            # only the new frequencies need to be evaluated
+            uNew = np.arange(n, 2 * n) * np.pi / (b - a)
+            u = np.concatenate([u, uNew])
+            cf = np.concatenate([cf, self.cf_x(ttm, uNew)])
+            n *= 2
+        return u, cf
+
+    def put(self, strike, ttm):
+        m = self.m
+        if any(np.ndim(v) > 0 for v in vars(m).values()):
+            return self.put_population(strike, ttm)
+
+        strikes = np.atleast_1d(np.asarray(strike, dtype=float))
+        x = np.log(m.s0 / strikes) + (m.r - m.q) * ttm
+
+        # truncation range for ln(S_T/K) = x + ln(S_T/F), shared by all strikes
+        c1, c2, c4 = self.cached('cumulants', self.cumulants, ttm)
+        width = self.L * np.sqrt(np.abs(c2) + np.sqrt(np.abs(c4)))
+        a = c1 + min(np.min(x), 0.) - width
+        b = c1 + max(np.max(x), 0.) + width
+
+        u, cf = self.cached('cf_grid', self.cf_grid, ttm, a, b)
+        n = len(u)
+        profile = profiling.current()
+        if profile is not None:
+            profile.count('quadratureNodes', n)
+
+        # cosine coefficients of the put payoff (1 - e^y)^+ on [a, 0]
+        chi = (np.cos(u * a) - np.exp(a) - u * np.sin(u * a)) / (1. + u ** 2)
+        psi = np.empty(n)
+        psi[0] = -a
+        psi[1:] = -np.sin(u[1:] * a) / u[1:]
+        U = 2. / (b - a) * (psi - chi)
+        U[0] *= 0.5
+
+        terms = np.real(np.exp(1j * np.outer(x - a, u)) * cf)
+        pv = strikes * np.exp(-m.r * ttm) * terms.dot(U)
+        return pv if np.ndim(strike) > 0 else pv[0]
+
+    def members(self, rows):
+        '''
+            pricer for the given rows of a population of parameter sets
+        '''
+        m = copy.copy(self.m)
+        for k, v in vars(m).items():
+            if np.ndim(v) > 0:
+                setattr(m, k, v[rows])
+        return HestonCOS(m, self.L, self.tol, self.minTerms, self.maxTerms)
+
+    def put_population(self, strike, ttm):
+        '''
+            puts for a population of parameter sets given as (P, 1) columns, shape (P, nK), not cached; the
+            strikes are shared (nK,) or per member (P, nK). every member gets its own range and number of
+            terms as if priced alone: the frequencies are only extended for the members whose cf has not
+            decayed yet and the expansions are summed per group of members with equally many terms
+        '''
+        m = self.m
+        strikes = np.atleast_1d(np.asarray(strike, dtype=float))
+        x = np.log(m.s0 / strikes) + (m.r - m.q) * ttm
+
+        c1, c2, c4 = self.cumulants(ttm)
+        width = self.L * np.sqrt(np.abs(c2) + np.sqrt(np.abs(c4)))
+        a = (c1 + np.minimum(np.min(x, axis=-1), 0.) - width)[:, np.newaxis]
+        b = (c1 + np.maximum(np.max(x, axis=-1), 0.) + width)[:, np.newaxis]
+        x = np.broadcast_to(x, (len(a), strikes.shape[-1]))
+
+        put = np.empty((len(a), strikes.shape[-1]))
+        profile = profiling.current()
+        rows = np.arange(len(a))
+        n = self.minTerms
+        u = np.arange(n) * np.pi / (b - a)
+        cf = self.cf_x(ttm, u)
+        while True:
+            done = ~(np.abs(cf[:, -1]) >= self.tol) | (n >= self.maxTerms)
+            # bound the size of the (members, strikes, terms) intermediates
+            chunk = max(1, 2 ** 20 // (strikes.shape[-1] * n))
+            if profile is not None:
+                profile.count('quadratureNodes', np.count_nonzero(done) * n)
+            for r in np.array_split(np.flatnonzero(done), max(1, -(-np.count_nonzero(done) // chunk))):
+                if len(r) == 0:
+                    continue
+                ar, br, ur = a[rows[r]], b[rows[r]], u[r]
+                chi = (np.cos(ur * ar) - np.exp(ar) - ur * np.sin(ur * ar)) / (1. + ur ** 2)
+                psi = np.empty_like(ur)
+                psi[:, 0] = -ar[:, 0]
+                psi[:, 1:] = -np.sin(ur[:, 1:] * ar) / ur[:, 1:]
+                U = 2. / (br - ar) * (psi - chi)
+                U[:, 0] *= 0.5
+                terms = np.real(np.exp(1j * (x[rows[r]] - ar)[:, :, np.newaxis] * ur[:, np.newaxis, :])
+                                * cf[r][:, np.newaxis, :])
+                put[rows[r]] = np.matmul(terms, U[:, :, np.newaxis])[..., 0]
+            if np.all(done):
+                break
+            rows, u, cf = rows[~done], u[~done], cf[~done]
+            uNew = np.arange(n, 2 * n) * np.pi / (b[rows] - a[rows])
+            u = np.concatenate([u, uNew], axis=1)
+            cf = np.concatenate([cf, self.members(rows).cf_x(ttm, uNew)], axis=1)
+            n *= 2
+
+        pv = strikes * np.exp(-m.r * ttm) * put
+        return pv if np.ndim(strike) > 0 else pv[:, 0]
+
+    def call(self, strike, ttm):
+        return self.put(strike, ttm) \
+            + self.m.s0 * np.exp(-self.m.q * ttm) \
+            - np.asarray(strike, dtype=float) * np.exp(-self.m.r * ttm)
+
+    def cf_x_gradient(self, ttm, u):
+        m = self.m
+        lnFwd = np.log(m.s0) + (m.r - m.q) * ttm
+        err = np.geterr()
+        np.seterr(under='ignore', invalid='ignore', divide='ignore')
+        _, dcf = self.cf_gradient(2, ttm, u)
+        dcf = dcf * np.exp(-1j * u * lnFwd)
+        np.seterr(**err)
+        return np.where(u == 0., 0., dcf)
+
+    def gradient(self, strike, ttm, phi=1.):
+        '''
+            price and its derivatives w.r.t. GRADIENT_PARAMS on the same expansion as the price, i.e.
+            with the truncation range and the number of terms held fixed; calls and puts share the
+            derivatives by parity, so phi only selects the price
+        '''
+        m = self.m
+        strikes = np.atleast_1d(np.asarray(strike, dtype=float))
+        x = np.log(m.s0 / strikes) + (m.r - m.q) * ttm
+
+        c1, c2, c4 = self.cached('cumulants', self.cumulants, ttm)
+        width = self.L * np.sqrt(np.abs(c2) + np.sqrt(np.abs(c4)))
+        a = c1 + min(np.min(x), 0.) - width
+        b = c1 + max(np.max(x), 0.) + width
+
+        u, _ = self.cached('cf_grid', self.cf_grid, ttm, a, b)
+        dcf = self.cached('cf_x_gradient', self.cf_x_gradient, ttm, u)
+        n = len(u)
+        profile = profiling.current()
+        if profile is not None:
+            profile.count('quadratureNodes', n)
+
+        chi = (np.cos(u * a) - np.exp(a) - u * np.sin(u * a)) / (1. + u ** 2)
+        psi = np.empty(n)
+        psi[0] = -a
+        psi[1:] = -np.sin(u[1:] * a) / u[1:]
+        U = 2. / (b - a) * (psi - chi)
+        U[0] *= 0.5
+
+        # (params, strikes, terms)
+        terms = np.real(np.exp(1j * np.outer(x - a, u))[np.newaxis] * dcf[:, np.newaxis, :])
+        dpv = strikes * np.exp(-m.r * ttm) * terms.dot(U)
+        return self.vanilla(strike, ttm, phi), (dpv if np.ndim(strike) > 0 else dpv[:, 0])
+
+
 class PremiumType:
     Included = 1
     Excluded = 0
@@ -402,18 +1059,47 @@ class DeltaHelper:
 
         return callput * dsc * st.norm.cdf(callput * d)
 
-    def atmStrike(self, ttm, premiumType=PremiumType.Excluded, deltaType=DeltaType.Spot):
-        fwd = self.m.m.s0 * np.exp((self.m.m.r - self.m.m.q) * ttm)
-
-        atmVol = self.m.smile(fwd, ttm)
-        strike = fwd * np.exp((0.5 if premiumType ==
-                               PremiumType.Excluded else -0.5) * atmVol ** 2 * ttm)
-
-        def obj(k): return self.deltaBS(k, ttm, 1., premiumType, deltaType) \
-            + self.deltaBS(k, ttm, -1., premiumType, deltaType)
+    def deltaDerivatives(self, x, vol, ttm, callput, premiumType, deltaType):
+        '''
+            bs delta at x = ln(K/F) and its partial derivatives w.r.t. x and the vol
+        '''
+        std = vol * np.sqrt(ttm)
+        if premiumType == PremiumType.Included:
+            d = -x / std - std / 2.
+            dsc = np.exp(x)
+        else:
+            d = -x / std + std / 2.
+            dsc = 1.
+        if deltaType == DeltaType.Spot:
+            dsc = dsc * np.exp(-self.m.m.q * ttm)
+        delta = callput * dsc * sps.ndtr(callput * d)
+        density = dsc * np.exp(-d ** 2 / 2.) / np.sqrt(2. * np.pi)
+        ddx = -density / std + (delta if premiumType == PremiumType.Included else 0.)
+        ddvol = density * np.sqrt(ttm) * (x / std ** 2 + (-0.5 if premiumType == PremiumType.Included else 0.5))
+        return delta, ddx, ddvol
+
+    def smileSlope(self, fwd, x, ttm, h=1.e-4):
+        '''
+            model vols at x = ln(K/F) and their central differences in x, by a single smile call
+        '''
+        vols = np.reshape(self.m.smile(fwd * np.exp(np.concatenate([x, x + h, x - h])), ttm), (3, -1))
+        return vols[0], (vols[1] - vols[2]) / (2. * h)
 
-        strike = newton(obj, strike)
-        return strike
+    def atmStrike(self, ttm, premiumType=PremiumType.Excluded, deltaType=DeltaType.Spot, tol=1.e-10, maxIter=50):
+        '''
+            delta neutral straddle strike: x = ln(K/F) = +-vol(x)^2 ttm / 2 for premium excluded/included deltas
+            (whatever the delta type), solved by newton on the model smile
+        '''
+        fwd = self.m.m.s0 * np.exp((self.m.m.r - self.m.m.q) * ttm)
+        sign = 0.5 if premiumType == PremiumType.Excluded else -0.5
+        x = sign * self.m.smile(fwd, ttm) ** 2 * ttm * np.ones(1)
+        for _ in xrange(maxIter):
+            vol, dvol = self.smileSlope(fwd, x, ttm)
+            step = (x - sign * vol ** 2 * ttm) / (1. - 2. * sign * vol * dvol * ttm)
+            x = x - step
+            if np.max(np.abs(step)) < tol:
+                break
+        return fwd * np.exp(x[0])
 
     def atmVol(self, ttm, premiumType=PremiumType.Excluded, deltaType=DeltaType.Spot):
         atmStrike = self.atmStrike(ttm, premiumType, deltaType)
@@ -425,14 +1111,26 @@ class DeltaHelper:
         vol = self.m.smile(strike, ttm)
         return vol
 
-    def strikeForDelta(self, delta, ttm, premiumType=PremiumType.Excluded, deltaType=DeltaType.Spot):
-        strike = self.m.m.s0 * np.exp((self.m.m.r - self.m.m.q) * ttm)
-        callput = 1. if delta > 0. else -1.
-
-        def obj(k): return self.deltaBS(
-            k, ttm, callput, premiumType, deltaType) - delta
-
-        strike = newton(obj, strike)
-        return strike
+    def strikeForDelta(self, delta, ttm, premiumType=PremiumType.Excluded, deltaType=DeltaType.Spot, tol=1.e-10,
+                       maxIter=50):
+        '''
+            strikes of the deltas (a scalar or an array) on the model smile, all at once by newton on x = ln(K/F):
+            every step prices the smile once for all strikes, the delta derivatives are analytic and the smile
+            slope is a central difference
+        '''
+        fwd = self.m.m.s0 * np.exp((self.m.m.r - self.m.m.q) * ttm)
+        delta = np.asarray(delta, dtype=float)
+        target = delta.ravel()
+        callput = np.where(target > 0., 1., -1.)
+        x = np.zeros_like(target)
+        for _ in xrange(maxIter):
+            vol, dvol = self.smileSlope(fwd, x, ttm)
+            value, ddx, ddvol = self.deltaDerivatives(x, vol, ttm, callput, premiumType, deltaType)
+            step = (value - target) / (ddx + ddvol * dvol)
+            x = x - step
+            if np.max(np.abs(step)) < tol:
+                break
+        strike = (fwd * np.exp(x)).reshape(delta.shape)
+        return strike if strike.ndim > 0 else strike[()]
 
 
@@ -2,14 +2,19 @@
     heston calibration
 '''
 
-import bisect
+import datetime as dt
+import multiprocessing
+import threading
+from collections import OrderedDict
 
 import numpy as np
+import scipy.special as sps
 import scipy.stats as st
 import scipy.optimize as opt
 
 import heston
-from src.fin.heston import HestonSingleIntegration
+import profiling
+from heston import HestonSingleIntegration
 
 
 class IRCurve:
@@ -21,6 +26,7 @@ class IRCurve:
 class ZeroCurve(IRCurve):
 
     def df(self, t):
+        t = np.asarray(t, dtype=float)
         return np.exp(-t * self.zeroRate(t))
 
     def zeroRate(self, t):
@@ -30,18 +36,15 @@ class ZeroCurve(IRCurve):
 class Interpolator:
 
     def __init__(self, x, y):
-        self.x = np.array(x)
-        self.y = np.array(y)
+        self.x = np.array(x, dtype=float)
+        self.y = np.array(y, dtype=float)
 
     def locate(self, x):
-        if x <= self.x[0]:
-            return (0, 1)
-        elif x >= self.x[-1]:
-            n = len(self.x)
-            return (n - 2, n - 1)
-        else:
-            left = bisect.bisect_left(self.x, x)
-            return (left, left + 1)
+        '''
+            index of the left pillar of the segment of x (a scalar or an array), the first and last segments
+            extend beyond the pillars; a pillar starts its segment
+        '''
+        return np.clip(np.searchsorted(self.x, x, side='right') - 1, 0, len(self.x) - 2)
 
     def __call__(self, x):
         raise NotImplementedError()
@@ -51,6 +54,13 @@ class InterpolatedZeroCurve(ZeroCurve):
 
     def __init__(self, interpolator):
         self.interpolator = interpolator
+        # the dfs at the pillars are asked for by every quote of their tenor
+        self.pillarDfs = dict(zip(interpolator.x.tolist(), ZeroCurve.df(self, interpolator.x)))
+
+    def df(self, t):
+        if np.isscalar(t) and t in self.pillarDfs:
+            return self.pillarDfs[t]
+        return ZeroCurve.df(self, t)
 
     def zeroRate(self, t):
         return self.interpolator(t)
@@ -62,15 +72,14 @@ class LinearInterpolator(Interpolator):
         Interpolator.__init__(self, x, y)
 
         if len(x) > 1:
-            self.dx = self.x[1:] - self.x[:-1]
-            self.fx = (self.y[1:] - self.y[:-1]) / self.dx
+            self.slope = np.diff(self.y) / np.diff(self.x)
 
     def __call__(self, x):
+        x = np.asarray(x, dtype=float)
         if len(self.x) == 1:
-            return self.y[0]
-        elif len(self.x) > 1:
-            left, right = self.locate(x)
-            return self.y[left] + self.fx[left] * (x - self.x[left]) / self.dx[left]
+            return self.y[0] + 0. * x
+        left = self.locate(x)
+        return self.y[left] + self.slope[left] * (x - self.x[left])
 
 
 class ForwardCurve:
@@ -89,13 +98,17 @@ class ForwardCurveFromLinearPoints:
     def __init__(self, spot, t, points, fwdFactor=10000.):
         self.spot = spot
         self.t = t
-        self.points = points,
+        self.points = points
         self.fwdFactor = 1. / fwdFactor
 
         self.pointInterpolator = LinearInterpolator(np.concatenate([[0.], t]),
                                                     np.concatenate([[0.], points]))
+        self.pillarFwds = dict(zip(self.pointInterpolator.x.tolist(),
+                                   spot + self.fwdFactor * self.pointInterpolator.y))
 
     def fwd(self, t):
+        if np.isscalar(t) and t in self.pillarFwds:
+            return self.pillarFwds[t]
         return self.spot + self.fwdFactor * self.pointInterpolator(t)
 
 
@@ -103,20 +116,20 @@ class ForwardHelper:
 
     @classmethod
     def implyForeignCurve(cls, fwdCurve, domCurve):
-        t = fwdCurve.t
+        t = np.asarray(fwdCurve.t, dtype=float)
         spot = fwdCurve.fwd(0)
         # F = S * DF_for / DF_dom  => DF_for = F/S * DF_dom
-        forDf = [fwdCurve.fwd(ti) / spot * domCurve.df(ti) for ti in t]
-        zr = [-np.log(dfi) / ti for ti, dfi in zip(t, forDf)]
+        forDf = fwdCurve.fwd(t) / spot * domCurve.df(t)
+        zr = -np.log(forDf) / t
         return InterpolatedZeroCurve(LinearInterpolator(t, zr))
 
     @classmethod
     def implyDomesticCurve(cls, fwdCurve, forCurve):
-        t = fwdCurve.t
+        t = np.asarray(fwdCurve.t, dtype=float)
         spot = fwdCurve.fwd(0)
         # F = S * DF_for / DF_dom  => DF_dom = S/F * DF_for
-        domDf = [spot / fwdCurve.fwd(ti) * forCurve.df(ti) for ti in t]
-        zr = [-np.log(dfi) / ti for ti, dfi in zip(t, domDf)]
+        domDf = spot / fwdCurve.fwd(t) * forCurve.df(t)
+        zr = -np.log(domDf) / t
         return InterpolatedZeroCurve(LinearInterpolator(t, zr))
 
 
@@ -148,95 +161,701 @@ class HestonParams:
 
 class HestonMarket(FxMarket):
 
-    def __init__(self, dfDomCurve, dfForCurve, fwdCurve, hestonParams):
+    def __init__(self, dfDomCurve, dfForCurve, fwdCurve, hestonParams, integrationScheme='cos', cfCache=None):
         FxMarket.__init__(self, dfDomCurve, dfForCurve, fwdCurve)
         self.hestonParams = hestonParams
+        self.integrationScheme = integrationScheme
+        self.cfCache = cfCache
 
-    def vanilla(self, ttm, strike, callput):
-        spot = self.spot()
-        fwd = self.fwdCurve.fwd(ttm)
-        params = heston.HestonParams(
+    @staticmethod
+    def modelParams(spot, fwd, ttm, hestonParams):
+        return heston.HestonParams(
             s0=spot,
-            v0=self.hestonParams.var0,
+            v0=hestonParams.var0,
             r=0.,  # we compute undiscounted price, however fwd needs to match:
             # F = S*exp((r-q)*ttm) => q = r - ln(F/S) / ttm
             q=np.log(spot / fwd) / ttm,
-            vMeanRevSpeed=self.hestonParams.kappa,
-            vLongTermMean=self.hestonParams.theta,
-            vVol=self.hestonParams.xi,
-            svCorrelation=self.hestonParams.rho
+            vMeanRevSpeed=hestonParams.kappa,
+            vLongTermMean=hestonParams.theta,
+            vVol=hestonParams.xi,
+            svCorrelation=hestonParams.rho
         )
-        model = HestonSingleIntegration(params, integrationLimit=400., integrationScheme='romb')
 
-        return self.dfDomCurve.df(ttm) * model.vanilla(strike, ttm, callput)
+    @staticmethod
+    def pricer(params, integrationScheme, cfCache):
+        if integrationScheme == 'cos':
+            return heston.HestonCOS(params, cfCache=cfCache)
+        if integrationScheme == 'fft':
+            return heston.HestonCarrMadan(params, cfCache=cfCache)
+        return HestonSingleIntegration(params,
+                                       integrationLimit=np.inf if integrationScheme == 'gauss' else 400.,
+                                       integrationScheme=integrationScheme,
+                                       cfCache=cfCache)
+
+    def model(self, ttm):
+        params = self.modelParams(self.spot(), self.fwdCurve.fwd(ttm), ttm, self.hestonParams)
+        return self.pricer(params, self.integrationScheme, self.cfCache)
 
-    def impl_vol(self, ttm, strike):
-        spot = self.spot()
-        fwd = self.fwdCurve.fwd(ttm)
-        params = heston.HestonParams(
-            s0=spot,
-            v0=self.hestonParams.var0,
-            r=0.,  # we compute undiscounted price, however fwd needs to match:
-            # F = S*exp((r-q)*ttm) => q = r - ln(F/S) / ttm
-            q=np.log(spot / fwd) / ttm,
-            vMeanRevSpeed=self.hestonParams.kappa,
-            vLongTermMean=self.hestonParams.theta,
-            vVol=self.hestonParams.xi,
-            svCorrelation=self.hestonParams.rho
-        )
-        model = HestonSingleIntegration(params, integrationLimit=400., integrationScheme='romb')
-
-        return model.smile(strike, ttm)
+    def vanilla(self, ttm, strike, callput):
+        return self.dfDomCurve.df(ttm) * self.model(ttm).vanilla(strike, ttm, callput)
+
+    def vanilla_gradient(self, ttm, strike, callput):
+        '''
+            pv and its derivatives w.r.t. heston.GRADIENT_PARAMS, needs the 'cos' or 'gauss' scheme
+        '''
+        df = self.dfDomCurve.df(ttm)
+        pv, dpv = self.model(ttm).gradient(strike, ttm, callput)
+        return df * pv, df * dpv
+
+    def impl_vol(self, ttm, strike, method=None):
+        return self.model(ttm).smile(strike, ttm, method=method)
+
+
+class CalibrationContext:
+    '''
+        everything about the quotes of a calibration that does not depend on the heston parameters,
+        computed once per tenor: forward, discount factor, the q matching the forward, otm flags and the
+        market pvs and vegas. the pricers are built once per tenor as well and only get new parameters
+        on every trial, each tenor is then priced by a single vectorized call
+    '''
+
+    def __init__(self, fxMarket, t, strikes, vols, integrationScheme='cos', cfCache=None):
+        self.spot = fxMarket.spot()
+        self.integrationScheme = integrationScheme
+        self.cfCache = cfCache
+        self.t = [float(ti) for ti in t]
+        self.strikes = [np.asarray(ki, dtype=float) for ki in strikes]
+        self.vols = [np.asarray(vi, dtype=float) for vi in vols]
+        # all tenors at once
+        tenors = np.array(self.t)
+        self.fwd = list(fxMarket.fwdCurve.fwd(tenors))
+        self.df = list(fxMarket.dfDomCurve.df(tenors))
+        self.callput = [np.where(ki > fwd, 1., -1.) for ki, fwd in zip(self.strikes, self.fwd)]
+
+        # continuously compounded rates of the bs quotes
+        self.r = list(-np.log(self.df) / tenors)
+        self.q = list(-np.log(fxMarket.dfForCurve.df(tenors)) / tenors)
+        self.marketPvs = []
+        self.marketVegas = []
+        for i in self.tenors():
+            bs = self.bs(i)
+            self.marketPvs.append(bs.vanilla(self.strikes[i], self.t[i], self.callput[i]))
+            self.marketVegas.append(bs.vega(self.strikes[i], self.t[i]))
+
+        self.hestonParams = None
+        self.pricers = [None] * len(self.t)
+
+    def tenors(self):
+        return xrange(len(self.t))
+
+    def bs(self, i, vols=None):
+        return heston.BS(heston.BSParams(self.spot, self.r[i], self.q[i], self.vols[i] if vols is None else vols))
+
+    def setParams(self, hestonParams):
+        '''
+            the parameters may also be (P, 1) columns of a population, priced at once by the 'cos' pricers
+            of a context without cf cache
+        '''
+        old = self.hestonParams
+        if old is not None and all(np.array_equal(v, getattr(hestonParams, k)) for k, v in vars(old).items()):
+            return
+        self.hestonParams = hestonParams
+        for i, ti in enumerate(self.t):
+            params = HestonMarket.modelParams(self.spot, self.fwd[i], ti, hestonParams)
+            if self.pricers[i] is None:
+                self.pricers[i] = HestonMarket.pricer(params, self.integrationScheme, self.cfCache)
+            else:
+                self.pricers[i].setParams(params)
+
+    def pvs(self, i):
+        return self.df[i] * self.pricers[i].vanilla(self.strikes[i], self.t[i], self.callput[i])
+
+    def pvs_gradient(self, i):
+        '''
+            otm pvs and their derivatives w.r.t. heston.GRADIENT_PARAMS, shape (5, len(strikes))
+        '''
+        pv, dpv = self.pricers[i].gradient(self.strikes[i], self.t[i], self.callput[i])
+        return self.df[i] * pv, self.df[i] * dpv
+
+    def impl_vols(self, i):
+        return self.pricers[i].smile(self.strikes[i], self.t[i])
+
+    def residuals(self, i, objective, weighted=False, gradient=False):
+        '''
+            per-quote residuals of tenor i for the PV, VEGA or VOL objective, PV ones divided by the market
+            vegas if weighted, and with gradient their derivatives w.r.t. heston.GRADIENT_PARAMS, else None.
+            VEGA is the weighted PV: price residuals turned into approximate vol residuals by the market
+            vegas, without implied vol inversions. VOL falls back to VEGA for the model pvs without implied
+            vol, outside of the no-arbitrage bounds
+        '''
+        if objective == 'VEGA':
+            objective, weighted = 'PV', True
+        if not gradient:
+            if objective == 'PV':
+                res = self.pvs(i) - self.marketPvs[i]
+                return (res / self.marketVegas[i] if weighted else res), None
+            res = self.impl_vols(i) - self.vols[i]
+            failed = np.isnan(res)
+            if np.any(failed):
+                res = np.where(failed, (self.pvs(i) - self.marketPvs[i]) / self.marketVegas[i], res)
+            return res, None
+
+        pv, dpv = self.pvs_gradient(i)
+        if objective == 'PV':
+            if weighted:
+                return (pv - self.marketPvs[i]) / self.marketVegas[i], dpv / self.marketVegas[i]
+            return pv - self.marketPvs[i], dpv
+        # implied vols of the model pvs and d(vol) = d(pv) / vega(vol), the market vegas where there is none
+        iv = self.bs(i).impliedVols(self.strikes[i], self.t[i], pv, self.callput[i], self.vols[i])
+        failed = np.isnan(iv)
+        vega = np.where(failed, self.marketVegas[i],
+                        self.bs(i, np.where(failed, self.vols[i], iv)).vega(self.strikes[i], self.t[i]))
+        return np.where(failed, (pv - self.marketPvs[i]) / self.marketVegas[i], iv - self.vols[i]), dpv / vega
+
+
+class TenorResidualCache:
+    '''
+        bounded lru cache of per-tenor residuals and their derivatives w.r.t. heston.GRADIENT_PARAMS, keyed by
+        the tenor's market data and quotes, the objective and the heston parameters; shared by the
+        calibrators it is handed to
+    '''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(ctx, i, objective, weighted, hestonParams):
+        return (ctx.integrationScheme, ctx.spot, ctx.t[i], ctx.fwd[i], ctx.df[i], ctx.q[i],
+                ctx.strikes[i].tobytes(), ctx.vols[i].tobytes(), objective, weighted,
+                tuple(float(getattr(hestonParams, name)) for name in PARAM_NAMES))
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            # re-insert to mark as most recently used
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+# state of a TenorPool worker: the preloaded market and a context per quoted tenor
+_workerMarket = None
+_workerScheme = None
+_workerCache = None
+_workerContexts = OrderedDict()
+
+
+def _initTenorWorker(fxMarket, integrationScheme):
+    global _workerMarket, _workerScheme, _workerCache
+    _workerMarket = fxMarket
+    _workerScheme = integrationScheme
+    _workerCache = heston.CFCache()
+    _workerContexts.clear()
+
+
+def _tenorResiduals(task):
+    ti, ki, vi, hestonParams, objective, weighted, gradient, errs = task
+    key = (ti, ki.tobytes(), vi.tobytes())
+    ctx = _workerContexts.get(key)
+    if ctx is None:
+        ctx = CalibrationContext(_workerMarket, [ti], [ki], [vi], _workerScheme, _workerCache)
+        _workerContexts[key] = ctx
+        while len(_workerContexts) > 64:
+            _workerContexts.popitem(last=False)
+    # same floating point error handling as the caller
+    saved = np.seterr(**errs)
+    try:
+        ctx.setParams(hestonParams)
+        return ctx.residuals(0, objective, weighted, gradient)
+    finally:
+        np.seterr(**saved)
+
+
+class TenorPool:
+    '''
+        persistent process pool for the per-tenor residuals of the calibration objectives; the workers get
+        the market once and keep a CalibrationContext per quoted tenor, objective calls only ship the
+        tenor's quotes and the parameters. results come back in tenor order and are combined by the
+        caller exactly as the serial ones
+    '''
+
+    def __init__(self, fxMarket, integrationScheme='cos', max_workers=None):
+        self.pool = multiprocessing.Pool(max_workers, _initTenorWorker, (fxMarket, integrationScheme))
+
+    def residuals(self, ctx, hestonParams, objective, weighted=False, gradient=False):
+        errs = np.geterr()
+        tasks = [(ctx.t[i], ctx.strikes[i], ctx.vols[i], hestonParams, objective, weighted, gradient, errs)
+                 for i in ctx.tenors()]
+        return self.pool.map(_tenorResiduals, tasks, chunksize=1)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class CalibrationAborted(Exception):
+    pass
+
+
+class EarlyStop:
+    '''
+        objective monitor of a multi-start run: publishes the run's best value to the best value shared by
+        all runs and aborts the run once it has been dominated by more than abortRatio after abortAfter
+        evaluations
+    '''
+
+    def __init__(self, sharedBest, abortAfter, abortRatio):
+        self.sharedBest = sharedBest
+        self.abortAfter = abortAfter
+        self.abortRatio = abortRatio
+        self.best = np.inf
+        self.nfev = 0
+
+    def __call__(self, f):
+        self.nfev += 1
+        if f < self.best:
+            self.best = f
+            with self.sharedBest.get_lock():
+                if f < self.sharedBest.value:
+                    self.sharedBest.value = f
+        if self.nfev >= self.abortAfter and self.best > self.abortRatio * self.sharedBest.value:
+            raise CalibrationAborted('dominated after {} evaluations'.format(self.nfev))
+
+
+def _runStart(calibrator, sharedBest, task):
+    i, iniParams, t, strikes, vols, method, objective, vegaWeighted, abortAfter, abortRatio = task
+    monitor = EarlyStop(sharedBest, abortAfter, abortRatio)
+    diagnostics = {'start': i,
+                   'iniParams': {name: iniParams[name]['value'] for name in PARAM_NAMES},
+                   'status': 'finished',
+                   'message': '',
+                   'hestonParams': None}
+    tStart = dt.datetime.now()
+    try:
+        diagnostics['hestonParams'], diagnostics['objectiveValue'] = calibrator.calibrate_to_surface(
+            t, strikes, vols, iniParams, method, objective, vegaWeighted, monitor=monitor)
+    except CalibrationAborted as e:
+        diagnostics.update(status='aborted', message=str(e))
+    except (FloatingPointError, ValueError) as e:
+        diagnostics.update(status='failed', message='{}: {}'.format(type(e).__name__, e))
+    if diagnostics['status'] != 'finished':
+        # null rather than an infinity json does not have, until the run has seen a finite value
+        diagnostics['objectiveValue'] = monitor.best if np.isfinite(monitor.best) else None
+    diagnostics['evaluations'] = monitor.nfev
+    diagnostics['elapsed'] = str(dt.datetime.now() - tStart)
+    return diagnostics
+
+
+# state of a multi-start worker: a serial calibrator and the best objective value of all runs
+_startCalibrator = None
+_startBest = None
+
+
+def _initStartWorker(fxMarket, integrationScheme, surrogate, sharedBest):
+    global _startCalibrator, _startBest
+    _startCalibrator = HestonCalibrator(fxMarket, integrationScheme, surrogate=surrogate)
+    _startBest = sharedBest
+
+
+def _calibrateFromStart(task):
+    return _runStart(_startCalibrator, _startBest, task)
+
+
+# scipy.optimize.minimize methods that do not use the jacobian
+GRADIENT_FREE_METHODS = ('nelder-mead', 'powell', 'cobyla')
+
+# integration schemes whose pricers have analytic parameter gradients
+GRADIENT_SCHEMES = ('cos', 'gauss')
+
+# the bounded least squares of calibrate_to_surface_trf, 'lm' is its former name
+LEAST_SQUARES_METHODS = ('trf', 'lm')
+
+# box constraints of the natural parameters for method='trf'
+PARAM_NAMES = ['var0', 'kappa', 'theta', 'xi', 'rho']
+PARAM_BOUNDS = {'var0': (1.e-8, 4.),
+                'kappa': (1.e-4, 50.),
+                'theta': (1.e-8, 4.),
+                'xi': (1.e-4, 10.),
+                'rho': (-0.9999, 0.9999)}
+
+# box of the random starts of the multi-start calibration
+START_BOUNDS = {'var0': (1.e-4, 0.25),
+                'kappa': (0.1, 10.),
+                'theta': (1.e-4, 0.25),
+                'xi': (0.05, 2.),
+                'rho': (-0.9, 0.9)}
 
 
 class HestonCalibrator:
 
-    def __init__(self, fxMarket):
+    def __init__(self, fxMarket, integrationScheme='cos', cfCache=None, max_workers=None, tenorCache=None,
+                 surrogate=None):
+        '''
+            max_workers > 1 fans the tenors of every objective call out to a persistent TenorPool,
+            tenorCache keeps the calibrated tenors for calibrate_to_surface_incremental, surrogate is a
+            heston_surrogate.ChebyshevSurrogate for method='surrogate'
+        '''
         self.fxMarket = fxMarket
+        self.integrationScheme = integrationScheme
+        self.cfCache = heston.CFCache() if cfCache is None else cfCache
+        self.tenorCache = TenorResidualCache() if tenorCache is None else tenorCache
+        self.surrogate = surrogate
+        self.max_workers = max_workers
+        self.pool = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def context(self, t, strikes, vols):
+        with profiling.timer('context'):
+            return CalibrationContext(self.fxMarket, t, strikes, vols, self.integrationScheme, self.cfCache)
+
+    def residuals(self, ctx, hestonParams, objective, weighted=False, gradient=False):
+        '''
+            per-tenor (residuals, derivatives) of ctx's quotes, serially or from the tenor pool; every call is
+            one objective evaluation of the profile, if any
+        '''
+        profile = profiling.current()
+        if profile is None:
+            return self.tenorResiduals(ctx, hestonParams, objective, weighted, gradient)
+        profile.count('objectiveCalls')
+        if gradient:
+            profile.count('gradientCalls')
+        with profile.timer('objective'):
+            return self.tenorResiduals(ctx, hestonParams, objective, weighted, gradient)
+
+    def tenorResiduals(self, ctx, hestonParams, objective, weighted, gradient):
+        if self.max_workers is None or self.max_workers <= 1 or len(ctx.t) < 2:
+            ctx.setParams(hestonParams)
+            return [ctx.residuals(i, objective, weighted, gradient) for i in ctx.tenors()]
+        if self.pool is None:
+            self.pool = TenorPool(self.fxMarket, self.integrationScheme, self.max_workers)
+        return self.pool.residuals(ctx, hestonParams, objective, weighted, gradient)
 
     def calibrate_to_single_smile(self, t, strikes, vols, iniParams):
         self.iniParams = iniParams
+        ctx = self.context([t], [strikes], [vols])
 
-        def obj(params): return sum(
-            (self.impl_vol(t, strikes, params) - vols) ** 2.)
+        def obj(params):
+            [(res, _)] = self.residuals(ctx, self.getHestonParams(params), 'VOL')
+            return sum(res ** 2.)
 
         res = opt.minimize(obj, self.getIniParams(
             iniParams), method='nelder-mead')
         calibratedParams = self.getHestonParams(res.x)
         return calibratedParams
 
-    def calibrate_to_surface(self, t, strikes, vols, iniParams, method, objective):
-        self.iniParams = iniParams
-
-        spot = self.fxMarket.spot()
-        if objective == 'PV':
-            otm_pvs = []
-            for ti, ki, vi in zip(t, strikes, vols):
-                fwd = self.fxMarket.fwdCurve.fwd(ti)
-                r = -np.log(self.fxMarket.dfDomCurve.df(ti)) / ti
-                q = -np.log(self.fxMarket.dfForCurve.df(ti)) / ti
-                otm_pvs.append([heston.BS(heston.BSParams(spot, r, q, v)).vanilla(k, ti, np.sign(k - fwd))
-                       for k, v in zip(ki, vi)])
-
-            def obj(params): return sum([sum((self.pvs(ti, ki, params) - pvs) ** 2.)
-                                         for ti, ki, vi, pvs in zip(t, strikes, vols, otm_pvs)])
+    def calibrate_to_surface(self, t, strikes, vols, iniParams, method, objective, vegaWeighted=True, seed=None,
+                             monitor=None):
+        '''
+            monitor, if given, is called with every value of the objective and may abort the run by raising
+        '''
+        if method in LEAST_SQUARES_METHODS:
+            return self.calibrate_to_surface_trf(t, strikes, vols, iniParams, objective, vegaWeighted, monitor)
+        if method == 'DE':
+            return self.calibrate_to_surface_de(t, strikes, vols, iniParams, objective, vegaWeighted, seed)
+        if method.lower() == 'surrogate':
+            return self.calibrate_to_surface_surrogate(t, strikes, vols, iniParams, objective, vegaWeighted, monitor)
 
+        self.iniParams = iniParams
+        ctx = self.context(t, strikes, vols)
+
+        def obj(params):
+            f = sum([sum(res ** 2.) for res, _ in self.residuals(ctx, self.getHestonParams(params), objective)])
+            if monitor is not None:
+                monitor(f)
+            return f
+
+        x0 = self.getIniParams(iniParams)
+        jac = None
+        scale = 1.
+        if objective in ('PV', 'VEGA') and method.lower() not in GRADIENT_FREE_METHODS \
+                and self.integrationScheme in GRADIENT_SCHEMES:
+            # exact gradient of the sum of squares from the analytic price derivatives, else finite differences
+            def obj(params):
+                f = 0.
+                g = np.zeros(len(params))
+                for res, dres in self.residuals(ctx, self.getHestonParams(params), objective, gradient=True):
+                    f += sum(res ** 2.)
+                    g += 2. * self.optimizerGradient(params, dres).dot(res)
+                if monitor is not None:
+                    monitor(f)
+                return f / scale, g / scale
+            jac = True
+            # squared pv errors are tiny in absolute terms, the gradient tolerances are not
+            scale = max(obj(x0)[0], 1.e-300)
+
+        errs = np.seterr(all='raise')
+        try:
+            res = opt.minimize(obj, x0, method=method, jac=jac)
+        finally:
+            np.seterr(**errs)
+        calibratedParams = self.getHestonParams(res.x)        
+        return calibratedParams, res.fun * scale
+
+    def calibrate_to_surface_trf(self, t, strikes, vols, iniParams, objective, vegaWeighted=True, monitor=None):
+        '''
+            least squares on the per-quote residuals in the natural parameter space within PARAM_BOUNDS;
+            PV residuals are divided by the market bs vegas unless vegaWeighted is False, VOL residuals
+            get the exact jacobian dvol = dpv / vega at the model vol. solved by scipy's bounded trust region
+            reflective least_squares, levenberg-marquardt does not take bounds
+        '''
+        self.iniParams = iniParams
+        ctx = self.context(t, strikes, vols)
+
+        def terms(x):
+            return self.residuals(ctx, self.getNaturalHestonParams(x), objective, vegaWeighted, gradient=True)
+
+        x, err = self.leastSquares(terms, iniParams, monitor)
+        return self.getNaturalHestonParams(x), err
+
+    def leastSquares(self, terms, iniParams, monitor=None):
+        '''
+            bounded least squares over the natural free parameters on the (residuals, derivatives) pairs of
+            terms(x); returns the solution and its sum of squares
+        '''
+        def evaluate(x):
+            pairs = terms(x)
+            res = np.concatenate([res for res, _ in pairs])
+            if monitor is not None:
+                monitor(sum(res ** 2.))
+            return res, np.vstack([self.optimizerGradient(x, dres, natural=True).T for _, dres in pairs])
+
+        # least_squares asks for residuals and jacobian separately at the same point
+        last = {}
+
+        def cached(x):
+            key = tuple(x)
+            if key not in last:
+                last.clear()
+                last[key] = evaluate(x)
+            return last[key]
+
+        names = [name for name in PARAM_NAMES if not iniParams[name]['fixed']]
+        lower = [PARAM_BOUNDS[name][0] for name in names]
+        upper = [PARAM_BOUNDS[name][1] for name in names]
+        x0 = np.clip(self.getNaturalIniParams(iniParams), lower, upper)
+
+        errs = np.seterr(all='raise')
+        try:
+            res = opt.least_squares(lambda x: cached(x)[0], x0, jac=lambda x: cached(x)[1],
+                                    bounds=(lower, upper), method='trf', x_scale='jac')
+        finally:
+            np.seterr(**errs)
+        return res.x, 2. * res.cost
+
+    def calibrate_to_surface_incremental(self, t, strikes, vols, iniParams, objective, vegaWeighted=True):
+        '''
+            least squares polish from iniParams, typically the previous solution, after the quotes of some
+            tenors have changed. tenors found in the tenor cache at iniParams enter the polish through their
+            first order expansion there, only the others are repriced on every step; the solution is then
+            priced exactly once and its tenors are cached for the next edit. without any cached tenor this
+            is calibrate_to_surface_trf
+        '''
+        self.iniParams = iniParams
+        ctx = self.context(t, strikes, vols)
+        x0 = self.getNaturalIniParams(iniParams)
+        p0 = self.getNaturalHestonParams(x0)
+        cached = [self.tenorCache.get(TenorResidualCache.key(ctx, i, objective, vegaWeighted, p0))
+                  for i in ctx.tenors()]
+        changed = [i for i in ctx.tenors() if cached[i] is None]
+        profile = profiling.current()
+        if profile is not None:
+            profile.count('cachedTenors', len(cached) - len(changed))
+
+        if not changed:
+            return p0, sum([sum(res ** 2.) for res, _ in cached])
+        if len(changed) == len(cached):
+            calibratedParams, _ = self.calibrate_to_surface_trf(t, strikes, vols, iniParams, objective, vegaWeighted)
+        else:
+            sub = self.context([ctx.t[i] for i in changed], [ctx.strikes[i] for i in changed],
+                               [ctx.vols[i] for i in changed])
+            z0 = np.array([getattr(p0, name) for name in PARAM_NAMES])
+
+            def terms(x):
+                params = self.getNaturalHestonParams(x)
+                dz = np.array([getattr(params, name) for name in PARAM_NAMES]) - z0
+                return self.residuals(sub, params, objective, vegaWeighted, gradient=True) \
+                    + [(res + dres.T.dot(dz), dres) for res, dres in filter(None, cached)]
+
+            x, _ = self.leastSquares(terms, iniParams)
+            calibratedParams = self.getNaturalHestonParams(x)
+
+        err = 0.
+        for i, (res, dres) in enumerate(self.residuals(ctx, calibratedParams, objective, vegaWeighted,
+                                                       gradient=True)):
+            self.tenorCache.put(TenorResidualCache.key(ctx, i, objective, vegaWeighted, calibratedParams),
+                                (res, dres))
+            err += sum(res ** 2.)
+        return calibratedParams, err
+
+    def calibrate_to_surface_surrogate(self, t, strikes, vols, iniParams, objective, vegaWeighted=True,
+                                       monitor=None):
+        '''
+            least squares of the surrogate vols against the quotes, with the free parameters bounded by the
+            surrogate's domain, then calibrate_to_surface_trf from there with the exact pricer, whose objective
+            values go to monitor
+        '''
+        if self.surrogate is None:
+            raise ValueError('method=\'surrogate\' needs a HestonCalibrator with a surrogate')
+        self.iniParams = iniParams
+        ctx = self.context(t, strikes, vols)
+        ttm = np.concatenate([np.full(len(ki), ti) for ti, ki in zip(ctx.t, ctx.strikes)])
+        logMoneyness = np.concatenate([np.log(ki / fwd) for ki, fwd in zip(ctx.strikes, ctx.fwd)])
+        marketVols = np.concatenate(ctx.vols)
+        profile = profiling.current()
+
+        def residuals(x):
+            if profile is not None:
+                profile.count('surrogateCalls')
+            p = self.getNaturalHestonParams(x)
+            return self.surrogate.impliedVols(ttm, logMoneyness, p.var0, p.kappa, p.theta, p.xi, p.rho) - marketVols
+
+        names = [name for name in PARAM_NAMES if not iniParams[name]['fixed']]
+        lower = [max(PARAM_BOUNDS[name][0], self.surrogate.bounds(name)[0]) for name in names]
+        upper = [min(PARAM_BOUNDS[name][1], self.surrogate.bounds(name)[1]) for name in names]
+        x0 = np.clip(self.getNaturalIniParams(iniParams), lower, upper)
+        res = opt.least_squares(residuals, x0, bounds=(lower, upper), method='trf', x_scale='jac')
+
+        surrogateParams = self.getNaturalHestonParams(res.x)
+        start = dict((name, {'value': getattr(surrogateParams, name), 'fixed': iniParams[name]['fixed']})
+                     for name in PARAM_NAMES)
+        calibratedParams, err = self.calibrate_to_surface_trf(t, strikes, vols, start, objective, vegaWeighted,
+                                                              monitor)
+        self.iniParams = iniParams
+        return calibratedParams, err
+
+    def calibrate_to_surface_de(self, t, strikes, vols, iniParams, objective, vegaWeighted=True, seed=None,
+                                popsize=15, maxiter=50, tol=0.01, polish=True):
+        '''
+            global search by differential evolution over the log/arctanh transforms of the free parameters
+            within PARAM_BOUNDS, on the same sum of squares as calibrate_to_surface_trf. every generation is
+            handed over as a whole and priced as one population per tenor with the 'cos' scheme (member by
+            member through residuals() for the other schemes). seed makes the search reproducible, polish
+            runs calibrate_to_surface_trf from the best member and keeps it if it improves
+        '''
+        self.iniParams = iniParams
+        ctx = self.context(t, strikes, vols)
+        # the cf cache is keyed by scalar parameters, the population gets its own pricers
+        popCtx = CalibrationContext(self.fxMarket, t, strikes, vols, self.integrationScheme) \
+            if self.integrationScheme == 'cos' else None
+
+        def obj(params):
+            err = np.seterr(all='ignore')
+            try:
+                f = sum([sum(res ** 2.) for res, _ in
+                         self.residuals(ctx, self.getHestonParams(params), objective, vegaWeighted)])
+            finally:
+                np.seterr(**err)
+            return f if np.isfinite(f) else np.inf
+
+        def population(func, X):
+            X = np.asarray(list(X))
+            if popCtx is None:
+                return [func(x) for x in X]
+            profile = profiling.current()
+            if profile is not None:
+                profile.count('objectiveCalls', len(X))
+                profile.count('populationCalls')
+            err = np.seterr(all='ignore')
+            try:
+                with profiling.timer('objective'):
+                    popCtx.setParams(self.getHestonParams(X.T[:, :, np.newaxis]))
+                    f = sum([np.sum(popCtx.residuals(i, objective, vegaWeighted)[0] ** 2., axis=-1)
+                             for i in popCtx.tenors()])
+            finally:
+                np.seterr(**err)
+            return np.where(np.isfinite(f), f, np.inf)
+
+        bounds = []
+        for name in PARAM_NAMES:
+            if not iniParams[name]['fixed']:
+                lower, upper = PARAM_BOUNDS[name]
+                bounds.append((np.arctanh(lower), np.arctanh(upper)) if name == 'rho'
+                              else (np.log(lower), np.log(upper)))
+
+        res = opt.differential_evolution(obj, bounds, maxiter=maxiter, popsize=popsize, tol=tol, seed=seed,
+                                         polish=False, updating='deferred', workers=population)
+        calibratedParams, err = self.getHestonParams(res.x), res.fun
+        if polish:
+            polishParams = {name: {'value': getattr(calibratedParams, name), 'fixed': iniParams[name]['fixed']}
+                            for name in PARAM_NAMES}
+            try:
+                params, polishErr = self.calibrate_to_surface_trf(t, strikes, vols, polishParams, objective,
+                                                                 vegaWeighted)
+                if polishErr < err:
+                    calibratedParams, err = params, polishErr
+            except FloatingPointError:
+                pass
+            self.iniParams = iniParams
+        return calibratedParams, err
+
+    def calibrate_to_surface_multistart(self, t, strikes, vols, iniParams, method, objective, vegaWeighted=True,
+                                        nStarts=8, seed=None, max_workers=None, abortAfter=50, abortRatio=10.):
+        '''
+            local calibrations by method from iniParams and from nStarts - 1 further starts, a latin hypercube in
+            the log/arctanh transforms of START_BOUNDS (fixed parameters stay fixed). the runs go to a process
+            pool of max_workers (the number of cpus if None, in-process if 1), at most one per start, and share
+            the best objective value seen so far: a run whose best value is still more than abortRatio times the
+            shared one after abortAfter evaluations is abandoned. which runs abort depends on their timing, so
+            only the serial mode is reproducible. returns the best params, its objective value and per-start
+            diagnostics
+        '''
+        names = [name for name in PARAM_NAMES if not iniParams[name]['fixed']]
+        rng = np.random.RandomState(seed)
+        n = nStarts - 1
+        # one stratum per start in every dimension, the strata paired at random
+        u = (np.array([rng.permutation(n) for _ in names]).T + rng.uniform(size=(n, len(names)))) / n
+        starts = [iniParams]
+        for ui in u:
+            start = {name: dict(iniParams[name]) for name in PARAM_NAMES}
+            for name, uij in zip(names, ui):
+                lower, upper = START_BOUNDS[name]
+                if name == 'rho':
+                    start[name]['value'] = np.tanh(np.arctanh(lower) + uij * (np.arctanh(upper) - np.arctanh(lower)))
+                else:
+                    start[name]['value'] = lower * (upper / lower) ** uij
+            starts.append(start)
+
+        best = multiprocessing.Value('d', np.inf)
+        tasks = [(i, start, t, strikes, vols, method, objective, vegaWeighted, abortAfter, abortRatio)
+                 for i, start in enumerate(starts)]
+        if max_workers == 1:
+            diagnostics = [_runStart(self, best, task) for task in tasks]
         else:
-            def obj(params): return sum([sum((self.impl_vol(ti, ki, params) - vi) ** 2.)
-                                     for ti, ki, vi in zip(t, strikes, vols)])
+            pool = multiprocessing.Pool(min(max_workers or multiprocessing.cpu_count(), len(tasks)), _initStartWorker,
+                                        (self.fxMarket, self.integrationScheme, self.surrogate, best))
+            try:
+                diagnostics = pool.map(_calibrateFromStart, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        self.iniParams = iniParams
 
-        errs = np.geterr()
-        np.seterr(all='raise')
-        res = opt.minimize(obj, self.getIniParams(iniParams), method=method)
-        np.seterr(**errs)
-        calibratedParams = self.getHestonParams(res.x)        
-        return calibratedParams, res.fun
+        finished = [d for d in diagnostics if d['status'] == 'finished']
+        if not finished:
+            raise ValueError('none of the {} starts finished: {}'.format(
+                len(starts), '; '.join(d['message'] for d in diagnostics)))
+        winner = min(finished, key=lambda d: d['objectiveValue'])
+        return winner['hestonParams'], winner['objectiveValue'], diagnostics
 
     def calibrate_to_surface_mc(self, t, strikes, vols, iniParams, nGen=300):
         self.iniParams = iniParams
+        ctx = self.context(t, strikes, vols)
 
-        def obj(params): return sum([sum((self.impl_vol(ti, ki, params) - vi) ** 2.)
-                                     for ti, ki, vi in zip(t, strikes, vols)])
+        def obj(params):
+            return sum([sum(res ** 2.) for res, _ in self.residuals(ctx, self.getHestonParams(params), 'VOL')])
 
         optParams = p0 = self.getIniParams(iniParams)
         optObj = obj(optParams)
@@ -257,16 +876,47 @@ class HestonCalibrator:
         market = HestonMarket(self.fxMarket.dfDomCurve,
                               self.fxMarket.dfForCurve,
                               self.fxMarket.fwdCurve,
-                              self.getHestonParams(params))
-        return np.array([market.impl_vol(t, k) for k in strikes])
+                              self.getHestonParams(params),
+                              self.integrationScheme,
+                              self.cfCache)
+        return market.impl_vol(t, np.asarray(strikes, dtype=float))
 
     def pvs(self, t, strikes, params):
         market = HestonMarket(self.fxMarket.dfDomCurve,
                               self.fxMarket.dfForCurve,
                               self.fxMarket.fwdCurve,
-                              self.getHestonParams(params))
+                              self.getHestonParams(params),
+                              self.integrationScheme,
+                              self.cfCache)
         fwd = self.fxMarket.fwdCurve.fwd(t)
-        return np.array([market.vanilla(t, k, np.sign(k - fwd)) for k in strikes])
+        strikes = np.asarray(strikes, dtype=float)
+        return market.vanilla(t, strikes, np.sign(strikes - fwd))
+
+    def pvs_gradient(self, t, strikes, params, natural=False):
+        '''
+            otm pvs and their derivatives w.r.t. the optimizer parameters, shape (len(params), len(strikes));
+            natural=True takes the free parameters themselves instead of their log/arctanh transforms
+        '''
+        market = HestonMarket(self.fxMarket.dfDomCurve,
+                              self.fxMarket.dfForCurve,
+                              self.fxMarket.fwdCurve,
+                              self.getNaturalHestonParams(params) if natural else self.getHestonParams(params),
+                              self.integrationScheme,
+                              self.cfCache)
+        fwd = self.fxMarket.fwdCurve.fwd(t)
+        strikes = np.asarray(strikes, dtype=float)
+        pv, dpv = market.vanilla_gradient(t, strikes, np.where(strikes > fwd, 1., -1.))
+        return pv, self.optimizerGradient(params, dpv, natural)
+
+    def optimizerGradient(self, params, dpv, natural=False):
+        '''
+            rows of the free parameters out of derivatives w.r.t. heston.GRADIENT_PARAMS,
+            chained through the log/arctanh transforms unless natural
+        '''
+        idx, dx = self.getHestonParamsDerivatives(params)
+        if natural:
+            return dpv[idx]
+        return dpv[idx] * np.reshape(dx, (-1, 1))
 
     def getIniParams(self, params):
         iniParams = []
@@ -318,6 +968,35 @@ class HestonCalibrator:
         )
         return hestonParams
 
+    def getNaturalIniParams(self, params):
+        return [params[name]['value'] for name in PARAM_NAMES if not params[name]['fixed']]
+
+    def getNaturalHestonParams(self, params):
+        values = []
+        idx = 0
+        for name in PARAM_NAMES:
+            if self.iniParams[name]['fixed']:
+                values.append(self.iniParams[name]['value'])
+            else:
+                values.append(params[idx])
+                idx += 1
+        return HestonParams(*values)
+
+    def getHestonParamsDerivatives(self, params):
+        '''
+            rows of heston.GRADIENT_PARAMS for the free parameters and the derivatives
+            of their transforms in getHestonParams
+        '''
+        idx = []
+        dx = []
+        for i, name in enumerate(PARAM_NAMES):
+            if self.iniParams[name]['fixed']:
+                continue
+            p = params[len(idx)]
+            idx.append(i)
+            dx.append(1. - np.tanh(p) ** 2. if name == 'rho' else np.exp(p))
+        return idx, np.array(dx)
+
 
 class DeltaType:
     Spot = 0.
@@ -330,45 +1009,62 @@ class PremiumType:
 
 
 class QuoteHelper:
+    '''
+        strikes of delta quoted bs vols. ttm, delta and vol (and the delta type) may be arrays, e.g. of all the
+        pillars of a surface, which are then converted at once
+    '''
 
     def __init__(self, fxMarket, deltaType, premiumType):
         self.fxMarket = fxMarket
         self.deltaType = deltaType
         self.premiumType = premiumType
 
+    def deltaFactor(self, ttm):
+        # spot deltas are forward deltas discounted by the foreign curve
+        return np.where(np.asarray(self.deltaType) == DeltaType.Forward, 1., self.fxMarket.dfForCurve.df(ttm))
+
     def atmStrike(self, ttm, atmVol):
         fwd = self.fxMarket.fwdCurve.fwd(ttm)
         return fwd * np.exp(-self.premiumType * atmVol ** 2. * ttm / 2.)
 
-    def strikeForDelta(self, ttm, delta, vol):
+    def strikeForDelta(self, ttm, delta, vol, tol=1.e-12, maxIter=50):
+        '''
+            in closed form for premium excluded deltas, else by newton on x = ln(K/F) from the atm strike with
+            the analytic derivative of the delta, for all the quotes at once
+        '''
+        ttm, delta, vol = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in (ttm, delta, vol)])
         fwd = self.fxMarket.fwdCurve.fwd(ttm)
-        deltaFwd = delta if self.deltaType == DeltaType.Forward \
-            else delta / self.fxMarket.dfForCurve.df(ttm)
+        deltaFwd = delta / self.deltaFactor(ttm)
+        callput = np.sign(delta)
+        std = vol * np.sqrt(ttm)
 
         if self.premiumType == PremiumType.Excluded:
-            std = vol * np.sqrt(ttm)
-            q = st.norm.ppf(np.abs(deltaFwd))
-            return fwd * np.exp(std * (std / 2. - np.sign(delta) * q))
-        else:
-            callput = np.sign(delta)
-
-            def obj(k): return delta - self.deltaBS(callput, ttm, k, vol)
-
-            strike = opt.newton(obj, self.atmStrike(ttm, vol))
-            return strike
+            strike = fwd * np.exp(std * (std / 2. - callput * sps.ndtri(np.abs(deltaFwd))))
+            return strike if strike.ndim > 0 else strike[()]
+
+        # delta(x) = callput * e^x * N(callput * d), d = -x / std - std / 2, is decreasing in the call
+        # strike only beyond its maximum, which the atm start is
+        x = -std ** 2. / 2.
+        for _ in xrange(maxIter):
+            d = -x / std - std / 2.
+            value = callput * np.exp(x) * sps.ndtr(callput * d)
+            step = (value - deltaFwd) / (value - np.exp(x - d ** 2. / 2.) / (np.sqrt(2. * np.pi) * std))
+            x = x - step
+            if np.max(np.abs(step)) < tol:
+                break
+        strike = fwd * np.exp(x)
+        return strike if strike.ndim > 0 else strike[()]
 
     def deltaBS(self, callput, ttm, strike, vol):
-        deltaFactor = 1. if self.deltaType == DeltaType.Forward \
-            else self.fxMarket.dfForCurve.df(ttm)
-
         fwd = self.fxMarket.fwdCurve.fwd(ttm)
         std = vol * np.sqrt(ttm)
         d = np.log(fwd / strike) / std + std / 2.
-        if self.premiumType:
-            d -= std
-            deltaFactor *= strike / fwd
+        deltaFactor = self.deltaFactor(ttm)
+        if self.premiumType == PremiumType.Included:
+            d = d - std
+            deltaFactor = deltaFactor * strike / fwd
 
-        return callput * deltaFactor * st.norm.cdf(callput * d)
+        return callput * deltaFactor * sps.ndtr(callput * d)
 
 
 def testAtmStructure():
@@ -0,0 +1,548 @@
+'''
+    monte carlo pricing of path dependent payoffs in the heston (and black scholes) model:
+
+        mc = HestonMC(params, seed=1)
+        pv, stderr = mc.price(Barrier(strike, ttm, barrier, up=True), 2 ** 20)
+        pv, stderr = mc.priceRQMC(Asian(strike, fixings), 2 ** 14)
+
+    the paths are simulated in chunks of at most chunkSize paths, every chunk from its own random stream
+    keyed by (seed, chunk index). a payoff only keeps its running state per path (the running average,
+    whether the barrier was hit, ...) while the chunk is stepped through time, and the chunk is reduced to
+    the mean and comoments of the discounted payoffs, so the path matrix is never stored.
+
+    with workers > 1 the chunks are simulated in a process pool and their moments merged in the order of the
+    chunks, so the result does not depend on the number of workers. with a tolerance the simulation stops
+    at the first chunk where the confidence interval is narrower.
+
+    the normals come from a generator: pseudo random by default, or the brownian bridges of scrambled sobol
+    points (SobolBridge), the path i of a run the i-th point of the sequence in any chunk
+'''
+import copy
+import multiprocessing
+import os
+
+import numpy as np
+import scipy.special as sps
+
+import heston
+import profiling
+
+
+class PseudoRandom:
+    '''
+        independent standard normals, a stream per chunk, so that the paths of a chunk do not depend on the
+        order (or the process) in which the chunks are simulated: a RandomState seeded by (seed, chunk)
+    '''
+
+    def __init__(self, seed=0):
+        self.seed = seed
+
+    def normals(self, chunk, first, grid, nFactors, n):
+        '''
+            draws of shape (steps of grid, nFactors, n) of the chunk of paths first, ..., first + n - 1
+        '''
+        return np.random.RandomState([self.seed, chunk]).standard_normal((len(grid) - 1, nFactors, n))
+
+
+class BrownianBridge:
+    '''
+        standard brownian motion on the grid from normals: the first for the last time, the next ones for the
+        midpoints of ever finer intervals, so that the first coordinates of a low discrepancy sequence set
+        the coarse shape of the paths
+    '''
+
+    def __init__(self, grid):
+        t = np.asarray(grid, dtype=float)
+        self.sqrtDt = np.sqrt(np.diff(t))
+        self.std = np.sqrt(t[-1] - t[0])
+        # (point, left, right, weight of left, weight of right, std) in the order of the normals
+        self.plan = []
+        intervals = [(0, len(t) - 1)]
+        while intervals:
+            left, right = intervals.pop(0)
+            if right - left < 2:
+                continue
+            mid = (left + right) // 2
+            width = t[right] - t[left]
+            self.plan.append((mid, left, right, (t[right] - t[mid]) / width, (t[mid] - t[left]) / width,
+                              np.sqrt((t[mid] - t[left]) * (t[right] - t[mid]) / width)))
+            intervals += [(left, mid), (mid, right)]
+
+    def increments(self, z):
+        '''
+            (W(t[k + 1]) - W(t[k])) / sqrt(t[k + 1] - t[k]), independent standard normals again, from the
+            normals z of shape (steps, ...)
+        '''
+        w = np.zeros((len(z) + 1,) + z.shape[1:])
+        w[-1] = self.std * z[0]
+        for i, (mid, left, right, weightLeft, weightRight, std) in enumerate(self.plan, 1):
+            w[mid] = weightLeft * w[left] + weightRight * w[right] + std * z[i]
+        return np.diff(w, axis=0) / self.sqrtDt.reshape((-1,) + (1,) * (z.ndim - 1))
+
+
+# primitive polynomials and initial direction numbers of joe and kuo (2008), new-joe-kuo-6 for dimensions
+# 2, ..., 1024 as (degree, inner coefficients, m_1, ..., m_degree), read when first used
+DIRECTIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'new-joe-kuo-6.1024')
+_directions = []
+
+
+def directionNumbers(dim, bits):
+    '''
+        direction numbers of the first dim dimensions as integers of bits digits, shape (dim, bits)
+    '''
+    if not _directions:
+        with open(DIRECTIONS_PATH) as lines:
+            next(lines)
+            for line in lines:
+                values = [int(x) for x in line.split()]
+                _directions.append((values[1], values[2], values[3:]))
+    if dim > len(_directions) + 1:
+        raise ValueError('sobol points in at most {} dimensions'.format(len(_directions) + 1))
+
+    v = np.zeros((dim, bits), dtype=np.uint64)
+    # the first dimension is van der corput's
+    v[0] = [1 << (bits - k - 1) for k in xrange(bits)]
+    for d, (s, a, m) in enumerate(_directions[:dim - 1], 1):
+        vd = [mk << (bits - k - 1) for k, mk in enumerate(m[:bits])]
+        for k in xrange(s, bits):
+            x = vd[k - s] ^ (vd[k - s] >> s)
+            for j in xrange(1, s):
+                if (a >> (s - 1 - j)) & 1:
+                    x ^= vd[k - j]
+            vd.append(x)
+        v[d] = vd
+    return v
+
+
+def _parity(x):
+    for shift in [32, 16, 8, 4, 2, 1]:
+        x = x ^ (x >> np.uint64(shift))
+    return x & np.uint64(1)
+
+
+class Sobol:
+    '''
+        sobol points in dim dimensions in gray code order, the point i computed from i alone. with a seed the
+        digits of every coordinate are scrambled by a random lower triangular matrix with unit diagonal and a
+        random digital shift (matousek's linear scrambling), which keeps the net properties of the points
+    '''
+    bits = 32
+
+    def __init__(self, dim, seed=None):
+        self.dim = dim
+        v = directionNumbers(dim, self.bits)
+        self.shift = np.zeros(dim, dtype=np.uint64)
+        if seed is not None:
+            rng = np.random.RandomState(seed)
+            # row r of the matrix: the diagonal digit and random digits left of it
+            rows = rng.randint(0, 2 ** self.bits, (self.bits, dim, 1)).astype(np.uint64)
+            scrambled = np.zeros_like(v)
+            for r in xrange(self.bits):
+                digit = np.uint64(1 << (self.bits - r - 1))
+                row = rows[r] & ~(digit - np.uint64(1)) | digit
+                scrambled |= _parity(v & row) * digit
+            v = scrambled
+            self.shift = rng.randint(0, 2 ** self.bits, dim).astype(np.uint64)
+        self.v = v
+
+    def points(self, first, n):
+        '''
+            the points first, ..., first + n - 1 in (0, 1), shape (n, dim)
+        '''
+        if first + n > 2 ** self.bits:
+            raise ValueError('sobol points beyond index 2 ** {}'.format(self.bits))
+        i = np.arange(first, first + n, dtype=np.uint64)
+        gray = i ^ (i >> np.uint64(1))
+        x = np.tile(self.shift, (n, 1))
+        for k in xrange(int(first + n - 1).bit_length()):
+            x ^= ((gray >> np.uint64(k)) & np.uint64(1))[:, np.newaxis] * self.v[:, k]
+        # the centers of the cells of 2 ** -bits, never 0 or 1
+        return (x.astype(float) + 0.5) / 2. ** self.bits
+
+
+class SobolBridge:
+    '''
+        normals from the points of the scrambled sobol sequence of the seed through brownian bridges of every
+        factor: the coordinates of a point go to the bridges level by level, factor by factor
+    '''
+
+    def __init__(self, seed=0):
+        self.seed = seed
+
+    def normals(self, chunk, first, grid, nFactors, n):
+        nSteps = len(grid) - 1
+        # the same scrambling in every chunk
+        u = Sobol(nSteps * nFactors, self.seed).points(first, n)
+        z = sps.ndtri(u).reshape((n, nSteps, nFactors)).transpose((1, 2, 0))
+        return BrownianBridge(grid).increments(z)
+
+
+class Vanilla:
+    '''
+        european call (callput=1) or put (callput=-1)
+    '''
+
+    def __init__(self, strike, ttm, callput=1.):
+        self.strike = strike
+        self.ttm = ttm
+        self.callput = callput
+        self.times = [ttm]
+
+    def start(self, n):
+        return None
+
+    def observe(self, state, i, spot):
+        return spot
+
+    def values(self, state):
+        return np.maximum(self.callput * (state - self.strike), 0.)
+
+
+class Asian:
+    '''
+        arithmetic average rate call or put on the fixings, paid at the last one
+    '''
+
+    def __init__(self, strike, fixings, callput=1.):
+        self.strike = strike
+        self.times = sorted(fixings)
+        self.ttm = self.times[-1]
+        self.callput = callput
+
+    def start(self, n):
+        return np.zeros(n)
+
+    def observe(self, state, i, spot):
+        return state + spot
+
+    def values(self, state):
+        return np.maximum(self.callput * (state / len(self.times) - self.strike), 0.)
+
+
+class Barrier:
+    '''
+        knock-out (or knock-in) call or put, the barrier monitored at the monitoring times (daily by default)
+        and at maturity; up for a barrier above spot
+    '''
+
+    def __init__(self, strike, ttm, barrier, up=True, knockIn=False, callput=1., monitoring=None):
+        self.strike = strike
+        self.ttm = ttm
+        self.barrier = barrier
+        self.up = up
+        self.knockIn = knockIn
+        self.callput = callput
+        if monitoring is None:
+            monitoring = np.arange(1, int(np.ceil(ttm * 252. - 1.e-9))) / 252.
+        self.times = sorted(set(t for t in monitoring if 0. < t < ttm)) + [ttm]
+
+    def start(self, n):
+        return np.zeros(n, dtype=bool), None
+
+    def observe(self, state, i, spot):
+        hit = state[0] | (spot >= self.barrier if self.up else spot <= self.barrier)
+        return hit, spot
+
+    def values(self, state):
+        hit, spot = state
+        payoff = np.maximum(self.callput * (spot - self.strike), 0.)
+        return np.where(hit == self.knockIn, payoff, 0.)
+
+
+class Moments:
+    '''
+        count, means and comoment matrix of the samples of several payoffs, merged chunk by chunk
+        (chan et al.) so that large samples lose no precision
+    '''
+
+    def __init__(self, k):
+        self.n = 0
+        self.mean = np.zeros(k)
+        self.comoment = np.zeros((k, k))
+
+    @staticmethod
+    def of(samples):
+        '''
+            moments of samples of shape (k, n)
+        '''
+        moments = Moments(len(samples))
+        moments.n = samples.shape[1]
+        moments.mean = samples.mean(axis=1)
+        centered = samples - moments.mean[:, np.newaxis]
+        moments.comoment = centered.dot(centered.T)
+        return moments
+
+    def merge(self, other):
+        n = self.n + other.n
+        if n == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.n / n
+        self.comoment = self.comoment + other.comoment + np.outer(delta, delta) * self.n * other.n / n
+        self.n = n
+        return self
+
+    def covariance(self):
+        return self.comoment / max(self.n - 1, 1)
+
+
+# state of a worker: the engine and payoffs of the pool
+_workerMC = None
+_workerPayoffs = None
+
+
+def _initWorker(mc, payoffs):
+    global _workerMC, _workerPayoffs
+    _workerMC = mc
+    _workerPayoffs = payoffs
+
+
+def _simulateChunk(task):
+    chunk, n = task
+    return Moments.of(_workerMC.simulate(_workerPayoffs, chunk, n))
+
+
+class PathMC:
+    '''
+        simulation of payoffs in a model of nFactors normals per path and step, given by start(n) the state of
+        n paths at 0, step(state, dt, z) the state after dt, spot(state) and analytic() its vanilla pricer.
+        the time steps are at most dt and include all the observation times of the payoffs. with antithetic,
+        every chunk is half drawn and half mirrored, and a sample is the average of a pair
+    '''
+    nFactors = 1
+
+    def __init__(self, params, dt, chunkSize, antithetic, seed, generator):
+        self.m = params
+        self.dt = dt
+        self.chunkSize = chunkSize
+        self.antithetic = antithetic
+        self.seed = seed
+        self.generator = PseudoRandom(seed) if generator is None else generator
+
+    def grid(self, times):
+        '''
+            simulation times: 0, the observation times and equal steps of at most dt in between
+        '''
+        grid = [0.]
+        for t in sorted(set(times)):
+            t0 = grid[-1]
+            n = max(int(np.ceil((t - t0) / self.dt - 1.e-9)), 1)
+            grid.extend(t0 + (t - t0) * np.arange(1, n + 1) / float(n))
+            grid[-1] = t
+        return np.array(grid)
+
+    def simulate(self, payoffs, chunk, n):
+        '''
+            samples of the discounted payoffs on the n paths of the chunk, of shape (len(payoffs), n)
+            (n / 2 averaged pairs with antithetic)
+        '''
+        m = self.m
+        grid = self.grid([t for payoff in payoffs for t in payoff.times])
+        index = dict((t, i) for i, t in enumerate(grid))
+        observations = [[] for _ in grid]
+        for j, payoff in enumerate(payoffs):
+            for i, t in enumerate(payoff.times):
+                observations[index[t]].append((j, i))
+
+        nDraws = n // 2 if self.antithetic else n
+        first = chunk * (self.chunkPaths() // 2 if self.antithetic else self.chunkPaths())
+        z = self.generator.normals(chunk, first, grid, self.nFactors, nDraws)
+        if self.antithetic:
+            n = 2 * nDraws
+        states = [payoff.start(n) for payoff in payoffs]
+        state = self.start(n)
+        for k in xrange(1, len(grid)):
+            zk = np.concatenate((z[k - 1], -z[k - 1]), axis=1) if self.antithetic else z[k - 1]
+            state = self.step(state, grid[k] - grid[k - 1], zk)
+            if observations[k]:
+                spot = self.spot(state)
+                for j, i in observations[k]:
+                    states[j] = payoffs[j].observe(states[j], i, spot)
+
+        samples = np.array([np.exp(-m.r * payoff.ttm) * payoff.values(state)
+                            for payoff, state in zip(payoffs, states)])
+        if self.antithetic:
+            samples = 0.5 * (samples[:, :nDraws] + samples[:, nDraws:])
+        profile = profiling.current()
+        if profile is not None:
+            profile.count('mcPaths', n)
+            profile.count('mcSteps', n * (len(grid) - 1))
+        return samples
+
+    def chunkPaths(self):
+        return self.chunkSize - self.chunkSize % 2 if self.antithetic else self.chunkSize
+
+    def chunks(self, nPaths):
+        '''
+            (chunk, paths) of nPaths paths in chunks of at most chunkSize
+        '''
+        size = self.chunkPaths()
+        nChunks = int(np.ceil(nPaths / float(size)))
+        return [(c, min(size, nPaths - c * size)) for c in xrange(nChunks)]
+
+    def moments(self, payoffs, nPaths, workers=1, stop=None):
+        '''
+            moments of the samples of nPaths paths, simulated by workers processes (all cpus for None);
+            stop(moments) is asked after every chunk whether the samples so far are enough
+        '''
+        chunks = self.chunks(nPaths)
+        pool = None
+        if workers == 1 or len(chunks) == 1:
+            chunkMoments = (Moments.of(self.simulate(payoffs, chunk, n)) for chunk, n in chunks)
+        else:
+            pool = multiprocessing.Pool(workers, _initWorker, (self, payoffs))
+            chunkMoments = pool.imap(_simulateChunk, chunks, chunksize=1)
+        moments = Moments(len(payoffs))
+        try:
+            for m in chunkMoments:
+                if moments.merge(m).n > 1 and stop is not None and stop(moments):
+                    break
+        finally:
+            if pool is not None:
+                # the chunks simulated ahead of an early stop are dropped
+                pool.terminate()
+                pool.join()
+        return moments
+
+    def controlVariate(self, payoff):
+        '''
+            the vanilla of the strike, maturity and callput of payoff and its analytic price, None if payoff
+            has no strike
+        '''
+        if not hasattr(payoff, 'strike') or isinstance(payoff, Vanilla):
+            return None
+        vanilla = Vanilla(payoff.strike, payoff.ttm, payoff.callput)
+        return vanilla, self.analytic().vanilla(payoff.strike, payoff.ttm, payoff.callput)
+
+    def price(self, payoff, nPaths, controlVariate=True, workers=1, tolerance=None, confidence=0.95):
+        '''
+            present value and its standard error; with controlVariate the vanilla of the same strike is
+            simulated on the same paths and its error to the analytic price is regressed out. nPaths is the
+            most paths simulated with a tolerance, the half width of the confidence interval to reach
+        '''
+        cv = self.controlVariate(payoff) if controlVariate else None
+        payoffs = [payoff] if cv is None else [payoff, cv[0]]
+        exact = None if cv is None else cv[1]
+        stop = None
+        if tolerance is not None:
+            z = sps.ndtri(0.5 + 0.5 * confidence)
+            stop = lambda moments: z * self.estimate(moments, exact)[1] <= tolerance
+        with profiling.timer('mc'):
+            moments = self.moments(payoffs, nPaths, workers, stop)
+        return self.estimate(moments, exact)
+
+    def priceRQMC(self, payoff, nPaths, scrambles=8, controlVariate=True, workers=1):
+        '''
+            randomized quasi monte carlo: the mean of the prices on nPaths sobol paths of scrambles independent
+            scramblings, and its standard error from their spread (the standard errors of the single runs do
+            not hold for low discrepancy points)
+        '''
+        pvs = []
+        for i in xrange(scrambles):
+            mc = copy.copy(self)
+            mc.generator = SobolBridge([self.seed, i])
+            pvs.append(mc.price(payoff, nPaths, controlVariate, workers)[0])
+        return np.mean(pvs), np.std(pvs, ddof=1) / np.sqrt(scrambles)
+
+    @staticmethod
+    def estimate(moments, exact=None):
+        '''
+            mean of the first payoff and its standard error, adjusted by the second one of known mean exact
+        '''
+        cov = moments.covariance()
+        if exact is None or cov[1, 1] <= 0.:
+            return moments.mean[0], np.sqrt(cov[0, 0] / moments.n)
+        beta = cov[0, 1] / cov[1, 1]
+        variance = max(cov[0, 0] - beta * cov[0, 1], 0.)
+        return moments.mean[0] - beta * (moments.mean[1] - exact), np.sqrt(variance / moments.n)
+
+
+class HestonMC(PathMC):
+    '''
+        variance by the quadratic-exponential scheme of andersen (2008), ln(spot) by its trapezoidal
+        discretization with the martingale correction, so that the simulated forward is exact. the factors are
+        the normals of the variance and of the part of ln(spot) independent of it
+    '''
+    nFactors = 2
+
+    def __init__(self, params, dt=1. / 52, chunkSize=2 ** 14, antithetic=True, seed=0, generator=None,
+                 psiC=1.5):
+        PathMC.__init__(self, params, dt, chunkSize, antithetic, seed, generator)
+        self.psiC = psiC
+
+    def analytic(self):
+        return heston.HestonLord(self.m)
+
+    def start(self, n):
+        return np.full(n, np.log(self.m.s0)), np.full(n, self.m.v0)
+
+    def spot(self, state):
+        return np.exp(state[0])
+
+    def step(self, state, dt, z):
+        '''
+            ln(spot) and variance after dt, given the normals z of the variance and of the spot
+        '''
+        m = self.m
+        x, v = state
+        zv, zx = z
+        e = np.exp(-m.kappa * dt)
+        mean = m.theta + (v - m.theta) * e
+        s2 = v * m.xi ** 2 * e / m.kappa * (1. - e) + m.theta * m.xi ** 2 / (2. * m.kappa) * (1. - e) ** 2
+        psi = s2 / mean ** 2
+
+        # gamma1 = gamma2 = 1/2
+        k0 = -m.rho * m.kappa * m.theta / m.xi * dt
+        k1 = 0.5 * dt * (m.kappa * m.rho / m.xi - 0.5) - m.rho / m.xi
+        k2 = 0.5 * dt * (m.kappa * m.rho / m.xi - 0.5) + m.rho / m.xi
+        k3 = 0.5 * dt * (1. - m.rho ** 2)
+        A = k2 + 0.5 * k3
+        drift = (k1 + 0.5 * k3) * v
+
+        # quadratic branch, psi capped at psiC for the paths of the exponential one
+        with np.errstate(divide='ignore', invalid='ignore'):
+            psiQ = np.minimum(psi, self.psiC)
+            b2 = 2. / psiQ - 1. + np.sqrt(2. / psiQ) * np.sqrt(2. / psiQ - 1.)
+            a = mean / (1. + b2)
+            vNext = a * (np.sqrt(b2) + zv) ** 2
+            # the martingale correction exists for 2 A a < 1, otherwise the plain drift is kept
+            k0Star = np.where(2. * A * a < 1., -A * b2 * a / (1. - 2. * A * a) + 0.5 * np.log(1. - 2. * A * a) - drift,
+                              k0)
+
+        exponential = np.flatnonzero(psi > self.psiC)
+        if len(exponential):
+            psiE = psi[exponential]
+            p = (psiE - 1.) / (psiE + 1.)
+            beta = (1. - p) / mean[exponential]
+            # 1 - u of u = N(zv), accurate in the tail
+            oneMinusU = sps.ndtr(-zv[exponential])
+            with np.errstate(divide='ignore'):
+                vNext[exponential] = np.where(oneMinusU >= 1. - p, 0., np.log((1. - p) / oneMinusU) / beta)
+                k0Star[exponential] = np.where(A < beta, -np.log(p + beta * (1. - p) / (beta - A)) - drift[exponential],
+                                               k0)
+
+        xNext = x + (m.r - m.q) * dt + k0Star + k1 * v + k2 * vNext + np.sqrt(k3 * (v + vNext)) * zx
+        return xNext, vNext
+
+
+class BSMC(PathMC):
+    '''
+        black scholes paths (heston.BSParams), exact on any grid: by default the steps are only the
+        observation times
+    '''
+
+    def __init__(self, params, dt=np.inf, chunkSize=2 ** 14, antithetic=True, seed=0, generator=None):
+        PathMC.__init__(self, params, dt, chunkSize, antithetic, seed, generator)
+
+    def analytic(self):
+        return heston.BS(self.m)
+
+    def start(self, n):
+        return np.full(n, np.log(self.m.s0))
+
+    def spot(self, state):
+        return np.exp(state)
+
+    def step(self, state, dt, z):
+        m = self.m
+        return state + (m.r - m.q - 0.5 * m.vol ** 2) * dt + m.vol * np.sqrt(dt) * z[0]
@@ -0,0 +1,286 @@
+'''
+    finite differences of the heston pde in (spot, variance) by the alternating direction implicit scheme
+    of hundsdorfer and verwer, on grids dense around spot and small variances (in 't hout and foulon, 2010):
+
+        pde = HestonADI(params)
+        pvs = pde.price(strikes, ttms, callput=-1., american=True)
+
+    the strikes are solved together, as columns of the same tridiagonal systems, and with flat rates the
+    tenors are read off a single march in time to maturity, so a grid of options costs about one of them.
+    the tridiagonal systems of all variance (spot) levels are solved at once as one block diagonal banded
+    system by scipy.linalg.solve_banded; the operators are assembled once per grid and their banded
+    systems once per time step and rates (the last few of them with rates from curves)
+'''
+from collections import OrderedDict
+
+import numpy as np
+import scipy.interpolate as spint
+import scipy.linalg as sla
+
+import heston
+import profiling
+
+
+def sinhGrid(lower, upper, center, n, c):
+    '''
+        n + 1 points from lower to upper, dense within about c of center
+    '''
+    xi = np.linspace(np.arcsinh((lower - center) / c), np.arcsinh((upper - center) / c), n + 1)
+    x = center + c * np.sinh(xi)
+    x[0], x[-1] = lower, upper
+    return x
+
+
+def derivativeWeights(x):
+    '''
+        weights of the (left, center, right) neighbours of the central first and second derivatives on the
+        non uniform grid x, of shape (3, len(x)), zero at both ends
+    '''
+    h = np.diff(x)
+    hl, hr = h[:-1], h[1:]
+    first = np.zeros((3, len(x)))
+    second = np.zeros((3, len(x)))
+    first[:, 1:-1] = [-hr / (hl * (hl + hr)), (hr - hl) / (hl * hr), hl / (hr * (hl + hr))]
+    second[:, 1:-1] = [2. / (hl * (hl + hr)), -2. / (hl * hr), 2. / (hr * (hl + hr))]
+    return first, second
+
+
+class ADIOperators:
+    '''
+        the heston operator on the grid s x v split into A0 (mixed derivative), A1 (spot) and A2 (variance),
+        the discounting shared by A1 and A2. a tridiagonal operator is kept as the coefficients of shape
+        (3, nS, nV) of the left, center and right neighbour; A1 depends on the rates only through its
+        convection, which is kept apart. boundaries: nothing needed at s = 0 and v = 0 where the pde
+        degenerates (with a forward difference in v), u_ss = 0 at the top of the spot grid, u_v = 0 at the
+        top of the variance grid, and u = 0 at a knock-out barrier, at the top (up) or bottom of the spot grid
+    '''
+
+    def __init__(self, params, s, v, barrier=None, up=True, maxsize=8):
+        m = params
+        self.s = s
+        self.v = v
+        S = s[:, np.newaxis]
+        V = v[np.newaxis, :]
+        firstS, secondS = derivativeWeights(s)
+        firstV, secondV = derivativeWeights(v)
+
+        self.diffusion1 = secondS[:, :, np.newaxis] * (0.5 * S ** 2 * V)
+        self.convection1 = np.repeat((firstS * s)[:, :, np.newaxis], len(v), axis=2)
+        self.convection1[:, -1, :] = (np.array([-1., 1., 0.]) * s[-1] / (s[-1] - s[-2]))[:, np.newaxis]
+
+        a2 = secondV * (0.5 * m.xi ** 2 * v) + firstV * (m.kappa * (m.theta - v))
+        self.a2 = np.repeat(a2[:, np.newaxis, :], len(s), axis=1)
+        self.a2[:, :, 0] = (np.array([0., -1., 1.]) * m.kappa * m.theta / v[1])[:, np.newaxis]
+
+        # the 9 point stencil of the mixed derivative, inner points only
+        mixed = m.rho * m.xi * S * V
+        self.mixed = [(k, l, (mixed * np.outer(firstS[k + 1], firstV[l + 1]))[1:-1, 1:-1])
+                      for k in (-1, 0, 1) for l in (-1, 0, 1)]
+
+        self.dirichlet = None
+        if barrier is not None:
+            self.dirichlet = -1 if up else 0
+            for a in (self.diffusion1, self.convection1, self.a2):
+                a[:, self.dirichlet, :] = 0.
+        # lru of the operators and banded systems by time step and rates
+        self.maxsize = maxsize
+        self.systems = OrderedDict()
+
+    def a1(self, r, q):
+        a1 = self.diffusion1 + (r - q) * self.convection1
+        a1[1] -= 0.5 * r
+        return a1
+
+    def a2r(self, r):
+        a2 = self.a2.copy()
+        a2[1] -= 0.5 * r
+        return a2
+
+    @staticmethod
+    def apply(a, u, axis):
+        '''
+            the tridiagonal operator a on u of shape (nS, nV, columns) along axis 0 (spot) or 1 (variance)
+        '''
+        out = a[1][:, :, np.newaxis] * u
+        if axis == 0:
+            out[1:] += a[0][1:, :, np.newaxis] * u[:-1]
+            out[:-1] += a[2][:-1, :, np.newaxis] * u[1:]
+        else:
+            out[:, 1:] += a[0][:, 1:, np.newaxis] * u[:, :-1]
+            out[:, :-1] += a[2][:, :-1, np.newaxis] * u[:, 1:]
+        return out
+
+    def apply0(self, u):
+        out = np.zeros_like(u)
+        nS, nV = len(self.s), len(self.v)
+        for k, l, w in self.mixed:
+            out[1:-1, 1:-1] += w[:, :, np.newaxis] * u[1 + k:nS - 1 + k, 1 + l:nV - 1 + l]
+        return out
+
+    def system(self, a, axis, c):
+        '''
+            the banded form of I - c a, its tridiagonal systems one after the other
+        '''
+        if axis == 0:
+            a = a.transpose((0, 2, 1))
+        lower, diag, upper = [x.ravel() for x in a]
+        ab = np.zeros((3, len(diag)))
+        ab[0, 1:] = -c * upper[:-1]
+        ab[1] = 1. - c * diag
+        ab[2, :-1] = -c * lower[1:]
+        return ab
+
+    def solve(self, ab, u, axis):
+        '''
+            solution of the systems ab for the right hand sides u of shape (nS, nV, columns)
+        '''
+        profile = profiling.current()
+        if profile is not None:
+            profile.count('pdeSolves')
+        nS, nV, n = u.shape
+        if axis == 0:
+            x = sla.solve_banded((1, 1), ab, u.transpose((1, 0, 2)).reshape(nV * nS, n), check_finite=False)
+            return x.reshape(nV, nS, n).transpose((1, 0, 2))
+        return sla.solve_banded((1, 1), ab, u.reshape(nS * nV, n), check_finite=False).reshape(nS, nV, n)
+
+    def step(self, u, dt, r, q, theta):
+        '''
+            u after a hundsdorfer-verwer step dt at constant rates
+        '''
+        key = (dt, r, q)
+        if key in self.systems:
+            a1, a2, ab1, ab2 = self.systems[key] = self.systems.pop(key)
+        else:
+            a1 = self.a1(r, q)
+            a2 = self.a2r(r)
+            ab1 = self.system(a1, 0, theta * dt)
+            ab2 = self.system(a2, 1, theta * dt)
+            self.systems[key] = (a1, a2, ab1, ab2)
+            while len(self.systems) > self.maxsize:
+                self.systems.popitem(last=False)
+
+        f1 = self.apply(a1, u, 0)
+        f2 = self.apply(a2, u, 1)
+        f = self.apply0(u) + f1 + f2
+        y0 = u + dt * f
+        y1 = self.solve(ab1, y0 - theta * dt * f1, 0)
+        y2 = self.solve(ab2, y1 - theta * dt * f2, 1)
+
+        g1 = self.apply(a1, y2, 0)
+        g2 = self.apply(a2, y2, 1)
+        z0 = y0 + 0.5 * dt * (self.apply0(y2) + g1 + g2 - f)
+        z1 = self.solve(ab1, z0 - theta * dt * g1, 0)
+        return self.solve(ab2, z1 - theta * dt * g2, 1)
+
+
+class HestonADI:
+    '''
+        heston pde (heston.HestonParams) with the rates of the params, or of the curves if given, on a grid
+        of nS x nV intervals up to sMax and vMax and steps of at most dt. the operators are built once per
+        barrier and kept
+    '''
+    theta = 0.5 + np.sqrt(3.) / 6.
+
+    def __init__(self, params, nS=100, nV=50, dt=1. / 100, sMax=None, vMax=5., dfDomCurve=None,
+                 dfForCurve=None):
+        self.m = params
+        self.nS = nS
+        self.nV = nV
+        self.dt = dt
+        self.sMax = 8. * params.s0 if sMax is None else sMax
+        self.vMax = vMax
+        self.dfDomCurve = dfDomCurve
+        self.dfForCurve = dfForCurve
+        self.v = sinhGrid(0., vMax, 0., nV, vMax / 500.)
+        self.operators = {}
+
+    @staticmethod
+    def fromMarket(market, **kwargs):
+        '''
+            the pde of heston_calibration.HestonMarket: its parameters and curves
+        '''
+        hp = market.hestonParams
+        params = heston.HestonParams(market.spot(), hp.var0, 0., 0., hp.kappa, hp.theta, hp.xi, hp.rho)
+        return HestonADI(params, dfDomCurve=market.dfDomCurve, dfForCurve=market.dfForCurve, **kwargs)
+
+    def grid(self, barrier=None, up=True):
+        '''
+            the operators of the spot grid dense around spot, from 0 to sMax or ending at the barrier
+        '''
+        key = (barrier, up)
+        if key not in self.operators:
+            lower, upper = 0., self.sMax
+            if barrier is not None:
+                if up:
+                    upper = barrier
+                else:
+                    lower = barrier
+            s = sinhGrid(lower, upper, self.m.s0, self.nS, self.m.s0 / 5.)
+            self.operators[key] = ADIOperators(self.m, s, self.v, barrier, up)
+        return self.operators[key]
+
+    def rates(self, ttm, tau0, tau1):
+        '''
+            domestic and foreign rates from time to maturity tau0 to tau1 of an option maturing at ttm
+        '''
+        if self.dfDomCurve is None:
+            return self.m.r, self.m.q
+        t = np.array([ttm - tau1, ttm - tau0])
+        dfDom = self.dfDomCurve.df(t)
+        dfFor = self.dfForCurve.df(t)
+        return np.log(dfDom[0] / dfDom[1]) / (tau1 - tau0), np.log(dfFor[0] / dfFor[1]) / (tau1 - tau0)
+
+    def march(self, ops, u, exercise, ttm, tau0, tau1):
+        '''
+            u from time to maturity tau0 to tau1 in equal steps of at most dt
+        '''
+        n = max(int(np.ceil((tau1 - tau0) / self.dt - 1.e-9)), 1)
+        taus = tau0 + (tau1 - tau0) * np.arange(n + 1) / float(n)
+        dt = (tau1 - tau0) / n
+        profile = profiling.current()
+        if profile is not None:
+            profile.count('pdeSteps', n)
+        for k in xrange(n):
+            r, q = self.rates(ttm, taus[k], taus[k + 1])
+            u = ops.step(u, dt, r, q, self.theta)
+            if exercise is not None:
+                u = np.maximum(u, exercise)
+        return u
+
+    def value(self, ops, u):
+        '''
+            u at spot and v0, per column
+        '''
+        return np.array([spint.RectBivariateSpline(ops.s, ops.v, u[:, :, c]).ev(self.m.s0, self.m.v0)
+                         for c in xrange(u.shape[2])])
+
+    def price(self, strikes, ttms, callput=1., american=False, barrier=None, up=True):
+        '''
+            present values at spot and v0 of calls (callput=1) or puts, european or american, knocked out
+            when spot reaches the barrier (from below if up, monitored continuously), of shape
+            (len(ttms), len(strikes)); zero if spot is at or beyond the barrier already
+        '''
+        strikes = np.atleast_1d(np.asarray(strikes, dtype=float))
+        ttms = np.atleast_1d(np.asarray(ttms, dtype=float))
+        if barrier is not None and (barrier <= self.m.s0 if up else barrier >= self.m.s0):
+            return np.zeros((len(ttms), len(strikes)))
+        ops = self.grid(barrier, up)
+        payoff = np.maximum(callput * (ops.s[:, np.newaxis] - strikes), 0.)
+        if ops.dirichlet is not None:
+            payoff[ops.dirichlet] = 0.
+        payoff = np.repeat(payoff[:, np.newaxis, :], self.nV + 1, axis=1)
+        exercise = payoff if american else None
+
+        pvs = np.zeros((len(ttms), len(strikes)))
+        with profiling.timer('pde'):
+            if self.dfDomCurve is None:
+                # the same march for all tenors
+                u, tau = payoff, 0.
+                for i in np.argsort(ttms):
+                    u = self.march(ops, u, exercise, ttms[i], tau, ttms[i]) if ttms[i] > tau else u
+                    tau = max(tau, ttms[i])
+                    pvs[i] = self.value(ops, u)
+            else:
+                for i, ttm in enumerate(ttms):
+                    pvs[i] = self.value(ops, self.march(ops, payoff, exercise, ttm, 0., ttm))
+        return pvs
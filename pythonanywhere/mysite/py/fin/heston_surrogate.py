@@ -0,0 +1,116 @@
+'''
+    chebyshev surrogate of the heston implied vol map
+'''
+
+import numpy as np
+
+import heston
+
+# coordinates of the surrogate: log-moneyness ln(K/F) in units of sqrt(w * T), w the expected average variance
+# up to T, then sqrt(T), sqrt(v0), kappa, sqrt(theta), xi and rho
+AXES = ('x', 'sqrtT', 'sqrtV0', 'kappa', 'sqrtTheta', 'xi', 'rho')
+DEFAULT_LOWER = (-2.5, np.sqrt(1. / 52), 0.03, 0.1, 0.03, 0.02, -0.9)
+DEFAULT_UPPER = (2.5, np.sqrt(2.), 0.3, 5., 0.3, 0.6, 0.9)
+DEFAULT_NODES = (16, 8, 6, 5, 6, 6, 5)
+
+
+def averageVariance(v0, kappa, theta, ttm):
+    '''
+        E[1/T int_0^T v_t dt]
+    '''
+    kt = kappa * ttm
+    return theta + (v0 - theta) * -np.expm1(-kt) / kt
+
+
+def chebyshevNodes(n, lower, upper):
+    return lower + (np.cos(np.pi * (np.arange(n) + 0.5) / n) + 1.) * (upper - lower) / 2.
+
+
+class ChebyshevSurrogate:
+    '''
+        tensor chebyshev interpolant of the implied vol, divided by sqrt(w), on the box [lower, upper] of AXES.
+        trained offline by train() and kept as an .npz file; impliedVols() first contracts the coefficients
+        with the parameter coordinates and then evaluates the remaining (x, sqrtT) polynomial per quote.
+        coordinates outside the box are clipped to it
+    '''
+
+    def __init__(self, lower, upper, coefficients):
+        self.lower = np.asarray(lower, dtype=float)
+        self.upper = np.asarray(upper, dtype=float)
+        self.coefficients = np.ascontiguousarray(coefficients, dtype=float)
+
+    @classmethod
+    def train(cls, nodes=DEFAULT_NODES, lower=DEFAULT_LOWER, upper=DEFAULT_UPPER):
+        '''
+            implied vols on the tensor grid of chebyshev nodes by HestonCOS, one population of all the
+            parameter nodes per maturity node
+        '''
+        grids = [chebyshevNodes(n, lo, hi) for n, lo, hi in zip(nodes, lower, upper)]
+        sqrtV0, kappa, sqrtTheta, xi, rho = [p.reshape(-1, 1) for p in np.meshgrid(*grids[2:], indexing='ij')]
+        v0 = sqrtV0 ** 2.
+        theta = sqrtTheta ** 2.
+        model = heston.HestonCOS(heston.HestonParams(1., v0, 0., 0., kappa, theta, xi, rho))
+
+        values = np.empty((nodes[1], len(v0), nodes[0]))
+        err = np.seterr(all='ignore')
+        try:
+            for j, sqrtT in enumerate(grids[1]):
+                ttm = sqrtT ** 2.
+                w = averageVariance(v0, kappa, theta, ttm)
+                values[j] = model.smile(np.exp(grids[0] * np.sqrt(w * ttm)), ttm) / np.sqrt(w)
+        finally:
+            np.seterr(**err)
+        failed = np.count_nonzero(~np.isfinite(values))
+        if failed:
+            raise ValueError('{} of {} implied vols failed, narrow the domain'.format(failed, values.size))
+
+        # (sqrtT, parameters, x) -> (x, sqrtT, sqrtV0, kappa, sqrtTheta, xi, rho)
+        values = np.moveaxis(values.reshape((nodes[1],) + tuple(nodes[2:]) + (nodes[0],)), -1, 0)
+        for axis, n in enumerate(nodes):
+            # discrete chebyshev transform on the roots of T_n
+            k = np.arange(n)
+            transform = 2. / n * np.cos(np.pi * np.outer(k, k + 0.5) / n)
+            transform[0] *= 0.5
+            values = np.moveaxis(np.tensordot(transform, values, axes=(1, axis)), 0, axis)
+        return cls(lower, upper, values)
+
+    def save(self, path):
+        np.savez_compressed(path, lower=self.lower, upper=self.upper, coefficients=self.coefficients)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        try:
+            return cls(data['lower'], data['upper'], data['coefficients'])
+        finally:
+            data.close()
+
+    def bounds(self, name):
+        '''
+            range of the natural heston parameter name ('var0', 'kappa', 'theta', 'xi', 'rho')
+        '''
+        axis = {'var0': 2, 'kappa': 3, 'theta': 4, 'xi': 5, 'rho': 6}[name]
+        lower, upper = self.lower[axis], self.upper[axis]
+        return (lower ** 2., upper ** 2.) if name in ('var0', 'theta') else (lower, upper)
+
+    def basis(self, axis, values):
+        u = (2. * np.asarray(values, dtype=float) - (self.lower[axis] + self.upper[axis])) \
+            / (self.upper[axis] - self.lower[axis])
+        # T_k(u) = cos(k arccos(u)) on [-1, 1]
+        return np.cos(np.multiply.outer(np.arccos(np.clip(u, -1., 1.)), np.arange(self.coefficients.shape[axis])))
+
+    def impliedVols(self, ttm, logMoneyness, v0, kappa, theta, xi, rho):
+        '''
+            implied vols for quotes at maturities ttm and log-moneyness ln(K/F), one set of parameters
+        '''
+        # one matrix-vector product with the tensor product of the parameter bases
+        b = np.ones(1)
+        for axis, value in enumerate([np.sqrt(v0), kappa, np.sqrt(theta), xi, rho], 2):
+            b = np.outer(b, self.basis(axis, value)).ravel()
+        n = self.coefficients.shape
+        c = self.coefficients.reshape(n[0] * n[1], -1).dot(b).reshape(n[0], n[1])
+        ttm = np.asarray(ttm, dtype=float)
+        w = averageVariance(v0, kappa, theta, ttm)
+        bx = self.basis(0, np.asarray(logMoneyness) / np.sqrt(w * ttm))
+        bt = self.basis(1, np.sqrt(ttm))
+        return np.sqrt(w) * np.sum(bx.dot(c) * bt, axis=-1)
@@ -0,0 +1,378 @@
+'''
+    black implied volatility to machine precision after P. Jaeckel, "Let's be rational" (2015):
+    a rational cubic initial guess on four branches of the normalised price followed by
+    two householder(3) steps, no brackets to expand and no tolerances to tune
+
+    conventions follow the reference implementation: x = ln(F/K), s = sigma * sqrt(T), q = +1 for calls
+    and -1 for puts, normalised prices are undiscounted and divided by sqrt(F * K)
+'''
+import math
+import sys
+
+import scipy.special as sps
+
+
+DBL_EPSILON = sys.float_info.epsilon
+DBL_MIN = sys.float_info.min
+DBL_MAX = sys.float_info.max
+SQRT_DBL_MAX = math.sqrt(DBL_MAX)
+
+ONE_OVER_SQRT_TWO = 1. / math.sqrt(2.)
+ONE_OVER_SQRT_TWO_PI = 1. / math.sqrt(2. * math.pi)
+SQRT_TWO_PI = math.sqrt(2. * math.pi)
+SQRT_PI_OVER_TWO = math.sqrt(math.pi / 2.)
+SQRT_THREE = math.sqrt(3.)
+SQRT_ONE_OVER_THREE = 1. / SQRT_THREE
+TWO_PI = 2. * math.pi
+PI_OVER_SIX = math.pi / 6.
+TWO_PI_OVER_SQRT_TWENTY_SEVEN = 2. * math.pi / math.sqrt(27.)
+
+MIN_RATIONAL_CUBIC_CONTROL = -(1. - math.sqrt(DBL_EPSILON))
+MAX_RATIONAL_CUBIC_CONTROL = 2. / DBL_EPSILON ** 2
+
+SMALL_T_EXPANSION_THRESHOLD = 2. * DBL_EPSILON ** (1. / 16.)
+ASYMPTOTIC_EXPANSION_THRESHOLD = 6.5  # in units of the erfcx argument -(h+t)/sqrt(2)
+
+HOUSEHOLDER_STEPS = 2
+
+
+def normalised_intrinsic(x, q):
+    if q * x <= 0.:
+        return 0.
+    return 2. * q * math.sinh(0.5 * x)
+
+
+def normalised_vega(x, s):
+    if x == 0.:
+        return ONE_OVER_SQRT_TWO_PI * math.exp(-0.125 * s * s)
+    if s <= abs(x) * math.sqrt(DBL_MIN):
+        return 0.
+    h = x / s
+    return ONE_OVER_SQRT_TWO_PI * math.exp(-0.5 * (h * h + 0.25 * s * s))
+
+
+def asymptotic_expansion_of_normalised_black_call(h, t):
+    '''
+        h = x/s < 0 deep in the lower wing: erfcx(a) - erfcx(c) with a = -(h+t)/sqrt(2), c = (t-h)/sqrt(2)
+        from the asymptotic series of erfcx, each difference a^-m - c^-m taken without cancellation
+    '''
+    a = -(h + t) * ONE_OVER_SQRT_TWO
+    delta = 2. * t * ONE_OVER_SQRT_TWO  # c - a
+    lnRatio = math.log1p(delta / a)
+    c = a + delta
+    total, coeff, m = 0., 1., 1
+    previous = DBL_MAX
+    while True:
+        term = coeff * c ** -m * math.expm1(m * lnRatio)
+        if abs(term) >= previous:
+            break
+        total += term
+        if abs(term) <= DBL_EPSILON * abs(total):
+            break
+        previous = abs(term)
+        coeff *= -0.5 * m
+        m += 2
+    return 0.5 * math.exp(-0.5 * (h * h + t * t)) * total / math.sqrt(math.pi)
+
+
+def small_t_expansion_of_normalised_black_call(h, t):
+    a = 1. + h * (0.5 * SQRT_TWO_PI) * sps.erfcx(-ONE_OVER_SQRT_TWO * h)
+    w = t * t
+    h2 = h * h
+    expansion = 2. * t * (a + w * ((-1. + 3. * a + a * h2) / 6. + w * (
+        (-7. + 15. * a + h2 * (-1. + 10. * a + a * h2)) / 120. + w * (
+            (-57. + 105. * a + h2 * (-18. + 105. * a + h2 * (-1. + 21. * a + a * h2))) / 5040. + w * (
+                (-561. + 945. * a + h2 * (-285. + 1260. * a + h2 * (-33. + 378. * a + h2 * (-1. + 36. * a + a * h2))))
+                / 362880. + w * (
+                    (-6555. + 10395. * a + h2 * (-4680. + 17325. * a + h2 * (-840. + 6930. * a + h2 * (
+                        -52. + 990. * a + h2 * (-1. + 55. * a + a * h2))))) / 39916800. + (
+                        (-89055. + 135135. * a + h2 * (-82845. + 270270. * a + h2 * (-20370. + 135135. * a + h2 * (
+                            -1926. + 25740. * a + h2 * (-75. + 2145. * a + h2 * (-1. + 78. * a + a * h2))))))
+                        * w) / 6227020800.))))))
+    return ONE_OVER_SQRT_TWO_PI * math.exp(-0.5 * (h * h + t * t)) * expansion
+
+
+def normalised_black_call(x, s):
+    if x > 0.:
+        return normalised_intrinsic(x, 1.) + normalised_black_call(-x, s)
+    if s <= abs(x) * DBL_MIN:
+        return normalised_intrinsic(x, 1.)
+    h = x / s
+    t = 0.5 * s
+    if -(h + t) * ONE_OVER_SQRT_TWO >= ASYMPTOTIC_EXPANSION_THRESHOLD:
+        return asymptotic_expansion_of_normalised_black_call(h, t)
+    if t < SMALL_T_EXPANSION_THRESHOLD:
+        return small_t_expansion_of_normalised_black_call(h, t)
+    if h + t <= 0.:
+        return 0.5 * math.exp(-0.5 * (h * h + t * t)) * (sps.erfcx(-ONE_OVER_SQRT_TWO * (t + h))
+                                                         - sps.erfcx(ONE_OVER_SQRT_TWO * (t - h)))
+    return math.exp(0.5 * x) * sps.ndtr(h + t) - math.exp(-0.5 * x) * sps.ndtr(h - t)
+
+
+def normalised_black(x, s, q):
+    # put-call parity: b_put(x) = b_call(-x)
+    return normalised_black_call(q * x, s)
+
+
+def rational_cubic_interpolation(x, x_l, x_r, y_l, y_r, d_l, d_r, r):
+    h = x_r - x_l
+    if abs(h) <= 0.:
+        return 0.5 * (y_l + y_r)
+    t = (x - x_l) / h
+    if r < MAX_RATIONAL_CUBIC_CONTROL:
+        omt = 1. - t
+        t2 = t * t
+        omt2 = omt * omt
+        return (y_r * t2 * t + (r * y_r - h * d_r) * t2 * omt + (r * y_l + h * d_l) * t * omt2 + y_l * omt2 * omt) \
+            / (1. + (r - 3.) * t * omt)
+    return y_r * t + y_l * (1. - t)
+
+
+def rational_cubic_control_parameter_to_fit_second_derivative_at_left_side(x_l, x_r, y_l, y_r, d_l, d_r, d2_l):
+    h = x_r - x_l
+    numerator = 0.5 * h * d2_l + (d_r - d_l)
+    if numerator == 0.:
+        return 0.
+    denominator = (y_r - y_l) / h - d_l
+    if denominator == 0.:
+        return MAX_RATIONAL_CUBIC_CONTROL if numerator > 0. else MIN_RATIONAL_CUBIC_CONTROL
+    return numerator / denominator
+
+
+def rational_cubic_control_parameter_to_fit_second_derivative_at_right_side(x_l, x_r, y_l, y_r, d_l, d_r, d2_r):
+    h = x_r - x_l
+    numerator = 0.5 * h * d2_r + (d_r - d_l)
+    if numerator == 0.:
+        return 0.
+    denominator = d_r - (y_r - y_l) / h
+    if denominator == 0.:
+        return MAX_RATIONAL_CUBIC_CONTROL if numerator > 0. else MIN_RATIONAL_CUBIC_CONTROL
+    return numerator / denominator
+
+
+def minimum_rational_cubic_control_parameter(d_l, d_r, s, preferShapePreservation):
+    monotonic = d_l * s >= 0. and d_r * s >= 0.
+    convex = d_l <= s <= d_r
+    concave = d_l >= s >= d_r
+    if not (monotonic or convex or concave):
+        return MIN_RATIONAL_CUBIC_CONTROL
+    r1 = r2 = -DBL_MAX
+    if monotonic:
+        if s != 0.:
+            r1 = (d_r + d_l) / s
+        elif preferShapePreservation:
+            r1 = MAX_RATIONAL_CUBIC_CONTROL
+    if convex or concave:
+        if s - d_l != 0. and d_r - s != 0.:
+            r2 = max(abs((d_r - d_l) / (d_r - s)), abs((d_r - d_l) / (s - d_l)))
+        elif preferShapePreservation:
+            r2 = MAX_RATIONAL_CUBIC_CONTROL
+    elif monotonic and preferShapePreservation:
+        r2 = MAX_RATIONAL_CUBIC_CONTROL
+    return max(MIN_RATIONAL_CUBIC_CONTROL, r1, r2)
+
+
+def convex_rational_cubic_control_parameter_to_fit_second_derivative_at_left_side(
+        x_l, x_r, y_l, y_r, d_l, d_r, d2_l, preferShapePreservation):
+    r = rational_cubic_control_parameter_to_fit_second_derivative_at_left_side(x_l, x_r, y_l, y_r, d_l, d_r, d2_l)
+    return max(r, minimum_rational_cubic_control_parameter(d_l, d_r, (y_r - y_l) / (x_r - x_l),
+                                                           preferShapePreservation))
+
+
+def convex_rational_cubic_control_parameter_to_fit_second_derivative_at_right_side(
+        x_l, x_r, y_l, y_r, d_l, d_r, d2_r, preferShapePreservation):
+    r = rational_cubic_control_parameter_to_fit_second_derivative_at_right_side(x_l, x_r, y_l, y_r, d_l, d_r, d2_r)
+    return max(r, minimum_rational_cubic_control_parameter(d_l, d_r, (y_r - y_l) / (x_r - x_l),
+                                                           preferShapePreservation))
+
+
+def f_lower_map_and_first_two_derivatives(x, s):
+    ax = abs(x)
+    z = SQRT_ONE_OVER_THREE * ax / s
+    y = z * z
+    s2 = s * s
+    Phi = sps.ndtr(-z)
+    phi = math.exp(-0.5 * y) * ONE_OVER_SQRT_TWO_PI
+    fpp = PI_OVER_SIX * y / (s2 * s) * Phi * (8. * SQRT_THREE * s * ax + (3. * s2 * (s2 - 8.) - 8. * x * x) * Phi / phi) \
+        * math.exp(2. * y + 0.25 * s2)
+    Phi2 = Phi * Phi
+    fp = TWO_PI * y * Phi2 * math.exp(y + 0.125 * s2)
+    f = TWO_PI_OVER_SQRT_TWENTY_SEVEN * ax * (Phi2 * Phi)
+    return f, fp, fpp
+
+
+def inverse_f_lower_map(x, f):
+    if f <= 0.:
+        return 0.
+    return abs(x / (SQRT_THREE * sps.ndtri((f / (TWO_PI_OVER_SQRT_TWENTY_SEVEN * abs(x))) ** (1. / 3.))))
+
+
+def f_upper_map_and_first_two_derivatives(x, s):
+    f = sps.ndtr(-0.5 * s)
+    if x == 0.:
+        return f, -0.5, 0.
+    w = (x / s) ** 2
+    fp = -0.5 * math.exp(0.5 * w)
+    fpp = SQRT_PI_OVER_TWO * math.exp(w + 0.125 * s * s) * w / s
+    return f, fp, fpp
+
+
+def inverse_f_upper_map(f):
+    return -2. * sps.ndtri(f)
+
+
+def householder_factor(newton, halley, hh3):
+    return (1. + 0.5 * halley * newton) / (1. + newton * (halley + hh3 * newton / 6.))
+
+
+def normalised_implied_volatility(beta, x, q, N=HOUSEHOLDER_STEPS):
+    '''
+        s = sigma * sqrt(T) from the normalised price beta, without the range checks
+    '''
+    # in-the-money to out-of-the-money, then puts to calls: afterwards x <= 0 and q = 1
+    if q * x > 0.:
+        beta = abs(max(beta - normalised_intrinsic(x, q), 0.))
+        q = -q
+    if q < 0.:
+        x = -x
+        q = -q
+    if beta <= 0.:
+        return 0.
+    bMax = math.exp(0.5 * x)
+    if beta >= bMax:
+        return float('inf')
+
+    iterations = 0
+    reversals = 0
+    f = -DBL_MAX
+    s = -DBL_MAX
+    ds = s
+    dsPrevious = 0.
+    sLeft = DBL_MIN
+    sRight = DBL_MAX
+
+    sC = math.sqrt(abs(2. * x))
+    bC = normalised_black_call(x, sC)
+    vC = normalised_vega(x, sC)
+
+    objective = 'price'
+    if beta < bC:
+        sL = sC - bC / vC
+        bL = normalised_black_call(x, sL)
+        if beta < bL:
+            fL, dfL, d2fL = f_lower_map_and_first_two_derivatives(x, sL)
+            rLL = convex_rational_cubic_control_parameter_to_fit_second_derivative_at_right_side(
+                0., bL, 0., fL, 1., dfL, d2fL, True)
+            f = rational_cubic_interpolation(beta, 0., bL, 0., fL, 1., dfL, rLL)
+            if not f > 0.:
+                # quadratic through f(0) = 0, f(b_l) and f'(0) = 1
+                t = beta / bL
+                f = (fL * t + bL * (1. - t)) * t
+            s = inverse_f_lower_map(x, f)
+            sRight = sL
+            objective = 'lower'
+        else:
+            vL = normalised_vega(x, sL)
+            rLM = convex_rational_cubic_control_parameter_to_fit_second_derivative_at_right_side(
+                bL, bC, sL, sC, 1. / vL, 1. / vC, 0., False)
+            s = rational_cubic_interpolation(beta, bL, bC, sL, sC, 1. / vL, 1. / vC, rLM)
+            sLeft = sL
+            sRight = sC
+    else:
+        sH = sC + (bMax - bC) / vC if vC > DBL_MIN else sC
+        bH = normalised_black_call(x, sH)
+        if beta <= bH:
+            vH = normalised_vega(x, sH)
+            rHM = convex_rational_cubic_control_parameter_to_fit_second_derivative_at_left_side(
+                bC, bH, sC, sH, 1. / vC, 1. / vH, 0., False)
+            s = rational_cubic_interpolation(beta, bC, bH, sC, sH, 1. / vC, 1. / vH, rHM)
+            sLeft = sC
+            sRight = sH
+        else:
+            fH, dfH, d2fH = f_upper_map_and_first_two_derivatives(x, sH)
+            if -SQRT_DBL_MAX < d2fH < SQRT_DBL_MAX:
+                rHH = convex_rational_cubic_control_parameter_to_fit_second_derivative_at_left_side(
+                    bH, bMax, fH, 0., dfH, -0.5, d2fH, True)
+                f = rational_cubic_interpolation(beta, bH, bMax, fH, 0., dfH, -0.5, rHH)
+            if f <= 0.:
+                # quadratic through f(b_h), f(b_max) = 0 and f'(b_max) = -1/2
+                h = bMax - bH
+                t = (beta - bH) / h
+                f = (fH * (1. - t) + 0.5 * h * t) * (1. - t)
+            s = inverse_f_upper_map(f)
+            sLeft = sH
+            if beta > 0.5 * bMax:
+                objective = 'upper'
+
+    while iterations < N and abs(ds) > DBL_EPSILON * s:
+        if ds * dsPrevious < 0.:
+            reversals += 1
+        if iterations > 0 and (reversals == 3 or not sLeft < s < sRight):
+            # looping or out of the bracket: binary nesting
+            s = 0.5 * (sLeft + sRight)
+            if sRight - sLeft <= DBL_EPSILON * s:
+                break
+            reversals = 0
+            ds = 0.
+        dsPrevious = ds
+        b = normalised_black_call(x, s)
+        bp = normalised_vega(x, s)
+        if b > beta and s < sRight:
+            sRight = s
+        elif b < beta and s > sLeft:
+            sLeft = s
+
+        if objective == 'lower':
+            # g(s) = 1/ln(b(s)) - 1/ln(beta)
+            if b <= 0. or bp <= 0.:
+                ds = 0.5 * (sLeft + sRight) - s
+            else:
+                lnB = math.log(b)
+                lnBeta = math.log(beta)
+                bpob = bp / b
+                h = x / s
+                bHalley = h * h / s - s / 4.
+                newton = (lnBeta - lnB) * lnB / lnBeta / bpob
+                halley = bHalley - bpob * (1. + 2. / lnB)
+                bHH3 = bHalley * bHalley - 3. * (h / s) ** 2 - 0.25
+                hh3 = bHH3 + 2. * bpob ** 2 * (1. + 3. / lnB * (1. + 1. / lnB)) - 3. * bHalley * bpob * (1. + 2. / lnB)
+                ds = newton * householder_factor(newton, halley, hh3)
+        elif objective == 'upper':
+            # g(s) = ln(b_max - beta) - ln(b_max - b(s))
+            if b >= bMax or bp <= DBL_MIN:
+                ds = 0.5 * (sLeft + sRight) - s
+            else:
+                bMaxMinusB = bMax - b
+                g = math.log((bMax - beta) / bMaxMinusB)
+                gp = bp / bMaxMinusB
+                bHalley = (x / s) ** 2 / s - s / 4.
+                bHH3 = bHalley * bHalley - 3. * (x / (s * s)) ** 2 - 0.25
+                newton = -g / gp
+                halley = bHalley + gp
+                hh3 = bHH3 + gp * (2. * gp + 3. * bHalley)
+                ds = newton * householder_factor(newton, halley, hh3)
+        else:
+            # g(s) = b(s) - beta
+            newton = (beta - b) / bp
+            halley = (x / s) ** 2 / s - s / 4.
+            hh3 = halley * halley - 3. * (x / (s * s)) ** 2 - 0.25
+            ds = newton * householder_factor(newton, halley, hh3)
+        ds = max(-0.5 * s, ds)
+        s += ds
+        iterations += 1
+    return s
+
+
+def implied_volatility(price, fwd, strike, ttm, q, N=HOUSEHOLDER_STEPS):
+    '''
+        black volatility of an undiscounted call (q=1) or put (q=-1) price,
+        nan if the price is outside of (intrinsic, upper bound)
+    '''
+    intrinsic = abs(max(strike - fwd if q < 0 else fwd - strike, 0.))
+    if price < intrinsic or price >= (strike if q < 0 else fwd):
+        return float('nan')
+    x = math.log(fwd / strike)
+    if q * x > 0.:
+        price = abs(max(price - intrinsic, 0.))
+        q = -q
+    return normalised_implied_volatility(price / (math.sqrt(fwd) * math.sqrt(strike)), x, q, N) / math.sqrt(ttm)
@@ -0,0 +1,188 @@
+'''
+    heston calibration of a quoted fx vol surface: tenors with df, forward points, atm, 25 (and 10) delta
+    risk reversals and butterflies, as sent by the web client and read by the batch calibration
+'''
+import datetime as dt
+
+import numpy as np
+
+import heston_calibration as hcal
+import profiling
+from calibration_store import CalibrationStore
+
+
+def tenor2ttm(tenor):
+    m = {'ON': 1. / 252,
+         '1W': 1. / 52,
+         '2W': 2. / 52,
+         '3W': 3. / 52,
+         '1M': 1. / 12,
+         '2M': 2. / 12,
+         '3M': 3. / 12,
+         '4M': 4. / 12,
+         '5M': 5. / 12,
+         '6M': 6. / 12,
+         '7M': 7. / 12,
+         '8M': 8. / 12,
+         '9M': 9. / 12,
+         '10M': 10. / 12,
+         '11M': 11. / 12,
+         '12M': 1.,
+         '1Y': 1.,
+         '2Y': 2.,
+         '3Y': 3.,
+         '4Y': 4.,
+         '5Y': 5.
+         }
+
+    return m[tenor]
+
+
+class QuotedSurface:
+    '''
+        market and strikes of the quotes: the domestic curve from the dfs, the foreign one implied by the
+        forward points and per tenor the vols and strikes of the 10d put, 25d put, atm, 25d call and 10d
+        call (without the 10d ones if not quoted)
+    '''
+
+    def __init__(self, spot, inputQuotes, premiumType):
+        self.spot = spot
+        self.tenors = []
+        self.t = []
+        self.zrDom = []
+        self.fwdPoints = []
+        self.smiles = []
+        self.deltaTypes = []
+
+        for q in inputQuotes:
+            self.tenors.append(q['tenor'])
+            ttm = tenor2ttm(q['tenor'])
+            df = float(q['df'])
+            rr25 = float(q['rr25']) / 100.
+            atm = float(q['atm']) / 100.
+            bf25 = float(q['bf25']) / 100.
+
+            self.deltaTypes.append(hcal.DeltaType.Spot if q['deltaType'] == 'Spot' else hcal.DeltaType.Forward)
+            self.t.append(ttm)
+            self.zrDom.append(-np.log(df) / ttm)
+            self.fwdPoints.append(float(q['fwd']))
+            if 'rr10' in q:
+                rr10 = float(q['rr10']) / 100.
+                bf10 = float(q['bf10']) / 100.
+                self.smiles.append([atm + bf10 - rr10 / 2.,
+                                    atm + bf25 - rr25 / 2.,
+                                    atm,
+                                    atm + bf25 + rr25 / 2.,
+                                    atm + bf10 + rr10 / 2.])
+            else:
+                self.smiles.append([atm + bf25 - rr25 / 2.,
+                                    atm,
+                                    atm + bf25 + rr25 / 2.])
+
+        fwdPointsCurve = hcal.ForwardCurveFromLinearPoints(spot, self.t, self.fwdPoints)
+        self.dfDomCurve = hcal.InterpolatedZeroCurve(hcal.LinearInterpolator(self.t, self.zrDom))
+        self.dfForCurve = hcal.ForwardHelper.implyForeignCurve(fwdPointsCurve, self.dfDomCurve)
+        self.fwdCurve = hcal.ForwardCurve(spot, self.dfDomCurve, self.dfForCurve)
+        self.fxMarket = hcal.FxMarket(self.dfDomCurve, self.dfForCurve, self.fwdCurve)
+
+        self.premiumType = hcal.PremiumType.Included if premiumType == 'Included' else hcal.PremiumType.Excluded
+        with profiling.timer('strikeConversion'):
+            # all the pillars of all tenors at once
+            deltas = [[-0.1, -0.25, 0., 0.25, 0.1] if len(smile) == 5 else [-0.25, 0., 0.25]
+                      for smile in self.smiles]
+            n = [len(d) for d in deltas]
+            ttm = np.repeat(self.t, n)
+            delta = np.concatenate(deltas)
+            vol = np.concatenate(self.smiles)
+            otm = delta != 0.
+            # the atm strikes do not depend on the delta type
+            quoteHelper = hcal.QuoteHelper(self.fxMarket, np.repeat(self.deltaTypes, n)[otm], self.premiumType)
+            strikes = quoteHelper.atmStrike(ttm, vol)
+            strikes[otm] = quoteHelper.strikeForDelta(ttm[otm], delta[otm], vol[otm])
+            self.strikes = [list(k) for k in np.split(strikes, np.cumsum(n)[:-1])]
+
+    def quotes(self):
+        '''
+            the market inputs besides spot and vols, as keyed by the calibration store
+        '''
+        return self.fwdPoints + self.zrDom + self.deltaTypes
+
+
+def calibrateSurface(spot, inputQuotes, iniParams, method, premiumType, objective, starts=1, store=None,
+                     tenorCache=None, surrogate=None, max_workers=None):
+    '''
+        calibrates the quoted surface by method: 'MC', a multi-start of starts > 1 runs (not for 'DE'), the
+        incremental recalibration for 'trf' (or 'lm') or calibrate_to_surface. with a calibration store, stored results of
+        the same quotes are returned as they are and close ones seed the optimizer; max_workers is the size of
+        the multi-start pool. returns the json result of /heston/calibrate
+    '''
+    tStartMethod = dt.datetime.now()
+    if method in hcal.LEAST_SQUARES_METHODS:
+        method = 'trf'
+    surface = QuotedSurface(spot, inputQuotes, premiumType)
+    t, strikes, smiles = surface.t, surface.strikes, surface.smiles
+
+    setup = CalibrationStore.setup(iniParams, method, objective, surface.premiumType, starts)
+    storedParams = storedValue = None
+    if store is not None:
+        with profiling.timer('storeLookup'):
+            storedParams, storedValue = store.lookup(spot, t, smiles, surface.quotes(), setup)
+        if method == 'MC':
+            # a random search is run again, from the stored result
+            storedValue = None
+
+    calibrator = hcal.HestonCalibrator(surface.fxMarket, tenorCache=tenorCache, surrogate=surrogate)
+    tStart = dt.datetime.now()
+    startDiagnostics = None
+    if storedValue is not None:
+        warmStart = 'exact'
+        hParams, optValue = storedParams, storedValue
+    else:
+        warmStart = None
+        if storedParams is not None:
+            warmStart = 'near'
+            iniParams = CalibrationStore.warmStart(iniParams, storedParams)
+        with profiling.timer('calibration'):
+            if method == 'MC':
+                hParams, optValue = calibrator.calibrate_to_surface_mc(t, strikes, smiles, iniParams)
+            elif starts > 1 and method != 'DE':
+                hParams, optValue, startDiagnostics = calibrator.calibrate_to_surface_multistart(
+                    t, strikes, smiles, iniParams, method, objective, nStarts=starts, max_workers=max_workers)
+            elif method == 'trf':
+                hParams, optValue = calibrator.calibrate_to_surface_incremental(t, strikes, smiles, iniParams,
+                                                                                objective)
+            else:
+                hParams, optValue = calibrator.calibrate_to_surface(t, strikes, smiles, iniParams, method,
+                                                                    objective)
+        if store is not None:
+            store.save(spot, t, smiles, surface.quotes(), setup, hParams, optValue)
+    tEnd = dt.datetime.now()
+    profile = profiling.current()
+    if profile is not None:
+        cfCache = calibrator.cfCache.stats()
+        profile.count('cfCacheHits', cfCache['hits'])
+        profile.count('cfCacheMisses', cfCache['misses'])
+
+    result = {
+        'hestonParams': hParams,
+        'objectiveValue': optValue,
+        'warmStart': warmStart,
+        'elapsedCalibration': str(tEnd - tStart),
+        'elapsedTime': str(dt.datetime.now() - tStartMethod)}
+    if startDiagnostics is not None:
+        result['starts'] = startDiagnostics
+    return result
+
+
+def calibrationDiagnostics(profile):
+    '''
+        counters and timers (in seconds) of a profiled calibration; the optimizer overhead is the time of the
+        calibration spent neither in the objective nor in setting up the quotes. work of process pools
+        (multi-start, max_workers) is not profiled
+    '''
+    diagnostics = profile.jsonify()
+    timers = diagnostics['timers']
+    if 'calibration' in timers:
+        timers['optimizerOverhead'] = timers['calibration'] - timers.get('objective', 0.) \
+            - timers.get('context', 0.)
+    return diagnostics
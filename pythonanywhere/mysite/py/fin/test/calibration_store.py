@@ -0,0 +1,78 @@
+'''
+    warm start store round trips
+'''
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from fin.calibration_store import CalibrationStore
+from fin.heston_calibration import HestonParams, HestonCalibrator, EarlyStop
+from fin.test.fixtures import SyntheticSurface
+
+import numpy as np
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = CalibrationStore(os.path.join(self.dir, 'store.sqlite'))
+        self.spot = 1.6235
+        self.t = [0.25, 1.]
+        self.vols = [np.array([0.11, 0.1, 0.105]), np.array([0.12, 0.11, 0.114])]
+        self.quotes = [-60., -254.36, 0.02, 0.025]
+        self.iniParams = {'var0': {'value': 0.02, 'fixed': False},
+                          'kappa': {'value': 1.2, 'fixed': True},
+                          'theta': {'value': 0.02, 'fixed': False},
+                          'xi': {'value': 0.5, 'fixed': False},
+                          'rho': {'value': -0.1, 'fixed': False}}
+        self.setup = CalibrationStore.setup(self.iniParams, 'trf', 'VOL', -1.)
+        self.params = HestonParams(0.012, 1.2, 0.015, 0.3, -0.35)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testLookup(self):
+        self.assertEqual(self.store.lookup(self.spot, self.t, self.vols, self.quotes, self.setup), (None, None))
+        self.store.save(self.spot, self.t, self.vols, self.quotes, self.setup, self.params, 1.e-12)
+
+        # exact match, also from a new store on the same file
+        store = CalibrationStore(self.store.path)
+        params, value = store.lookup(self.spot, self.t, self.vols, self.quotes, self.setup)
+        self.assertEqual(params.jsonify(), self.params.jsonify())
+        self.assertEqual(value, 1.e-12)
+
+        # near match: slightly moved market
+        vols = [vi + 0.002 for vi in self.vols]
+        params, value = store.lookup(self.spot * 1.001, self.t, vols, self.quotes, self.setup)
+        self.assertEqual(params.jsonify(), self.params.jsonify())
+        self.assertTrue(value is None)
+
+        # no match: far away vols, other tenors or another setup
+        vols = [vi + 0.05 for vi in self.vols]
+        self.assertEqual(store.lookup(self.spot, self.t, vols, self.quotes, self.setup), (None, None))
+        self.assertEqual(store.lookup(self.spot, [0.25, 2.], self.vols, self.quotes, self.setup), (None, None))
+        setup = CalibrationStore.setup(self.iniParams, 'trf', 'PV', -1.)
+        self.assertEqual(store.lookup(self.spot, self.t, self.vols, self.quotes, setup), (None, None))
+
+        start = CalibrationStore.warmStart(self.iniParams, HestonParams(0.01, 3., 0.02, 0.4, -0.5))
+        self.assertEqual(start['kappa'], {'value': 1.2, 'fixed': True})
+        self.assertEqual(start['xi'], {'value': 0.4, 'fixed': False})
+        self.assertEqual(self.iniParams['xi']['value'], 0.5)
+
+    def testWarmStartEvaluations(self):
+        surface = SyntheticSurface()
+        calibrator = HestonCalibrator(surface.fxMarket)
+        evaluations = []
+        for iniParams in [surface.iniParams, CalibrationStore.warmStart(surface.iniParams, surface.params)]:
+            monitor = EarlyStop(multiprocessing.Value('d', np.inf), np.inf, np.inf)
+            calibrator.calibrate_to_surface(surface.t, surface.strikes, surface.vols, iniParams, 'trf', 'VOL',
+                                            monitor=monitor)
+            evaluations.append(monitor.nfev)
+        self.assertTrue(evaluations[1] < evaluations[0], evaluations)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+'''
+    synthetic market data shared by the calibration tests
+'''
+from fin.heston_calibration import HestonMarket, HestonParams, FxMarket, InterpolatedZeroCurve, LinearInterpolator, \
+    ForwardCurveFromLinearPoints, ForwardHelper, ForwardCurve
+
+import numpy as np
+
+
+class SyntheticSurface:
+    '''
+        fx market of three tenors with the heston vols of params at five strikes per tenor, and iniParams
+        away from params (kappa fixed at its true value) to calibrate from
+    '''
+
+    def __init__(self):
+        spot = 1.6235
+        self.t = [0.25, 1., 2.]
+        domCurve = InterpolatedZeroCurve(LinearInterpolator(self.t, [0.02, 0.025, 0.03]))
+        fwdPointsCurve = ForwardCurveFromLinearPoints(spot, self.t, [-60., -254.36, -480.])
+        forCurve = ForwardHelper.implyForeignCurve(fwdPointsCurve, domCurve)
+        self.fxMarket = FxMarket(domCurve, forCurve, ForwardCurve(spot, domCurve, forCurve))
+
+        self.params = HestonParams(0.012, 1.2, 0.015, 0.3, -0.35)
+        market = HestonMarket(domCurve, forCurve, self.fxMarket.fwdCurve, self.params)
+        self.strikes = []
+        self.vols = []
+        for ti in self.t:
+            fwd = self.fxMarket.fwdCurve.fwd(ti)
+            ki = fwd * np.exp(0.11 * np.sqrt(ti) * np.array([-1.5, -0.7, 0., 0.7, 1.5]))
+            self.strikes.append(ki)
+            self.vols.append(market.impl_vol(ti, ki))
+
+        self.iniParams = {'var0': {'value': 0.02, 'fixed': False},
+                          'kappa': {'value': 1.2, 'fixed': True},
+                          'theta': {'value': 0.02, 'fixed': False},
+                          'xi': {'value': 0.5, 'fixed': False},
+                          'rho': {'value': -0.1, 'fixed': False}}
+
+    def assertRecovered(self, test, params, places):
+        for name in ['var0', 'kappa', 'theta', 'xi', 'rho']:
+            test.assertAlmostEqual(getattr(params, name), getattr(self.params, name), places=places)
@@ -4,8 +4,10 @@ Created on Nov 27, 2017
 @author: Alexander
 '''
 import unittest
+from fin import lets_be_rational, profiling
 from fin.heston import HestonParams, HestonSingleIntegration, Heston93, \
-    HestonCommonCF, HestonLord, BSParams, BS
+    HestonCommonCF, HestonLord, HestonCarrMadan, HestonCOS, BSParams, BS, \
+    QuadraturePlan, CFCache, DeltaHelper, PremiumType, DeltaType
 
 import numpy as np
 import datetime
@@ -136,6 +138,262 @@ class Test(unittest.TestCase):
 
         self.assertAlmostEquals(pv_bs, pv_h, 7)
 
+    def testVectorizedStrikes(self):
+        p = HestonParams(s0=100.,
+                         v0=0.04,
+                         r=0.02, q=0.01,
+                         vMeanRevSpeed=1.5,
+                         vLongTermMean=0.06,
+                         vVol=0.7,
+                         svCorrelation=-0.5)
+        strikes = np.array([80., 95., 100., 110., 130.])
+        phis = np.array([-1., -1., 1., 1., 1.])
+        t = 0.5
+        # the adaptive quadrature of the scalar pricer, strike by strike
+        expected = [HestonLord(p).vanilla(k, t, phi) for k, phi in zip(strikes, phis)]
+
+        for scheme in ['quad', 'fixed_quad', 'romb', 'romberg', 'quadromb']:
+            pricer = HestonSingleIntegration(p,
+                                             integrationLimit=np.inf if scheme == 'quad' else 400.,
+                                             integrationScheme=scheme)
+            pvs = pricer.vanilla(strikes, t, phis)
+            self.assertEqual(pvs.shape, strikes.shape)
+            for k, phi, pv, ref in zip(strikes, phis, pvs, expected):
+                self.assertAlmostEqual(pv, ref, places=7,
+                                       msg='{}: vanilla(k={}, phi={})'.format(scheme, k, phi))
+
+    def testCarrMadan(self):
+        for p, t in [(HestonParams(s0=100., v0=0.04, r=0.02, q=0.,
+                                   vMeanRevSpeed=1.5, vLongTermMean=0.06,
+                                   vVol=0.7, svCorrelation=0.8), 0.25),
+                     (HestonParams(s0=1.6235, v0=0.01, r=0.02, q=0.01,
+                                   vMeanRevSpeed=1., vLongTermMean=0.01,
+                                   vVol=0.5, svCorrelation=-0.3), 1. / 252),
+                     (HestonParams(s0=1.6235, v0=0.01, r=0.02, q=0.01,
+                                   vMeanRevSpeed=1., vLongTermMean=0.01,
+                                   vVol=1.5, svCorrelation=-0.3), 5.)]:
+            fwd = p.s0 * np.exp((p.r - p.q) * t)
+            strikes = fwd * np.exp(np.sqrt(p.v0 * t) * np.array([-3., -1., 0., 1., 3.]))
+            phis = np.sign(strikes - fwd)
+            pvs = HestonCarrMadan(p).vanilla(strikes, t, phis)
+            expected = HestonSingleIntegration(p).vanilla(strikes, t, phis)
+            for k, pv, v in zip(strikes, pvs, expected):
+                self.assertAlmostEqual(pv / v, 1., places=5,
+                                       msg='fft: vanilla(k={}, t={}; {}) = {} <> {}'.format(k, t, p, pv, v))
+
+    def testCOS(self):
+        for p, t in [(HestonParams(s0=100., v0=0.04, r=0.02, q=0.,
+                                   vMeanRevSpeed=1.5, vLongTermMean=0.06,
+                                   vVol=0.7, svCorrelation=0.8), 0.25),
+                     (HestonParams(s0=1.6235, v0=0.01, r=0.02, q=0.01,
+                                   vMeanRevSpeed=1., vLongTermMean=0.01,
+                                   vVol=0.5, svCorrelation=-0.3), 1. / 252),
+                     (HestonParams(s0=1.6235, v0=0.001, r=0.02, q=0.01,
+                                   vMeanRevSpeed=0.6, vLongTermMean=0.001,
+                                   vVol=0.05, svCorrelation=-0.1), 1.),
+                     (HestonParams(s0=1., v0=0.16, r=0., q=0.,
+                                   vMeanRevSpeed=1., vLongTermMean=0.16,
+                                   vVol=2., svCorrelation=-0.8), 10.)]:
+            fwd = p.s0 * np.exp((p.r - p.q) * t)
+            strikes = fwd * np.exp(np.sqrt(p.v0 * t) * np.array([-3., -1., 0., 1., 3.]))
+            phis = np.sign(strikes - fwd)
+            pvs = HestonCOS(p).vanilla(strikes, t, phis)
+            expected = HestonSingleIntegration(p).vanilla(strikes, t, phis)
+            for k, pv, v in zip(strikes, pvs, expected):
+                self.assertAlmostEqual(pv / p.s0, v / p.s0, places=9,
+                                       msg='cos: vanilla(k={}, t={}; {}) = {} <> {}'.format(k, t, p, pv, v))
+
+        p, k, t, v = HestonParams(s0=100., v0=0.04, r=0.02, q=0.,
+                                  vMeanRevSpeed=1.5, vLongTermMean=0.06,
+                                  vVol=0.7, svCorrelation=0.8), 110., 0.25, 1.680798168853325336
+        self.assertRegression(HestonCOS(p).call(k, t), v, 'cos: Call(k={}, t={}; {})'.format(k, t, p), precision=8)
+
+    def testCOSPopulation(self):
+        # each member priced as if alone, with shared strikes and with strikes of its own
+        v0 = np.array([[0.01], [0.04], [0.16]])
+        xi = np.array([[0.3], [0.7], [1.5]])
+        population = HestonParams(s0=1.6235, v0=v0, r=0.02, q=0.01, vMeanRevSpeed=1.5, vLongTermMean=0.04,
+                                  vVol=xi, svCorrelation=-0.5)
+        shared = np.array([1.4, 1.6, 1.8])
+        own = 1.6235 * np.exp(np.sqrt(v0 * 0.5) * np.array([-2., 0., 2.]))
+        for strikes in [shared, own]:
+            pvs = HestonCOS(population).put(strikes, 0.5)
+            self.assertEqual(pvs.shape, (3, 3))
+            for i in range(3):
+                p = HestonParams(s0=1.6235, v0=v0[i, 0], r=0.02, q=0.01, vMeanRevSpeed=1.5, vLongTermMean=0.04,
+                                 vVol=xi[i, 0], svCorrelation=-0.5)
+                k = np.broadcast_to(strikes, (3, 3))[i]
+                self.assertTrue(np.allclose(pvs[i], HestonCOS(p).put(k, 0.5), rtol=0., atol=1.e-12))
+
+    def testDeltaHelper(self):
+        p = HestonParams(s0=1.6235, v0=0.01, r=0.02, q=0.01,
+                         vMeanRevSpeed=1., vLongTermMean=0.012,
+                         vVol=0.5, svCorrelation=-0.3)
+        helper = DeltaHelper(HestonCOS(p))
+        deltas = np.array([-0.1, -0.25, 0.25, 0.1])
+        for premiumType in [PremiumType.Excluded, PremiumType.Included]:
+            for deltaType in [DeltaType.Spot, DeltaType.Forward]:
+                strikes = helper.strikeForDelta(deltas, 0.5, premiumType, deltaType)
+                self.assertTrue(np.all(np.diff(strikes) > 0.), str(strikes))
+                actual = helper.deltaBS(strikes, 0.5, np.sign(deltas), premiumType, deltaType)
+                self.assertTrue(np.allclose(actual, deltas, rtol=0., atol=1.e-10), str(actual))
+                self.assertAlmostEqual(helper.strikeForDelta(0.25, 0.5, premiumType, deltaType), strikes[2], 9)
+
+                atm = helper.atmStrike(0.5, premiumType, deltaType)
+                self.assertAlmostEqual(helper.deltaBS(atm, 0.5, 1., premiumType, deltaType),
+                                       -helper.deltaBS(atm, 0.5, -1., premiumType, deltaType), 10)
+
+    def testGaussPlan(self):
+        p = HestonParams(s0=100., v0=0.04, r=0.02, q=0.,
+                         vMeanRevSpeed=1.5, vLongTermMean=0.06,
+                         vVol=0.7, svCorrelation=0.8)
+        k, t = 110., 0.25
+        expected = HestonSingleIntegration(p).call(k, t)
+        for pricer in [HestonSingleIntegration(p, integrationScheme='gauss'),
+                       HestonLord(p, integrationScheme='gauss'),
+                       HestonCommonCF(p, integrationScheme='gauss')]:
+            self.assertAlmostEqual(pricer.call(k, t), expected, places=8,
+                                   msg='gauss: {}'.format(type(pricer).__name__))
+
+        # nearby maturities share the cached nodes
+        pricer = HestonSingleIntegration(p, integrationScheme='gauss')
+        self.assertIs(pricer.plan(0.25), pricer.plan(0.26))
+        self.assertIs(pricer.plan(0.25), QuadraturePlan.get('gauss', 24, pricer.plan(0.25).panels))
+
+    def testCFCache(self):
+        p = HestonParams(s0=100., v0=0.04, r=0.02, q=0.,
+                         vMeanRevSpeed=1.5, vLongTermMean=0.06,
+                         vVol=0.7, svCorrelation=0.8)
+        strikes = np.array([90., 100., 110.])
+        t = 0.25
+        cache = CFCache(maxsize=8)
+        for pricer, expected in [(HestonLord(p, integrationScheme='gauss', cfCache=cache),
+                                  HestonLord(p, integrationScheme='gauss').call(100., t)),
+                                 (HestonCommonCF(p, integrationScheme='gauss', cfCache=cache),
+                                  HestonCommonCF(p, integrationScheme='gauss').call(100., t))]:
+            call = pricer.call(100., t)
+            misses = cache.misses
+            self.assertEqual(pricer.put(100., t), call - p.s0 + 100. * np.exp(-p.r * t))
+            self.assertEqual(cache.misses, misses)
+            self.assertEqual(call, expected)
+
+        for pricer in [HestonSingleIntegration(p, integrationScheme='gauss', cfCache=cache),
+                       HestonCOS(p, cfCache=cache)]:
+            hits = cache.hits
+            pvs = pricer.vanilla(strikes, t, np.ones(3))
+            self.assertTrue(np.all(pricer.vanilla(strikes, t, np.ones(3)) == pvs))
+            self.assertTrue(cache.hits > hits)
+        self.assertTrue(len(cache.entries) <= cache.maxsize)
+        self.assertEqual(cache.values, sum(CFCache.valueSize(v) for v in cache.entries.values()))
+
+        # large grids are bounded by the number of values, not of entries
+        small = CFCache(maxsize=8, maxValues=10)
+        for i in range(3):
+            small.get(p, 'grid', (i,), lambda i: np.zeros(4))
+        self.assertEqual(len(small.entries), 2)
+        self.assertEqual(small.values, 8)
+        small.get(p, 'grid', (3,), lambda i: np.zeros(16))
+        self.assertEqual(small.stats()['size'], 0)
+        self.assertEqual(small.values, 0)
+
+        # changed parameters must not hit the stale entries
+        p1 = HestonParams(s0=100., v0=0.05, r=0.02, q=0.,
+                          vMeanRevSpeed=1.5, vLongTermMean=0.06,
+                          vVol=0.7, svCorrelation=0.8)
+        pricer.setParams(p1)
+        self.assertFalse(any(key[0] == p.key() for key in cache.entries))
+        self.assertAlmostEqual(pricer.call(100., t), HestonCOS(p1).call(100., t), places=14)
+
+    def testImpliedVols(self):
+        bs = BS(BSParams(s0=1.6, r=0.02, q=0.01, sVol=0.1))
+        for t in [1. / 252, 0.25, 1., 5.]:
+            fwd = 1.6 * np.exp(0.01 * t)
+            x = np.linspace(-1., 1., 21)
+            strikes = fwd * np.exp(6. * 0.1 * np.sqrt(t) * x)
+            vols = 0.1 + 0.05 * x ** 2
+            cp = np.where(strikes > fwd, 1., -1.)
+            pvs = np.array([BS(BSParams(s0=1.6, r=0.02, q=0.01, sVol=v)).vanilla(k, t, phi)
+                            for k, v, phi in zip(strikes, vols, cp)])
+            iv = bs.impliedVols(strikes, t, pvs, cp)
+            self.assertTrue(np.allclose(iv, vols, rtol=0., atol=1.e-10))
+            for k, pv, phi, v in zip(strikes[::5], pvs[::5], cp[::5], iv[::5]):
+                self.assertAlmostEqual(bs.impliedVol(k, t, pv, phi), v, places=10)
+
+        # outside of the no-arbitrage bounds
+        self.assertTrue(np.isnan(bs.impliedVols(1.5, 1., 0., 1.)))
+        self.assertTrue(np.isnan(bs.impliedVols(1.5, 1., 1.7, 1.)))
+
+    def testImpliedVolsIterations(self):
+        # 200 quotes within 3 std. dev. of the forward, in and out of the money
+        rng = np.random.RandomState(0)
+        t = rng.uniform(0.02, 5., 200)
+        vols = rng.uniform(0.05, 0.8, 200)
+        fwd = 1.6 * np.exp(0.01 * t)
+        strikes = fwd * np.exp(vols * np.sqrt(t) * rng.uniform(-3., 3., 200))
+        cp = np.where(rng.uniform(size=200) < 0.5, 1., -1.)
+        pvs = np.array([BS(BSParams(s0=1.6, r=0.02, q=0.01, sVol=v)).vanilla(k, tt, phi)
+                        for k, tt, v, phi in zip(strikes, t, vols, cp)])
+        for guess, iterations in [(None, 10), (0.01, 14), (2., 10)]:
+            with profiling.recording() as profile:
+                iv = BS(BSParams(s0=1.6, r=0.02, q=0.01, sVol=0.2)).impliedVols(strikes, t, pvs, cp, guess)
+            self.assertTrue(np.allclose(iv, vols, rtol=0., atol=1.e-10))
+            self.assertTrue(profile.counters['impliedVolIterations'] <= iterations, (guess, profile.counters))
+
+    def testLetsBeRational(self):
+        for x in [-10., -3., -0.3, -1.e-3, 0., 0.05, 1., 10.]:
+            for s in [1.e-3, 0.05, 0.3, 1., 4.]:
+                for q in [1., -1.]:
+                    b = lets_be_rational.normalised_black(x, s, q)
+                    v = lets_be_rational.normalised_vega(x, s)
+                    if b < 1.e-280 or v < 1.e-280:
+                        continue
+                    # within a few ulps of what the rounding of b allows
+                    tol = 8. * lets_be_rational.DBL_EPSILON * (b / v + s)
+                    self.assertTrue(abs(lets_be_rational.normalised_implied_volatility(b, x, q) - s) <= tol)
+
+        # short tenors and deep otm wings through the BS interface
+        bs = BS(BSParams(s0=1.6, r=0.02, q=0.01, sVol=0.1))
+        for t in [1. / 365, 7. / 365, 1.]:
+            for k in [1.2, 1.5, 1.6, 1.7, 2.2]:
+                phi = 1. if k > 1.6 else -1.
+                # BS.put goes through parity and loses the relative accuracy of tiny wing prices
+                fwd = 1.6 * np.exp(0.01 * t)
+                pv = np.exp(-0.02 * t) * np.sqrt(fwd * k) \
+                    * lets_be_rational.normalised_black(np.log(fwd / k), 0.25 * np.sqrt(t), phi)
+                if pv < 1.e-200:
+                    continue
+                self.assertAlmostEqual(bs.impliedVol(k, t, pv, phi, method='rational'), 0.25, places=10)
+        self.assertTrue(np.isnan(bs.impliedVol(1.5, 1., 0., 1., method='rational')))
+
+        p = HestonParams(s0=100., v0=0.04, r=0.02, q=0.,
+                         vMeanRevSpeed=1.5, vLongTermMean=0.06,
+                         vVol=0.7, svCorrelation=0.8)
+        pricer = HestonCOS(p)
+        strikes = np.array([60., 90., 100., 110., 160.])
+        self.assertTrue(np.allclose(pricer.smile(strikes, 0.5, method='rational'), pricer.smile(strikes, 0.5),
+                                    rtol=0., atol=1.e-10))
+
+    def testGradient(self):
+        base = dict(s0=100., v0=0.04, r=0.02, q=0.01,
+                    vMeanRevSpeed=1.5, vLongTermMean=0.06,
+                    vVol=0.7, svCorrelation=-0.6)
+        names = ['v0', 'vMeanRevSpeed', 'vLongTermMean', 'vVol', 'svCorrelation']
+        strikes = np.array([70., 90., 100., 110., 140.])
+        for t in [0.1, 1., 5.]:
+            for pricer in [lambda p: HestonCOS(p),
+                           lambda p: HestonSingleIntegration(p, integrationScheme='gauss')]:
+                pv, dpv = pricer(HestonParams(**base)).gradient(strikes, t, -1.)
+                self.assertTrue(np.allclose(pv, pricer(HestonParams(**base)).put(strikes, t), rtol=0., atol=1.e-12))
+                for i, name in enumerate(names):
+                    h = 1.e-5 * max(abs(base[name]), 0.1)
+                    up = dict(base)
+                    up[name] += h
+                    dn = dict(base)
+                    dn[name] -= h
+                    fd = (pricer(HestonParams(**up)).put(strikes, t)
+                          - pricer(HestonParams(**dn)).put(strikes, t)) / (2. * h)
+                    self.assertTrue(np.allclose(dpv[i], fd, rtol=1.e-6, atol=1.e-6), (t, name, dpv[i], fd))
+
     def testImpliedVolComputation(self):
         spot = 1.6235
         v0 = 0.001
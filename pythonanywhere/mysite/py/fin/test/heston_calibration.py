@@ -0,0 +1,249 @@
+'''
+    calibration round trips on synthetic smiles
+'''
+import json
+import multiprocessing
+import unittest
+
+from fin import heston_calibration as hcal
+from fin import profiling
+from fin.heston_calibration import HestonCalibrator, HestonParams, CalibrationContext, LinearInterpolator, EarlyStop, \
+    QuoteHelper, DeltaType, PremiumType
+from fin.test.fixtures import SyntheticSurface
+
+import numpy as np
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.surface = SyntheticSurface()
+        self.fxMarket, self.t, self.strikes, self.vols = \
+            self.surface.fxMarket, self.surface.t, self.surface.strikes, self.surface.vols
+        self.params, self.iniParams = self.surface.params, self.surface.iniParams
+
+    def assertRecovered(self, params, places):
+        self.surface.assertRecovered(self, params, places)
+
+    def testCurves(self):
+        zr = LinearInterpolator(self.t, [0.02, 0.025, 0.03])
+        self.assertEqual(zr(1.), 0.025)
+        self.assertAlmostEqual(zr(0.625), 0.0225, places=15)
+        self.assertAlmostEqual(zr(1.5), 0.0275, places=15)
+        self.assertAlmostEqual(zr(3.), 0.035, places=15)
+        self.assertAlmostEqual(zr(0.), 0.02 - 0.25 * 0.005 / 0.75, places=15)
+
+        t = np.array([0., 0.1, 0.25, 0.5, 1., 1.7, 2., 3.])
+        curve = self.fxMarket.fwdCurve
+        for f in [zr, self.fxMarket.dfDomCurve.df, self.fxMarket.dfForCurve.df, curve.fwd]:
+            values = f(t)
+            self.assertEqual(values.shape, t.shape)
+            self.assertTrue(np.allclose(values, [f(ti) for ti in t], rtol=1.e-15, atol=0.))
+        # the forward points are matched at the pillars
+        self.assertTrue(np.allclose(curve.fwd(np.array(self.t)), 1.6235 + np.array([-60., -254.36, -480.]) / 1.e4,
+                                    rtol=1.e-14))
+
+    def testQuoteHelper(self):
+        # all the pillars of all tenors, with spot deltas up to one year
+        ttm = np.repeat(self.t, 4)
+        delta = np.tile([-0.1, -0.25, 0.25, 0.1], len(self.t))
+        vol = 0.1 + 0.3 * delta ** 2.
+        deltaType = np.where(ttm <= 1., DeltaType.Spot, DeltaType.Forward)
+        for premiumType in [PremiumType.Excluded, PremiumType.Included]:
+            helper = QuoteHelper(self.fxMarket, deltaType, premiumType)
+            strikes = helper.strikeForDelta(ttm, delta, vol)
+            self.assertTrue(np.allclose(helper.deltaBS(np.sign(delta), ttm, strikes, vol), delta, rtol=0., atol=1.e-12))
+            for i in [0, 6, 11]:
+                scalar = QuoteHelper(self.fxMarket, deltaType[i], premiumType)
+                self.assertAlmostEqual(scalar.strikeForDelta(ttm[i], delta[i], vol[i]) / strikes[i], 1., places=14)
+            atm = helper.atmStrike(ttm, vol)
+            self.assertEqual(atm[4], QuoteHelper(self.fxMarket, DeltaType.Spot, premiumType).atmStrike(1., vol[4]))
+
+    def testLeastSquares(self):
+        calibrator = HestonCalibrator(self.fxMarket)
+        for objective in ['PV', 'VOL']:
+            params, err = calibrator.calibrate_to_surface(self.t, self.strikes, self.vols, self.iniParams,
+                                                          method='trf', objective=objective)
+            self.assertRecovered(params, 5)
+            self.assertTrue(err < 1.e-14)
+        # the former name of the method
+        lm = calibrator.calibrate_to_surface(self.t, self.strikes, self.vols, self.iniParams, 'lm', 'VOL')
+        trf = calibrator.calibrate_to_surface(self.t, self.strikes, self.vols, self.iniParams, 'trf', 'VOL')
+        self.assertEqual((lm[0].jsonify(), lm[1]), (trf[0].jsonify(), trf[1]))
+
+    def testGradientMethod(self):
+        calibrator = HestonCalibrator(self.fxMarket)
+        params, err = calibrator.calibrate_to_surface(self.t, self.strikes, self.vols, self.iniParams,
+                                                      method='BFGS', objective='PV')
+        self.assertRecovered(params, 3)
+        # finite differences for the schemes without analytic gradients
+        params, err = HestonCalibrator(self.fxMarket, 'romb').calibrate_to_surface(
+            self.t, self.strikes, self.vols, self.iniParams, method='BFGS', objective='PV')
+        self.assertRecovered(params, 2)
+        self.assertTrue(err < 1.e-8)
+
+    def testVegaObjective(self):
+        calibrator = HestonCalibrator(self.fxMarket)
+        ctx = calibrator.context(self.t, self.strikes, self.vols)
+        # close to the solution vega weighted price residuals are vol residuals to first order
+        params = HestonParams(0.0121, 1.2, 0.0151, 0.302, -0.352)
+        for (vega, _), (vol, _) in zip(calibrator.residuals(ctx, params, 'VEGA'),
+                                       calibrator.residuals(ctx, params, 'VOL')):
+            self.assertTrue(np.allclose(vega, vol, rtol=0.05, atol=1.e-5), (vega, vol))
+
+        params, err = calibrator.calibrate_to_surface(self.t, self.strikes, self.vols, self.iniParams,
+                                                      method='BFGS', objective='VEGA')
+        self.assertRecovered(params, 3)
+
+    def testVolFallback(self):
+        # without variance the model pvs of the wings are below intrinsic, they have no implied vol
+        calibrator = HestonCalibrator(self.fxMarket)
+        ctx = calibrator.context(self.t, self.strikes, self.vols)
+        params = HestonParams(1.e-6, 1.2, 1.e-6, 0.01, -0.3)
+        for gradient in [False, True]:
+            vols = calibrator.residuals(ctx, params, 'VOL', gradient=gradient)
+            vegas = calibrator.residuals(ctx, params, 'VEGA', gradient=gradient)
+            for i, ((vol, dvol), (vega, dvega)) in enumerate(zip(vols, vegas)):
+                failed = np.isnan(ctx.bs(i).impliedVols(ctx.strikes[i], ctx.t[i], ctx.pvs(i), ctx.callput[i]))
+                self.assertTrue(np.all(np.isfinite(vol)))
+                self.assertTrue(np.array_equal(vol[failed], vega[failed]))
+                if gradient:
+                    self.assertTrue(np.array_equal(dvol[:, failed], dvega[:, failed]))
+        self.assertTrue(failed.any())
+
+    def testPvsGradient(self):
+        calibrator = HestonCalibrator(self.fxMarket)
+        calibrator.iniParams = self.iniParams
+        x = np.array(calibrator.getIniParams(self.iniParams))
+        for natural in [False, True]:
+            if natural:
+                x = np.array(calibrator.getNaturalIniParams(self.iniParams))
+            pv, dpv = calibrator.pvs_gradient(1., self.strikes[1], x, natural)
+            for i in xrange(len(x)):
+                h = 1.e-6 * max(abs(x[i]), 1.e-2)
+                up = x.copy()
+                up[i] += h
+                dn = x.copy()
+                dn[i] -= h
+                fd = (calibrator.pvs_gradient(1., self.strikes[1], up, natural)[0]
+                      - calibrator.pvs_gradient(1., self.strikes[1], dn, natural)[0]) / (2. * h)
+                self.assertTrue(np.allclose(dpv[i], fd, rtol=1.e-5, atol=1.e-9), (natural, i, dpv[i], fd))
+
+    def testPopulationResiduals(self):
+        calibrator = HestonCalibrator(self.fxMarket)
+        calibrator.iniParams = self.iniParams
+        ctx = calibrator.context(self.t, self.strikes, self.vols)
+        population = CalibrationContext(self.fxMarket, self.t, self.strikes, self.vols)
+        X = np.log([[0.012, 0.015, 0.3], [1.e-6, 0.2, 2.], [0.5, 1.e-4, 0.01]])
+        X = np.column_stack([X, [-0.35, 1.5, -2.]])
+        population.setParams(calibrator.getHestonParams(X.T[:, :, np.newaxis]))
+        for objective in ['PV', 'VOL']:
+            for i in population.tenors():
+                res, _ = population.residuals(i, objective, True)
+                for x, resx in zip(X, res):
+                    ctx.setParams(calibrator.getHestonParams(x))
+                    self.assertTrue(np.allclose(resx, ctx.residuals(i, objective, True)[0], rtol=1.e-10, atol=1.e-12))
+
+    def testDifferentialEvolution(self):
+        calibrator = HestonCalibrator(self.fxMarket)
+        results = [calibrator.calibrate_to_surface_de(self.t, self.strikes, self.vols, self.iniParams, 'VOL', seed=7,
+                                                      popsize=5, maxiter=10) for _ in xrange(2)]
+        self.assertEqual(results[0][1], results[1][1])
+        self.assertEqual(results[0][0].jsonify(), results[1][0].jsonify())
+        self.assertRecovered(results[0][0], 5)
+
+    def testMultiStart(self):
+        calibrator = HestonCalibrator(self.fxMarket)
+        results = [calibrator.calibrate_to_surface_multistart(self.t, self.strikes, self.vols, self.iniParams, 'trf',
+                                                              'VOL', nStarts=4, seed=3, max_workers=1)
+                   for _ in xrange(2)]
+        params, err, diagnostics = results[0]
+        self.assertRecovered(params, 5)
+        self.assertEqual(len(diagnostics), 4)
+        self.assertEqual(diagnostics[0]['iniParams']['xi'], self.iniParams['xi']['value'])
+        self.assertTrue(all(d['iniParams']['kappa'] == 1.2 for d in diagnostics))
+        self.assertTrue(all(d['status'] in ('finished', 'aborted', 'failed') for d in diagnostics))
+        self.assertEqual(err, min(d['objectiveValue'] for d in diagnostics if d['status'] == 'finished'))
+        self.assertEqual(err, results[1][1])
+        self.assertEqual([d['status'] for d in diagnostics], [d['status'] for d in results[1][2]])
+
+    def testFailedStart(self):
+        # no surrogate: the run fails before its first evaluation, json has no infinity
+        calibrator = HestonCalibrator(self.fxMarket)
+        task = (0, self.iniParams, self.t, self.strikes, self.vols, 'surrogate', 'VOL', True, 50, 10.)
+        diagnostics = hcal._runStart(calibrator, multiprocessing.Value('d', np.inf), task)
+        self.assertEqual(diagnostics['status'], 'failed')
+        self.assertTrue(diagnostics['objectiveValue'] is None)
+        json.dumps(diagnostics, allow_nan=False)
+
+    def testIncremental(self):
+        calibrator = HestonCalibrator(self.fxMarket)
+        params, err = calibrator.calibrate_to_surface_incremental(self.t, self.strikes, self.vols, self.iniParams,
+                                                                  'VOL')
+        self.assertRecovered(params, 5)
+
+        # restart from the solution, nothing to do
+        iniParams = dict((name, {'value': getattr(params, name), 'fixed': self.iniParams[name]['fixed']})
+                         for name in self.iniParams)
+        params1, err1 = calibrator.calibrate_to_surface_incremental(self.t, self.strikes, self.vols, iniParams,
+                                                                    'VOL')
+        self.assertEqual(params1.jsonify(), params.jsonify())
+        self.assertEqual(err1, err)
+
+        # one tenor edited: close to the full least squares from the same start
+        vols = list(self.vols)
+        vols[1] = vols[1] + np.array([0.001, 0.0005, 0., 0.0007, 0.0015])
+        params2, err2 = calibrator.calibrate_to_surface_incremental(self.t, self.strikes, vols, iniParams, 'VOL')
+        params3, err3 = calibrator.calibrate_to_surface_trf(self.t, self.strikes, vols, iniParams, 'VOL')
+        self.assertTrue(err2 < err3 * 1.001, (err2, err3))
+        for name in ['var0', 'theta', 'xi', 'rho']:
+            self.assertAlmostEqual(getattr(params2, name), getattr(params3, name), places=3)
+
+    def testTenorPool(self):
+        serial = HestonCalibrator(self.fxMarket)
+        parallel = HestonCalibrator(self.fxMarket, max_workers=2)
+        try:
+            ctx = serial.context(self.t, self.strikes, self.vols)
+            for objective in ['PV', 'VOL']:
+                for gradient in [False, True]:
+                    expected = serial.residuals(ctx, self.params, objective, gradient=gradient)
+                    actual = parallel.residuals(ctx, self.params, objective, gradient=gradient)
+                    for (res, dres), (res1, dres1) in zip(expected, actual):
+                        self.assertTrue(np.all(res == res1))
+                        self.assertTrue(dres is None and dres1 is None or np.all(dres == dres1))
+
+            expected = serial.calibrate_to_surface(self.t, self.strikes, self.vols, self.iniParams,
+                                                   method='BFGS', objective='PV')
+            actual = parallel.calibrate_to_surface(self.t, self.strikes, self.vols, self.iniParams,
+                                                   method='BFGS', objective='PV')
+            self.assertEqual(actual[1], expected[1])
+            self.assertEqual(actual[0].jsonify(), expected[0].jsonify())
+        finally:
+            parallel.close()
+
+    def testProfiling(self):
+        calibrator = HestonCalibrator(self.fxMarket)
+        monitor = EarlyStop(multiprocessing.Value('d', np.inf), np.inf, np.inf)
+        with profiling.recording() as profile:
+            params, err = calibrator.calibrate_to_surface(self.t, self.strikes, self.vols, self.iniParams, 'trf', 'VOL',
+                                                          monitor=monitor)
+        self.assertTrue(profiling.current() is None)
+        self.assertRecovered(params, 5)
+
+        counters, timers = profile.jsonify()['counters'], profile.jsonify()['timers']
+        self.assertEqual(counters['objectiveCalls'], monitor.nfev)
+        self.assertEqual(counters['gradientCalls'], monitor.nfev)
+        # one pricer per tenor, repriced with new parameters on every call
+        self.assertEqual(counters['pricers'], len(self.t))
+        self.assertTrue(counters['cfEvaluations'] > 0 and counters['quadratureNodes'] > 0)
+        self.assertEqual(counters['impliedVolSolves'], monitor.nfev * sum(len(ki) for ki in self.strikes))
+        self.assertTrue(0. < timers['objective'])
+        self.assertTrue('context' in timers)
+
+        # nothing recorded outside of recording()
+        calibrator.calibrate_to_surface(self.t, self.strikes, self.vols, self.iniParams, 'trf', 'VOL')
+        self.assertEqual(profile.jsonify()['counters'], counters)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+'''
+    monte carlo of the heston model
+'''
+import unittest
+
+from fin import heston
+from fin import heston_mc
+from fin.heston_mc import HestonMC, BSMC, BrownianBridge, Sobol, Vanilla, Asian, Barrier, Moments
+
+import numpy as np
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        # strongly correlated, far from feller: both branches of the qe scheme are used
+        self.params = heston.HestonParams(1., 0.04, 0.02, 0.01, 1.5, 0.04, 0.6, -0.7)
+        self.mc = HestonMC(self.params, seed=3)
+        self.nPaths = 2 ** 16
+
+    def testForward(self):
+        pv, stderr = self.mc.price(Vanilla(0., 1.), self.nPaths)
+        self.assertTrue(abs(pv - np.exp(-self.params.q)) < 4. * stderr, (pv, stderr))
+
+    def testVanilla(self):
+        lord = heston.HestonLord(self.params)
+        for strike in [0.8, 1., 1.2]:
+            for callput in [1., -1.]:
+                pv, stderr = self.mc.price(Vanilla(strike, 1., callput), self.nPaths)
+                exact = lord.vanilla(strike, 1., callput)
+                self.assertTrue(abs(pv - exact) < 4. * stderr, (strike, callput, pv, exact, stderr))
+
+    def testControlVariate(self):
+        # an asian with its only fixing at maturity is the vanilla, the control variate makes it exact
+        pv, stderr = self.mc.price(Asian(1., [1.]), self.nPaths)
+        self.assertAlmostEqual(pv, heston.HestonLord(self.params).call(1., 1.), 12)
+        self.assertTrue(stderr < 1.e-12)
+
+        asian = Asian(1., [0.25, 0.5, 0.75, 1.])
+        pv, stderr = self.mc.price(asian, self.nPaths)
+        pvPlain, stderrPlain = self.mc.price(asian, self.nPaths, controlVariate=False)
+        self.assertTrue(stderr < 0.7 * stderrPlain, (stderr, stderrPlain))
+        self.assertTrue(abs(pv - pvPlain) < 4. * stderrPlain)
+
+    def testBarrier(self):
+        # knock-in and knock-out add up to the vanilla path by path
+        out = Barrier(1., 0.5, 1.15)
+        knockIn = Barrier(1., 0.5, 1.15, knockIn=True)
+        pvOut, pvIn, pvVanilla = self.mc.moments([out, knockIn, Vanilla(1., 0.5)], self.nPaths).mean
+        self.assertAlmostEqual(pvOut + pvIn, pvVanilla, 12)
+        self.assertTrue(0. < pvOut < pvVanilla)
+        # a barrier far away never knocks out
+        pv, stderr = self.mc.price(Barrier(1., 0.5, 10.), self.nPaths)
+        self.assertAlmostEqual(pv, heston.HestonLord(self.params).call(1., 0.5), 12)
+
+    def testChunks(self):
+        # the chunks are reproducible one by one, and their moments merge into those of all the samples
+        payoffs = [Vanilla(1., 0.5), Vanilla(0.9, 0.5, -1.)]
+        mc = HestonMC(self.params, chunkSize=2 ** 10, seed=5)
+        self.assertTrue(np.array_equal(mc.simulate(payoffs, 2, 2 ** 10), mc.simulate(payoffs, 2, 2 ** 10)))
+        samples = np.hstack([mc.simulate(payoffs, chunk, n) for chunk, n in mc.chunks(5000)])
+        moments = mc.moments(payoffs, 5000)
+        self.assertEqual(moments.n, 2500)
+        self.assertTrue(np.allclose(moments.mean, samples.mean(axis=1), rtol=1.e-12))
+        self.assertTrue(np.allclose(moments.covariance(), np.cov(samples), rtol=1.e-10))
+        self.assertTrue(np.allclose(Moments.of(samples).covariance(), np.cov(samples), rtol=1.e-12))
+
+    def testWorkers(self):
+        # the same chunks in the same order, whoever simulates them
+        mc = HestonMC(self.params, chunkSize=2 ** 12, seed=7)
+        asian = Asian(1., [0.25, 0.5])
+        single = mc.price(asian, 2 ** 14)
+        for workers in [2, 3]:
+            self.assertEqual(mc.price(asian, 2 ** 14, workers=workers), single)
+
+    def testTolerance(self):
+        mc = HestonMC(self.params, chunkSize=2 ** 12, seed=7)
+        payoffs = [Vanilla(1., 0.5)]
+        stop = lambda moments: 1.96 * np.sqrt(moments.covariance()[0, 0] / moments.n) <= 5.e-4
+        moments = mc.moments(payoffs, 2 ** 20, stop=stop)
+        self.assertTrue(stop(moments))
+        self.assertTrue(moments.n < 2 ** 19)
+        self.assertEqual(moments.n % 2 ** 11, 0)
+        # the stop is decided on the merged chunks in order
+        self.assertTrue(np.array_equal(mc.moments(payoffs, 2 ** 20, workers=2, stop=stop).mean, moments.mean))
+
+        pv, stderr = mc.price(Vanilla(1., 0.5), 2 ** 20, tolerance=5.e-4)
+        self.assertTrue(1.96 * stderr <= 5.e-4)
+        self.assertTrue(abs(pv - heston.HestonLord(self.params).call(1., 0.5)) < 4. * stderr)
+
+    def testBrownianBridge(self):
+        # the map of the normals to the normalized increments is orthogonal, on any grid
+        grid = [0., 0.01, 0.1, 0.25, 0.3, 0.5, 0.9, 1.]
+        increments = BrownianBridge(grid).increments(np.eye(len(grid) - 1))
+        self.assertTrue(np.allclose(increments.dot(increments.T), np.eye(len(grid) - 1)))
+        # the first normal sets the end point
+        z = np.zeros((len(grid) - 1, 3))
+        z[0] = [-1., 0., 2.]
+        w = np.cumsum(BrownianBridge(grid).increments(z) * np.sqrt(np.diff(grid))[:, np.newaxis], axis=0)
+        self.assertTrue(np.allclose(w[-1], z[0]))
+        self.assertTrue(np.allclose(w, np.outer(grid[1:], z[0])))
+
+    def testBS(self):
+        params = heston.BSParams(1., 0.02, 0.01, 0.2)
+        mc = BSMC(params, seed=1)
+        self.assertEqual(list(mc.grid([0.5, 1.])), [0., 0.5, 1.])
+        pv, stderr = mc.price(Vanilla(1.1, 1.), self.nPaths)
+        self.assertTrue(abs(pv - heston.BS(params).call(1.1, 1.)) < 4. * stderr)
+        # heston without vol of variance, where the fourier pricers of the control variate are inaccurate
+        hestonMC = HestonMC(heston.HestonParams(1., 0.04, 0.02, 0.01, 1., 0.04, 1.e-8, 0.), seed=1)
+        asian = Asian(1., [0.25, 0.5, 0.75, 1.])
+        pvBS, stderrBS = mc.price(asian, self.nPaths, controlVariate=False)
+        pvHeston, stderrHeston = hestonMC.price(asian, self.nPaths, controlVariate=False)
+        self.assertTrue(abs(pvBS - pvHeston) < 4. * np.hypot(stderrBS, stderrHeston))
+
+    def testSobol(self):
+        self.assertTrue(np.allclose(Sobol(3).points(0, 4), [[0., 0., 0.], [0.5, 0.5, 0.5], [0.75, 0.25, 0.25],
+                                                            [0.25, 0.75, 0.75]], rtol=0., atol=2. ** -32))
+        for seed in [None, 3]:
+            sobol = Sobol(100, seed)
+            u = sobol.points(0, 2 ** 10)
+            # every coordinate has a point in each of the 2 ** 10 cells, the first two a point in every box of
+            # 2 ** -a by 2 ** (a - 10)
+            for d in xrange(100):
+                self.assertEqual(len(set(np.floor(u[:, d] * 2 ** 10))), 2 ** 10)
+            for a in xrange(11):
+                self.assertEqual(len(set(zip(np.floor(u[:, 0] * 2 ** a), np.floor(u[:, 1] * 2 ** (10 - a))))), 2 ** 10)
+            self.assertTrue(np.array_equal(sobol.points(700, 324), u[700:]))
+        self.assertRaises(ValueError, Sobol, 1025)
+
+    def testRQMC(self):
+        asian = Asian(1., [0.25, 0.5, 0.75, 1.])
+        mc = HestonMC(self.params, chunkSize=2 ** 10, seed=2)
+        pv, stderr = mc.priceRQMC(asian, 2 ** 12, scrambles=8, controlVariate=False)
+        pvMC, stderrMC = HestonMC(self.params, seed=2).price(asian, 2 ** 16, controlVariate=False)
+        self.assertTrue(abs(pv - pvMC) < 4. * np.hypot(stderr, stderrMC))
+        # 8 scrambles of 4096 points beat 65536 pseudo random paths
+        self.assertTrue(stderr < stderrMC, (stderr, stderrMC))
+        # the points of a chunk follow from its first index
+        sobol = heston_mc.SobolBridge(3)
+        grid = mc.grid([0.5])
+        whole = sobol.normals(0, 0, grid, 2, 2 ** 10)
+        self.assertTrue(np.allclose(sobol.normals(1, 2 ** 9, grid, 2, 2 ** 9), whole[:, :, 2 ** 9:]))
+
+
+if __name__ == "__main__":
+    unittest.main()
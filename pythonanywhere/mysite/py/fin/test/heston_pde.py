@@ -0,0 +1,83 @@
+'''
+    adi finite differences of the heston pde
+'''
+import unittest
+
+from fin import heston
+from fin import heston_calibration as hcal
+from fin.heston_pde import HestonADI, sinhGrid
+
+import numpy as np
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.params = heston.HestonParams(1., 0.04, 0.02, 0.01, 1.5, 0.04, 0.6, -0.7)
+        self.strikes = np.array([0.8, 0.9, 1., 1.1, 1.2])
+        self.ttms = [0.5, 0.25, 1.]
+
+    def testGrid(self):
+        s = sinhGrid(0., 8., 1., 100, 0.2)
+        self.assertEqual((s[0], s[-1], len(s)), (0., 8., 101))
+        h = np.diff(s)
+        self.assertTrue(np.all(h > 0.))
+        # dense around the center
+        self.assertTrue(h[np.searchsorted(s, 1.)] < 0.05 * h[-1])
+
+    def testEuropean(self):
+        pde = HestonADI(self.params)
+        cos = heston.HestonCOS(self.params)
+        for callput in [1., -1.]:
+            pvs = pde.price(self.strikes, self.ttms, callput)
+            self.assertEqual(pvs.shape, (3, 5))
+            for ttm, pv in zip(self.ttms, pvs):
+                exact = cos.vanilla(self.strikes, ttm, callput)
+                self.assertTrue(np.max(np.abs(pv - exact)) < 2.e-4, (ttm, pv - exact))
+        # the tenors are read off the same march
+        self.assertTrue(np.array_equal(pde.price(self.strikes, 0.25, -1.)[0], pvs[1]))
+
+    def testCurves(self):
+        spot = 1.
+        domCurve = hcal.InterpolatedZeroCurve(hcal.LinearInterpolator([0.25, 1.], [0.02, 0.03]))
+        forCurve = hcal.InterpolatedZeroCurve(hcal.LinearInterpolator([0.25, 1.], [0.01, 0.005]))
+        fwdCurve = hcal.ForwardCurve(spot, domCurve, forCurve)
+        market = hcal.HestonMarket(domCurve, forCurve, fwdCurve, hcal.HestonParams(0.04, 1.5, 0.04, 0.6, -0.7))
+        pde = HestonADI.fromMarket(market)
+        pvs = pde.price(self.strikes, self.ttms)
+        for ttm, pv in zip(self.ttms, pvs):
+            exact = market.vanilla(ttm, self.strikes, 1.)
+            self.assertTrue(np.max(np.abs(pv - exact)) < 2.e-4, (ttm, pv - exact))
+
+    def testAmerican(self):
+        # clarke and parrott (1999)
+        params = heston.HestonParams(10., 0.0625, 0.1, 0., 5., 0.16, 0.9, 0.1)
+        for spot, pv in [(8., 2.), (9., 1.107641), (10., 0.520030), (11., 0.213668), (12., 0.082036)]:
+            params.s0 = spot
+            self.assertAlmostEqual(HestonADI(params, dt=0.0025).price(10., 0.25, -1., american=True)[0, 0],
+                                   pv, delta=1.e-3)
+        # worth more than the european one, not for calls without dividends
+        params.s0 = 10.
+        pde = HestonADI(params)
+        self.assertTrue(pde.price(10., 0.25, -1., american=True) > pde.price(10., 0.25, -1.) + 1.e-2)
+        self.assertAlmostEqual(pde.price(10., 0.25, 1., american=True)[0, 0], pde.price(10., 0.25, 1.)[0, 0], 5)
+
+    def testBarrier(self):
+        pde = HestonADI(self.params)
+        vanilla = pde.price(self.strikes, self.ttms)
+        upOut = pde.price(self.strikes, self.ttms, barrier=1.25)
+        self.assertTrue(np.all(upOut < vanilla))
+        self.assertTrue(np.all(upOut > 0.))
+        # heston_mc, 2 ** 15 paths monitored hourly with the barrier shifted by 0.5826 vol sqrt(dt)
+        self.assertAlmostEqual(upOut[0, 2], 0.04755, delta=1.e-3)
+        # never reached
+        far = pde.price(self.strikes, self.ttms, -1., barrier=0.05, up=False)
+        self.assertTrue(np.allclose(far, pde.price(self.strikes, self.ttms, -1.), atol=2.e-4))
+        # knocked out already
+        self.assertTrue(np.array_equal(pde.price(self.strikes, self.ttms, barrier=1.), np.zeros((3, 5))))
+        self.assertTrue(np.array_equal(pde.price(self.strikes, self.ttms, -1., barrier=1.1, up=False),
+                                       np.zeros((3, 5))))
+
+
+if __name__ == "__main__":
+    unittest.main()
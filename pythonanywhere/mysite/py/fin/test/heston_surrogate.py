@@ -0,0 +1,77 @@
+'''
+    chebyshev surrogate of the implied vols
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from fin import heston
+from fin.heston_surrogate import ChebyshevSurrogate
+from fin.heston_calibration import HestonCalibrator
+from fin.test.fixtures import SyntheticSurface
+
+import numpy as np
+
+
+class Test(unittest.TestCase):
+
+    # a small box around the parameters of the calibration tests
+    lower = (-2.5, 0.45, 0.08, 1., 0.08, 0.1, -0.7)
+    upper = (2.5, 1.45, 0.15, 1.5, 0.15, 0.5, 0.)
+    nodes = (10, 5, 4, 3, 4, 4, 4)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.surrogate = ChebyshevSurrogate.train(cls.nodes, cls.lower, cls.upper)
+
+    def testAccuracy(self):
+        rng = np.random.RandomState(1)
+        for _ in xrange(10):
+            sqrtT, sqrtV0, kappa, sqrtTheta, xi, rho = rng.uniform(self.lower[1:], self.upper[1:])
+            ttm = sqrtT ** 2.
+            k = np.linspace(-0.15, 0.15, 7) * sqrtT
+            model = heston.HestonCOS(heston.HestonParams(1., sqrtV0 ** 2., 0., 0., kappa, sqrtTheta ** 2., xi, rho))
+            exact = model.smile(np.exp(k), ttm)
+            vols = self.surrogate.impliedVols(ttm, k, sqrtV0 ** 2., kappa, sqrtTheta ** 2., xi, rho)
+            self.assertTrue(np.max(np.abs(vols - exact)) < 1.e-3, (vols, exact))
+
+    def testSaveLoad(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'surrogate.npz')
+            self.surrogate.save(path)
+            loaded = ChebyshevSurrogate.load(path)
+        finally:
+            shutil.rmtree(folder)
+        self.assertTrue(np.all(loaded.coefficients == self.surrogate.coefficients))
+        self.assertTrue(np.all(loaded.lower == self.surrogate.lower))
+        self.assertTrue(np.all(loaded.upper == self.surrogate.upper))
+        self.assertEqual(loaded.bounds('var0'), (self.lower[2] ** 2., self.upper[2] ** 2.))
+        self.assertEqual(loaded.bounds('rho'), (self.lower[6], self.upper[6]))
+
+    def testCalibration(self):
+        surface = SyntheticSurface()
+        calibrator = HestonCalibrator(surface.fxMarket, surrogate=self.surrogate)
+        for objective in ['VOL', 'VEGA']:
+            params, err = calibrator.calibrate_to_surface(surface.t, surface.strikes, surface.vols,
+                                                          surface.iniParams, 'surrogate', objective)
+            surface.assertRecovered(self, params, 5)
+
+        self.assertRaises(ValueError, HestonCalibrator(surface.fxMarket).calibrate_to_surface,
+                          surface.t, surface.strikes, surface.vols, surface.iniParams, 'surrogate', 'VOL')
+
+    def testMultiStart(self):
+        # the pool workers get the surrogate, the exact polish reports to the monitor
+        surface = SyntheticSurface()
+        calibrator = HestonCalibrator(surface.fxMarket, surrogate=self.surrogate)
+        params, err, diagnostics = calibrator.calibrate_to_surface_multistart(
+            surface.t, surface.strikes, surface.vols, surface.iniParams, 'Surrogate', 'VOL', nStarts=3, seed=1,
+            max_workers=2, abortAfter=np.inf)
+        self.assertEqual([d['status'] for d in diagnostics], ['finished'] * 3)
+        self.assertTrue(all(d['evaluations'] > 0 for d in diagnostics))
+        surface.assertRecovered(self, params, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+'''
+    calibration of quoted surfaces, one by one and in batches
+'''
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import batch_calibration
+from fin.calibration_store import CalibrationStore
+from fin.heston_calibration import DeltaType
+from fin.surface_calibration import QuotedSurface, calibrateSurface
+
+import numpy as np
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.spot = 1.6235
+        self.quotes = [{'tenor': '3M', 'df': 0.995, 'fwd': -60., 'atm': 2.5, 'rr25': -0.3, 'bf25': 0.12,
+                        'deltaType': 'Spot'},
+                       {'tenor': '1Y', 'df': 0.975420395, 'fwd': -254.36, 'atm': 2.975, 'rr25': -0.35,
+                        'bf25': 0.15, 'rr10': -0.63, 'bf10': 0.525, 'deltaType': 'Forward'}]
+        self.iniParams = {'var0': {'value': 0.001, 'fixed': False},
+                          'kappa': {'value': 0.6666667, 'fixed': True},
+                          'theta': {'value': 0.001, 'fixed': False},
+                          'xi': {'value': 0.1, 'fixed': False},
+                          'rho': {'value': -0.2, 'fixed': False}}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testQuotedSurface(self):
+        surface = QuotedSurface(self.spot, self.quotes, 'Excluded')
+        self.assertEqual(surface.t, [0.25, 1.])
+        self.assertEqual(surface.deltaTypes, [DeltaType.Spot, DeltaType.Forward])
+        self.assertEqual([len(k) for k in surface.strikes], [3, 5])
+        self.assertAlmostEqual(surface.smiles[1][2], 0.02975)
+        self.assertAlmostEqual(surface.fwdCurve.fwd(0.25), self.spot - 0.006)
+        self.assertAlmostEqual(surface.fwdCurve.fwd(1.), self.spot - 0.025436)
+        for ki in surface.strikes:
+            self.assertTrue(np.all(np.diff(ki) > 0.), ki)
+
+    def testStore(self):
+        store = CalibrationStore(os.path.join(self.dir, 'store.sqlite'))
+        first = calibrateSurface(self.spot, self.quotes, self.iniParams, 'trf', 'Excluded', 'VOL', store=store)
+        second = calibrateSurface(self.spot, self.quotes, self.iniParams, 'trf', 'Excluded', 'VOL', store=store)
+        self.assertTrue(first['warmStart'] is None)
+        self.assertEqual(second['warmStart'], 'exact')
+        self.assertEqual(calibrateSurface(self.spot, self.quotes, self.iniParams, 'lm', 'Excluded', 'VOL',
+                                          store=store)['warmStart'], 'exact')
+        self.assertEqual(second['objectiveValue'], first['objectiveValue'])
+        self.assertTrue(first['objectiveValue'] < 1.e-6)
+
+        # a multi-start runs even if the single start is stored, the random search always runs
+        multi = calibrateSurface(self.spot, self.quotes, self.iniParams, 'trf', 'Excluded', 'VOL', starts=2,
+                                 store=store, max_workers=1)
+        self.assertTrue(multi['warmStart'] is None)
+        self.assertEqual(len(multi['starts']), 2)
+        for _ in xrange(2):
+            mc = calibrateSurface(self.spot, self.quotes, self.iniParams, 'MC', 'Excluded', 'VOL', store=store)
+        self.assertEqual(mc['warmStart'], 'near')
+
+    def testBatch(self):
+        inputPath = os.path.join(self.dir, 'surfaces.jsonl')
+        outputPath = os.path.join(self.dir, 'results.jsonl')
+        bad = [dict(q, tenor='7Y') for q in self.quotes]
+        with open(inputPath, 'w') as f:
+            for surface in [{'id': 'GBPUSD', 'spot': self.spot, 'input_quotes': self.quotes},
+                            {'id': 'BAD', 'spot': self.spot, 'input_quotes': bad},
+                            {'spot': self.spot, 'input_quotes': self.quotes, 'method': 'BFGS'}]:
+                surface['ini_params'] = self.iniParams
+                f.write(json.dumps(surface) + '\n')
+        defaults = {'method': 'trf', 'objective': 'VOL', 'premium_type': 'Excluded', 'starts': 1}
+
+        # an interrupted run: one result and half a line
+        first = json.dumps({'id': 'GBPUSD', 'status': 'ok', 'elapsed': 0., 'result': {}})
+        with open(outputPath, 'w') as f:
+            f.write(first + '\n{"id": "surfaces.jsonl:3", "sta')
+
+        progress = []
+        summary = batch_calibration.run(inputPath, outputPath, defaults, workers=1,
+                                        progress=lambda n, total, record: progress.append((n, total, record['id'])))
+        self.assertEqual((summary['skipped'], summary['ok'], summary['failed']), (1, 1, 1))
+        self.assertEqual(progress, [(1, 2, 'BAD'), (2, 2, 'surfaces.jsonl:3')])
+        with open(outputPath) as f:
+            records = dict((r['id'], r) for r in map(json.loads, f.readlines()[2:]))
+        self.assertEqual(sorted(records), ['BAD', 'surfaces.jsonl:3'])
+        self.assertTrue(records['BAD']['error'].startswith('KeyError'))
+        self.assertTrue(records['surfaces.jsonl:3']['result']['objectiveValue'] < 1.e-6)
+
+        # nothing left, unless the failures are retried
+        summary = batch_calibration.run(inputPath, outputPath, defaults, workers=1)
+        self.assertEqual((summary['skipped'], summary['ok'], summary['failed']), (3, 0, 0))
+        summary = batch_calibration.run(inputPath, outputPath, defaults, workers=1, retryFailed=True)
+        self.assertEqual((summary['skipped'], summary['failed']), (2, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
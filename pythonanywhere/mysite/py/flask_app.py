@@ -3,7 +3,7 @@
 from flask import Flask, render_template, request, json
 from flask_cors import CORS
 
-import datetime as dt
+import os
 import scipy.stats as st
 import numpy as np
 
@@ -12,6 +12,10 @@ import mpld3
 
 from fin.heston import HestonLord, HestonParams
 import fin.heston_calibration as hcal
+from fin import profiling
+from fin.surface_calibration import QuotedSurface, calibrateSurface, calibrationDiagnostics
+from fin.calibration_store import CalibrationStore
+from fin.heston_surrogate import ChebyshevSurrogate
 
 app = Flask(__name__)
 
@@ -36,192 +40,62 @@ def bs_pv(spot, vol, r, q, strike, ttm, phi):
 
 
 def heston_pv(spot, var0, r, q, kappa, theta, xi, rho, strike, ttm, phi):
+    # one-off prices over the whole range of the ui (short tenors, high xi): adaptive quad, not fixed nodes
     params = HestonParams(spot, var0, r, q, kappa, theta, xi, rho)
     model = HestonLord(params)
 
     return model.vanilla(strike, ttm, phi)
 
 
-def tenor2ttm(tenor):
-    m = {'ON': 1. / 252,
-         '1W': 1. / 52,
-         '2W': 2. / 52,
-         '3W': 3. / 52,
-         '1M': 1. / 12,
-         '2M': 2. / 12,
-         '3M': 3. / 12,
-         '4M': 4. / 12,
-         '5M': 5. / 12,
-         '6M': 6. / 12,
-         '7M': 7. / 12,
-         '8M': 8. / 12,
-         '9M': 9. / 12,
-         '10M': 10. / 12,
-         '11M': 11. / 12,
-         '12M': 1.,
-         '1Y': 1.,
-         '2Y': 2.,
-         '3Y': 3.,
-         '4Y': 4.,
-         '5Y': 5.
-         }
-
-    return m[tenor]
-
-
-def heston_calibrate_to_single_smile(spot, input_quotes, ini_params, method, premiumType, objective):
-    tStartMethod = dt.datetime.now()
-    t = []
-    zrDom = []
-    fwdPoints = []
-    smiles = []
-    tenors = []
-    deltaTypes = []
-
-    for q in input_quotes:
-        tenors.append(q['tenor'])
-        ttm = tenor2ttm(tenors[-1])
-        df = float(q['df'])
-        fwd = float(q['fwd'])
-        rr25 = float(q['rr25']) / 100.
-        atm = float(q['atm']) / 100.
-        bf25 = float(q['bf25']) / 100.
-        if 'rr10' in q:
-            rr10 = float(q['rr10']) / 100.
-            bf10 = float(q['bf10']) / 100.
-
-        deltaTypes.append(hcal.DeltaType.Spot if q['deltaType'] == 'Spot' else hcal.DeltaType.Forward)
-
-        t.append(ttm)
-        zrDom.append(-np.log(df) / ttm)
-        fwdPoints.append(fwd)
-        if 'rr10' in q:
-            smiles.append([atm + bf10 - rr10 / 2.,
-                           atm + bf25 - rr25 / 2.,
-                           atm,
-                           atm + bf25 + rr25 / 2.,
-                           atm + bf10 + rr10 / 2.])
-        else:
-            smiles.append([atm + bf25 - rr25 / 2.,
-                           atm,
-                           atm + bf25 + rr25 / 2.])
-
-    fwdPointsCurve = hcal.ForwardCurveFromLinearPoints(spot, t, fwdPoints)
-    dfDomCurve = hcal.InterpolatedZeroCurve(hcal.LinearInterpolator(t, zrDom))
-    dfForCurve = hcal.ForwardHelper.implyForeignCurve(
-        fwdPointsCurve, dfDomCurve)
-    fwdCurve = hcal.ForwardCurve(spot, dfDomCurve, dfForCurve)
-    fxMarket = hcal.FxMarket(dfDomCurve, dfForCurve, fwdCurve)
-
-    premiumType = hcal.PremiumType.Included if premiumType == 'Included' else hcal.PremiumType.Excluded
-    strikes = []
-    for i in xrange(len(t)):
-        quoteHelper = hcal.QuoteHelper(fxMarket,
-                                       deltaTypes[i],
-                                       premiumType)
-        if 'rr10' in q:
-            strikes.append([quoteHelper.strikeForDelta(t[i], -0.1, smiles[i][0]),
-                            quoteHelper.strikeForDelta(t[i], -0.25, smiles[i][1]),
-                            quoteHelper.atmStrike(t[i], smiles[i][2]),
-                            quoteHelper.strikeForDelta(t[i], 0.25, smiles[i][3]),
-                            quoteHelper.strikeForDelta(t[i], 0.1, smiles[i][4])])
-        else:
-            strikes.append([quoteHelper.strikeForDelta(t[i], -0.25, smiles[i][0]),
-                            quoteHelper.atmStrike(t[i], smiles[i][1]),
-                            quoteHelper.strikeForDelta(t[i], 0.25, smiles[i][-1])])
+# calibrated tenors, only edited ones are repriced by the incremental 'trf' recalibration
+TENOR_CACHE = hcal.TenorResidualCache()
 
-    # hParams = calibrator.calibrate_to_single_smile(
-    #    ttm, strikes[0], smiles[0], ini_params)
+# chebyshev surrogate for method 'Surrogate', trained offline by benchmark_heston_surrogate.py
+SURROGATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'heston_surrogate.npz')
+SURROGATE = ChebyshevSurrogate.load(SURROGATE_PATH) if os.path.exists(SURROGATE_PATH) else None
 
-    calibrator = hcal.HestonCalibrator(fxMarket)
-    tStart = dt.datetime.now()
-    if method == 'MC':
-        hParams, optValue = calibrator.calibrate_to_surface_mc(t, strikes, smiles, ini_params)
-    else:
-        hParams, optValue = calibrator.calibrate_to_surface(t, strikes, smiles, ini_params, method, objective)
-    tEnd = dt.datetime.now()
+# methods offered by the ui, 'Surrogate' only with a trained surrogate
+CALIBRATION_METHODS = [m for m in ['Nelder-Mead', 'Powell', 'Cobyla', 'BFGS', 'trf', 'DE', 'Surrogate', 'MC']
+                       if m != 'Surrogate' or SURROGATE is not None]
 
-    result = {
-        'hestonParams': hParams,
-        'objectiveValue': optValue,
-        'elapsedCalibration': str(tEnd - tStart),
-        'elapsedTime': str(dt.datetime.now() - tStartMethod)}
-    return result
+# calibrations of the same quotes are reused, close ones seed the optimizer. the sqlite file is
+# HESTON_CALIBRATION_STORE if set, else it lives in the instance folder of the app
+CALIBRATION_STORE_PATH = os.environ.get('HESTON_CALIBRATION_STORE',
+                                        os.path.join(app.instance_path, 'heston_calibrations.sqlite'))
+if not os.path.isdir(os.path.dirname(os.path.abspath(CALIBRATION_STORE_PATH))):
+    os.makedirs(os.path.dirname(os.path.abspath(CALIBRATION_STORE_PATH)))
+CALIBRATION_STORE = CalibrationStore(CALIBRATION_STORE_PATH)
+
+
+# processes of a multi-start calibration, per request
+MULTISTART_WORKERS = int(os.environ.get('HESTON_MULTISTART_WORKERS', 2))
+
+
+def heston_calibrate_to_single_smile(spot, input_quotes, ini_params, method, premiumType, objective, starts=1):
+    return calibrateSurface(spot, input_quotes, ini_params, method, premiumType, objective, starts,
+                            store=CALIBRATION_STORE, tenorCache=TENOR_CACHE, surrogate=SURROGATE,
+                            max_workers=MULTISTART_WORKERS)
 
 
 def heston_plot(spot, input_quotes, premiumType, hestonParams, xaxis, yaxis, optValue):
-    t = []
-    zrDom = []
-    fwdPoints = []
-    smiles = []
-    tenors = []
-    deltaTypes = []
-
-    for q in input_quotes:
-        tenors.append(q['tenor'])
-        ttm = tenor2ttm(tenors[-1])
-        df = float(q['df'])
-        fwd = float(q['fwd'])
-        rr25 = float(q['rr25']) / 100.
-        atm = float(q['atm']) / 100.
-        bf25 = float(q['bf25']) / 100.
-        if 'rr10' in q:
-            rr10 = float(q['rr10']) / 100.
-            bf10 = float(q['bf10']) / 100.
-
-        deltaTypes.append(hcal.DeltaType.Spot if q['deltaType'] == 'Spot' else hcal.DeltaType.Forward)
-
-        t.append(ttm)
-        zrDom.append(-np.log(df) / ttm)
-        fwdPoints.append(fwd)
-        if 'rr10' in q:
-            smiles.append([atm + bf10 - rr10 / 2.,
-                           atm + bf25 - rr25 / 2.,
-                           atm,
-                           atm + bf25 + rr25 / 2.,
-                           atm + bf10 + rr10 / 2.])
-        else:
-            smiles.append([atm + bf25 - rr25 / 2.,
-                           atm,
-                           atm + bf25 + rr25 / 2.])
-
-    fwdPointsCurve = hcal.ForwardCurveFromLinearPoints(spot, t, fwdPoints)
-    dfDomCurve = hcal.InterpolatedZeroCurve(hcal.LinearInterpolator(t, zrDom))
-    dfForCurve = hcal.ForwardHelper.implyForeignCurve(
-        fwdPointsCurve, dfDomCurve)
-    fwdCurve = hcal.ForwardCurve(spot, dfDomCurve, dfForCurve)
-    fxMarket = hcal.FxMarket(dfDomCurve, dfForCurve, fwdCurve)
-
-    premiumType = hcal.PremiumType.Included if premiumType == 'Included' else hcal.PremiumType.Excluded
-    strikes = []
-    for i in xrange(len(t)):
-        quoteHelper = hcal.QuoteHelper(fxMarket,
-                                       deltaTypes[i],
-                                       premiumType)
-        if 'rr10' in q:
-            strikes.append([quoteHelper.strikeForDelta(t[i], -0.1, smiles[i][0]),
-                            quoteHelper.strikeForDelta(t[i], -0.25, smiles[i][1]),
-                            quoteHelper.atmStrike(t[i], smiles[i][2]),
-                            quoteHelper.strikeForDelta(t[i], 0.25, smiles[i][3]),
-                            quoteHelper.strikeForDelta(t[i], 0.1, smiles[i][4])])
-        else:
-            strikes.append([quoteHelper.strikeForDelta(t[i], -0.25, smiles[i][0]),
-                            quoteHelper.atmStrike(t[i], smiles[i][1]),
-                            quoteHelper.strikeForDelta(t[i], 0.25, smiles[i][-1])])
+    surface = QuotedSurface(spot, input_quotes, premiumType)
+    t, tenors, smiles, strikes = surface.t, surface.tenors, surface.smiles, surface.strikes
+    dfDomCurve, dfForCurve, fwdCurve = surface.dfDomCurve, surface.dfForCurve, surface.fwdCurve
 
     hParams = hcal.HestonParams(**hestonParams)
     hestonMarket = hcal.HestonMarket(dfDomCurve, dfForCurve, fwdCurve, hParams)
 
     figure, _ = plt.subplots()
 
+    fwds = fwdCurve.fwd(np.array(t))
     for i in xrange(len(t)):
-        fwdi = fwdCurve.fwd(t[i])
+        fwdi = fwds[i]
         xPillars = kPillars = np.array(strikes[i])
         yPillars = np.array(smiles[i])
         k = np.linspace(0.9 * strikes[i][0], 1.1 * strikes[i][-1])
         k = np.array(sorted(set(k).union(kPillars)))
         x = k
-        y = np.array([hestonMarket.impl_vol(t[i], xi) for xi in x])
+        y = hestonMarket.impl_vol(t[i], x)
         if xaxis == 'Log-Moneyness':
             x = np.log(k / fwdi)
             xPillars = np.log(xPillars / fwdi)
@@ -242,8 +116,8 @@ def heston_plot(spot, input_quotes, premiumType, hestonParams, xaxis, yaxis, opt
         elif yaxis == 'Volatility':
             pass
         elif yaxis == 'PV':
-            y = [hestonMarket.vanilla(t[i], ki, np.sign(ki - fwdi)) for ki in k]
-            yPillars = [hestonMarket.vanilla(t[i], ki, np.sign(ki - fwdi)) for ki in kPillars]
+            y = hestonMarket.vanilla(t[i], k, np.sign(k - fwdi))
+            yPillars = hestonMarket.vanilla(t[i], kPillars, np.sign(kPillars - fwdi))
         elif yaxis == 'Density':
             pass
         else:
@@ -343,6 +217,14 @@ def heston_calibration_render():
         return error_response(e)
 
 
+@app.route('/heston/calibration_methods', methods=['GET'])
+def heston_calibration_methods():
+    try:
+        return json.dumps({'methods': CALIBRATION_METHODS})
+    except Exception as e:
+        return error_response(e)
+
+
 @app.route('/heston/calibrate', methods=['GET'])
 def heston_calibrate():
     try:
@@ -351,10 +233,18 @@ def heston_calibrate():
         ini_params = json.loads(request.args['ini_params'])
         method = request.args['method']
         premium_type = request.args['premium_type']
-        objective = request.args['objective']
-
-        result = heston_calibrate_to_single_smile(
-            spot, input_quotes, ini_params, method, premium_type, objective)
+        objective = request.args['objective'].upper()
+        starts = int(request.args.get('starts', 1))
+        diagnostics = request.args.get('diagnostics', 'false').lower() == 'true'
+
+        if diagnostics:
+            with profiling.recording() as profile:
+                result = heston_calibrate_to_single_smile(
+                    spot, input_quotes, ini_params, method, premium_type, objective, starts)
+            result['diagnostics'] = calibrationDiagnostics(profile)
+        else:
+            result = heston_calibrate_to_single_smile(
+                spot, input_quotes, ini_params, method, premium_type, objective, starts)
 
         return json.dumps(result, cls=JsonifiableEncoder)
     except Exception as e:
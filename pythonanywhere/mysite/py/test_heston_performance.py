@@ -30,7 +30,7 @@ def tenor2ttm(tenor):
     return m[tenor]
 
 
-def calibrateToSingleSmile():
+def calibrateToSingleSmile(method='Nelder-Mead'):
     spot = 1.6235
     input_quotes = [{
         'tenor': '1Y',
@@ -93,7 +93,7 @@ def calibrateToSingleSmile():
                                     strikes,
                                     vols,
                                     iniParams,
-                                    method='Nelder-Mead',
+                                    method=method,
                                     objective='PV')
     tEnd = datetime.now()
     print 'calibration finished in', tEnd - tStart